@@ -370,7 +370,7 @@ class Window(QMainWindow, Ui_MainWindow):
     def initialize_camera(self):
         def open_camera_feed():
             if self.client is not None:
-                url = "http://" + self.client.ip + ":8080/stream.mjpg"
+                url = "http://" + self.client.ip + ":8080/preview.mjpg"
                 webbrowser.open(url)
         self.camera.clicked.connect(open_camera_feed)
 
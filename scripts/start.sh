@@ -27,5 +27,6 @@ sudo /usr/bin/python driver_leds.py &
 /usr/bin/python behaviour_blush.py &
 /usr/bin/python behaviour_look_around.py &
 /usr/bin/python behaviour_change_mode.py &
+/usr/bin/python behaviour_track_face.py &
 
 /usr/bin/python driver_camera.py
@@ -13,6 +13,7 @@ import time
 import random
 import middleware as mw
 import cv2
+from face_detection import create_detector
 
 
 MAX_RANGE = 30.0
@@ -32,16 +33,14 @@ class BehaviourLookAround:
         self.pan = mw.Pan()
         self.tilt = mw.Tilt()
 
-        # Load pre-trained face detection classifier from OpenCV
-        # self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-    
+        # Face detector, the pyramid detector is fast enough to run on every glance
+        self.face_detector = create_detector("pyramid")
+
     def detect_faces(self, frame):
         """
         Detect faces in a given frame using OpenCV.
         """
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = self.face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
-        return faces
+        return self.face_detector.detect(frame, min_size=30)
 
     def run(self):
         """
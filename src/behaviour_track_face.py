@@ -0,0 +1,209 @@
+#! /usr/bin/env python
+
+
+"""
+
+Behaviour node.
+
+While enabled, the behaviour keeps the head pointed at the closest face.
+
+Faces are detected on the low resolution grayscale camera stream, at a steady rate.
+A PID controller turns the face offset into pan and tilt corrections.
+
+"""
+
+import threading
+import time
+
+import cv2
+
+import middleware as mw
+
+
+LOOP_RATE = 10
+FRAME_WIDTH = 320
+HORIZONTAL_FOV = 62.2
+VERTICAL_FOV = 48.8
+DEAD_ZONE = 1.5
+KP = 0.6
+KI = 0.05
+KD = 0.05
+MAX_INTEGRAL = 10.0
+
+
+class PID:
+    """
+    PID controller, with a bounded integral term.
+    """
+
+    def __init__(self, kp, ki, kd, max_integral):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.max_integral = max_integral
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.last_error = None
+
+    def update(self, error, dt):
+        self.integral += error * dt
+        self.integral = max(-self.max_integral, min(self.max_integral, self.integral))
+        derivative = 0.0
+        if self.last_error is not None and dt > 0:
+            derivative = (error - self.last_error) / dt
+        self.last_error = error
+        return self.kp * error + self.ki * self.integral + self.kd * derivative
+
+
+class FrameReader:
+    """
+    Reads the camera stream in the background.
+    Only the latest frame is kept, so detection never runs on stale frames.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.frame = None
+        self.timestamp = 0.0
+        self.running = False
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.frame = None
+
+    def read(self):
+        capture = cv2.VideoCapture(self.url)
+        try:
+            while self.running:
+                ok, frame = capture.read()
+                if not ok:
+                    time.sleep(0.1)
+                    continue
+                with self.lock:
+                    self.frame = frame
+                    self.timestamp = time.time()
+        finally:
+            capture.release()
+
+    def latest(self):
+        with self.lock:
+            return self.frame, self.timestamp
+
+
+class BehaviourTrackFace:
+
+    def __init__(self):
+        """
+        Connect to middleware.
+        Initialize node.
+        """
+        self.node = mw.Node("behaviour_track_face")
+        self.behaviours = mw.Behaviours()
+        self.camera = mw.Camera()
+        self.pan = mw.Pan()
+        self.tilt = mw.Tilt()
+        self.face_classifier = cv2.CascadeClassifier(
+            cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+        )
+        self.pid_pan = PID(KP, KI, KD, MAX_INTEGRAL)
+        self.pid_tilt = PID(KP, KI, KD, MAX_INTEGRAL)
+        self.reader = None
+        self.last_timestamp = 0.0
+
+    def detect_face(self, frame):
+        """
+        Detect the largest face in a downscaled grayscale frame.
+        Returns the face center, relative to the frame size, or None.
+        """
+        height, width = frame.shape[:2]
+        scale = FRAME_WIDTH / width
+        small = cv2.resize(frame, (FRAME_WIDTH, int(height * scale)), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        faces = self.face_classifier.detectMultiScale(gray, 1.2, 5, minSize=(30, 30))
+        if len(faces) == 0:
+            return None
+        x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+        return (x + w / 2) / gray.shape[1], (y + h / 2) / gray.shape[0]
+
+    def track(self):
+        """
+        Correct pan and tilt angles towards the face in the latest frame.
+        """
+        frame, timestamp = self.reader.latest()
+        if frame is None or timestamp == self.last_timestamp:
+            return
+        dt = timestamp - self.last_timestamp if self.last_timestamp else 1.0 / LOOP_RATE
+        self.last_timestamp = timestamp
+        face = self.detect_face(frame)
+        if face is None:
+            self.pid_pan.reset()
+            self.pid_tilt.reset()
+            return
+        # angle offsets, using the same conventions as the game centring
+        pan_error = (face[0] - 0.5) * HORIZONTAL_FOV
+        tilt_error = (0.5 - face[1]) * VERTICAL_FOV
+        if abs(pan_error) > DEAD_ZONE:
+            pan_angle = self.pan.angle - self.pid_pan.update(pan_error, dt)
+            self.pan.angle = round(max(self.pan.min_angle, min(self.pan.max_angle, pan_angle)), 1)
+        else:
+            self.pid_pan.reset()
+        if abs(tilt_error) > DEAD_ZONE:
+            tilt_angle = self.tilt.angle - self.pid_tilt.update(tilt_error, dt)
+            self.tilt.angle = round(max(self.tilt.min_angle, min(self.tilt.max_angle, tilt_angle)), 1)
+        else:
+            self.pid_tilt.reset()
+
+    def run(self):
+        """
+        Main loop.
+        """
+        try:
+            self.node.loginfo("waiting for pan and tilt to be ready")
+            # wait for pan and tilt to be ready
+            while not self.node.is_shutdown():
+                time.sleep(0.1)
+                if self.pan.ready and self.tilt.ready:
+                    break
+            self.node.loginfo("starting behaviour")
+            enabled = False
+            while not self.node.is_shutdown():
+                loop_start = time.time()
+                if self.behaviours.track_face and not enabled:
+                    # behaviour was enabled, enable torque and start reading frames
+                    enabled = True
+                    self.pan.enable = True
+                    self.tilt.enable = True
+                    self.pid_pan.reset()
+                    self.pid_tilt.reset()
+                    self.last_timestamp = 0.0
+                    self.reader = FrameReader(self.camera.analysis_url)
+                    self.reader.start()
+                if not self.behaviours.track_face and enabled:
+                    # behaviour was disabled, stop reading frames, keep the head where it is
+                    enabled = False
+                    self.reader.stop()
+                    self.reader = None
+                if enabled and self.pan.enabled and self.tilt.enabled:
+                    self.track()
+                time.sleep(max(0.0, 1.0 / LOOP_RATE - (time.time() - loop_start)))
+        finally:
+            if self.reader is not None:
+                self.reader.stop()
+            self.node.shutdown()
+
+
+if __name__ == '__main__':
+    behaviour = BehaviourTrackFace()
+    behaviour.run()
@@ -0,0 +1,109 @@
+"""
+
+Commands that controllers can send to the robot.
+
+The commands are registered by name and take a single text value, as in the
+"command::value" messages of the Emo-Show game. They are shared by emoshow_handler,
+which receives them over UDP, TCP or WebSocket, and robot_api, which accepts them
+as {"op": command, "value": value} requests.
+
+"""
+
+import os
+
+import middleware as mw
+
+
+class CommandRegistry:
+    """
+    Commands, by name.
+
+    Slow commands block (e.g. on HTTP downloads) and are run outside of
+    the receive path by the handlers.
+
+    Methods:
+        register(name, slow): Decorator that registers a command
+        has(name): Check if a command is registered
+        is_slow(name): Check if a command is slow
+        execute(name, value): Run a command
+    """
+
+    def __init__(self):
+        self.commands = {}
+        self.slow = set()
+
+    def register(self, name, slow=False):
+        def decorator(function):
+            self.commands[name] = function
+            if slow:
+                self.slow.add(name)
+            return function
+        return decorator
+
+    def has(self, name):
+        return name in self.commands
+
+    def is_slow(self, name):
+        return name in self.slow
+
+    def execute(self, name, value):
+        if name not in self.commands:
+            raise ValueError(f"{name} is not a recognized command")
+        self.commands[name](value)
+
+
+registry = CommandRegistry()
+
+pan = mw.Pan()
+tilt = mw.Tilt()
+onboard = mw.Onboard()
+speakers = mw.Speakers()
+leds = mw.Leds()
+server = mw.Server()
+
+image_path = "images/emoshow/"
+sound_path = "emoshow/"
+icon_path = "emoshow/"
+
+
+@registry.register("pan")
+def set_pan(value):
+    pan.angle = int(value)
+
+
+@registry.register("tilt")
+def set_tilt(value):
+    tilt.angle = int(value)
+
+
+@registry.register("image")
+def set_image(value):
+    if "emoshow" in value:
+        image_src = value
+    else:
+        image_src = os.path.join(image_path, f"{value}")
+    onboard.image = image_src
+
+
+@registry.register("speakers")
+def set_speakers(value):
+    if value == "increaseVolume":
+        speakers.volume += 10
+    elif value == "decreaseVolume":
+        speakers.volume -= 10
+    else:
+        speakers.volume = int(value)
+
+
+@registry.register("sound", slow=True)
+def play_sound(value):
+    sound_src = os.path.join(sound_path, f"{value}")
+    sound_url = server.url_for_sound(sound_src)
+    speakers.url = sound_url
+
+
+@registry.register("icon", slow=True)
+def set_icon(value):
+    icon_src = os.path.join(icon_path, f"{value}")
+    icon_url = server.url_for_icon(icon_src)
+    leds.load_from_url(icon_url)
@@ -6,6 +6,7 @@
 Driver node.
 
 This node reads the battery voltage and publishes it to the middleware.
+The values are written to shared memory, see telemetry.py.
 
 """
 
@@ -16,6 +17,7 @@ import time
 import numpy as np
 
 import middleware as mw
+from telemetry import TelemetryWriter
 
 
 I2C_SLAVE_COMMAND=0x0703
@@ -44,6 +46,7 @@ class DriverBattery:
         self.file_handle =  io.open("/dev/i2c-1", "rb", buffering=0)
         fcntl.ioctl(self.file_handle, I2C_SLAVE_COMMAND, self.battery.i2c_address)
         self.node = mw.Node("driver_battery")
+        self.telemetry = TelemetryWriter(self.battery)
         value_at_13v = self.battery.ad_at_13v
         value_at_16v = self.battery.ad_at_16v
         x = [value_at_13v, value_at_16v]
@@ -75,17 +78,18 @@ class DriverBattery:
             while not self.node.is_shutdown():
                 time.sleep(0.1)
                 raw = self.read_ad()
-                self.battery.raw = raw
                 voltage = self.ad_to_voltage(raw)
-                self.battery.voltage = voltage
                 self.voltage_buffer.append(voltage)
                 if len(self.voltage_buffer) > 100:
                     self.voltage_buffer.pop(0)
                     m = np.mean(self.voltage_buffer)
-                    self.battery.percentage = battery_percentage(m)
+                    self.telemetry.write(raw=raw, voltage=voltage, percentage=battery_percentage(m))
+                else:
+                    self.telemetry.write(raw=raw, voltage=voltage)
         except KeyboardInterrupt:
             pass
         finally:
+            self.telemetry.close()
             self.node.shutdown()
 
 
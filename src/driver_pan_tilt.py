@@ -9,46 +9,201 @@ This node manages the pan tilt servos.
 
 Uses the herkulex library to control the servos.
 
+New target angles are turned into a combined pan tilt trajectory,
+following a minimum-jerk profile within the velocity and acceleration limits.
+The trajectory is streamed to the servos as intermediate setpoints, at a fixed control rate.
+Once the trajectory ends, the servo inposition flag is polled to report when the head settled.
+The current angles are written to shared memory, see telemetry.py.
+
 """
 
 
+import math
 import time
 
 import herkulex as hx
 import middleware as mw
+from telemetry import TelemetryWriter
+
+
+CONTROL_RATE = 20
+PLAYTIME_UNIT = 0.0112
+TELEMETRY_SLEEP = 0.2
+INPOSITION_SLEEP = 0.05
+
+
+def minimum_jerk(tau):
+    """
+    Normalized minimum-jerk profile.
+    Maps tau between 0.0 and 1.0 to a position between 0.0 and 1.0.
+    """
+    tau = max(0.0, min(1.0, tau))
+    return tau ** 3 * (10.0 - 15.0 * tau + 6.0 * tau ** 2)
+
+
+class Trajectory:
+    """
+    Combined trajectory for several axes.
+    All axes start and stop together, following a minimum-jerk profile.
+    The duration is the shortest one that respects the velocity and
+    acceleration limits of every axis.
+    """
+
+    # peak velocity and acceleration of the normalized minimum-jerk profile
+    PEAK_VELOCITY = 1.875
+    PEAK_ACCELERATION = 10.0 / math.sqrt(3.0)
+
+    def __init__(self, start, goal, max_velocity, max_acceleration):
+        self.start = list(start)
+        self.goal = list(goal)
+        self.duration = 0.0
+        for s, g, v, a in zip(start, goal, max_velocity, max_acceleration):
+            distance = abs(g - s)
+            if distance == 0:
+                continue
+            self.duration = max(
+                self.duration,
+                self.PEAK_VELOCITY * distance / v,
+                math.sqrt(self.PEAK_ACCELERATION * distance / a),
+            )
+        self.start_time = time.time()
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def is_complete(self):
+        return self.elapsed() >= self.duration
+
+    def is_moving(self, axis):
+        return self.start[axis] != self.goal[axis]
+
+    def sample(self):
+        """
+        Get the setpoint of every axis at the current time.
+        """
+        if self.duration == 0.0:
+            return list(self.goal)
+        s = minimum_jerk(self.elapsed() / self.duration)
+        return [a + (b - a) * s for a, b in zip(self.start, self.goal)]
 
 
 class DriverPanTilt:
 
-    def __init__(self):
+    def __init__(self, herkulex=hx):
         """
         Connect to middleware.
         Initialize node.
+        The herkulex module can be replaced, e.g. by a simulated servo bus.
         """
+        self.hx = herkulex
         self.pan = mw.Pan()
         self.tilt = mw.Tilt()
         self.node = mw.Node("driver_pan_tilt")
-    
+        self.pan_telemetry = TelemetryWriter(self.pan)
+        self.tilt_telemetry = TelemetryWriter(self.tilt)
+        self.trajectory = None
+        self.setpoint = [0.0, 0.0]
+        self.telemetry_step = 0
+
     def connect(self):
         """
         Connect to servos.
         """
         pan_id = self.pan.id
         tilt_id = self.tilt.id
-        hx.connect("/dev/ttyS0", 115200)
+        self.hx.connect("/dev/ttyS0", 115200)
         self.node.loginfo("connected to serial port")
-        hx.clear_errors()
+        self.hx.clear_errors()
         time.sleep(1.0)
         self.node.loginfo("errors cleared")
         self.node.loginfo("connecting to pan servo using id %s" % pan_id)
-        self.servo_pan = hx.servo(pan_id)
+        self.servo_pan = self.hx.servo(pan_id)
         self.node.loginfo("connected to pan servo")
         self.node.loginfo("connecting to tilt servo using id %s" % tilt_id)
-        self.servo_tilt = hx.servo(tilt_id)
+        self.servo_tilt = self.hx.servo(tilt_id)
         self.node.loginfo("connected to tilt servo")
         time.sleep(1.0)
         self.node.loginfo("connected to pan tilt servos")
 
+    def plan_trajectory(self):
+        """
+        Plan a trajectory from the current setpoint to the requested angles.
+        A trajectory in progress is replaced, starting from where it is now.
+        """
+        start = list(self.setpoint)
+        goal = list(self.trajectory.goal) if self.trajectory else list(self.setpoint)
+        if self.pan.enabled and self.pan.angle_ref != self.pan.angle:
+            self.pan.angle_ref = self.pan.angle
+            goal[0] = max(self.pan.min_angle, min(self.pan.max_angle, self.pan.angle))
+        if self.tilt.enabled and self.tilt.angle_ref != self.tilt.angle:
+            self.tilt.angle_ref = self.tilt.angle
+            goal[1] = max(self.tilt.min_angle, min(self.tilt.max_angle, self.tilt.angle))
+        self.trajectory = Trajectory(
+            start,
+            goal,
+            [self.pan.max_velocity, self.tilt.max_velocity],
+            [self.pan.max_acceleration, self.tilt.max_acceleration],
+        )
+        if self.trajectory.is_moving(0):
+            self.pan.moving = True
+            self.pan.in_position = False
+        if self.trajectory.is_moving(1):
+            self.tilt.moving = True
+            self.tilt.in_position = False
+
+    def follow_trajectory(self):
+        """
+        Send the next setpoint of the trajectory to the servos.
+        Each setpoint is reached within one control period.
+        Signals motion complete once the goal is sent.
+        """
+        # Decide before sampling, so the last step always sends the exact goal
+        complete = self.trajectory.is_complete()
+        self.setpoint = list(self.trajectory.goal) if complete else self.trajectory.sample()
+        playtime = max(1, int(round(1.0 / CONTROL_RATE / PLAYTIME_UNIT)))
+        if self.pan.enabled and self.trajectory.is_moving(0):
+            self.servo_pan.set_servo_angle(self.setpoint[0] + self.pan.angle_bias, playtime, 0)
+        if self.tilt.enabled and self.trajectory.is_moving(1):
+            self.servo_tilt.set_servo_angle(self.setpoint[1] + self.tilt.angle_bias, playtime, 0)
+        if complete:
+            self.trajectory = None
+            self.pan.moving = False
+            self.tilt.moving = False
+
+    def update_in_position(self):
+        """
+        Poll the inposition flag of the servos that did not settle yet.
+        Returns True if any servo was polled.
+        """
+        if self.pan.enabled and not self.pan.in_position:
+            self.pan.in_position = self.servo_pan.get_servo_inposition()
+            time.sleep(INPOSITION_SLEEP)
+            return True
+        if self.tilt.enabled and not self.tilt.in_position:
+            self.tilt.in_position = self.servo_tilt.get_servo_inposition()
+            time.sleep(INPOSITION_SLEEP)
+            return True
+        return False
+
+    def update_telemetry(self):
+        """
+        Read one telemetry value from the servos, taking turns.
+        Keeps the loop responsive to new targets while idle.
+        """
+        if self.update_in_position():
+            return
+        step = self.telemetry_step % 4
+        self.telemetry_step += 1
+        if step == 0:
+            self.pan_telemetry.write(current_angle=self.servo_pan.get_servo_angle() - self.pan.angle_bias)
+        elif step == 1:
+            self.tilt_telemetry.write(current_angle=self.servo_tilt.get_servo_angle() - self.tilt.angle_bias)
+        elif step == 2:
+            self.pan.temperature = self.servo_pan.get_servo_temperature()
+        else:
+            self.tilt.temperature = self.servo_tilt.get_servo_temperature()
+        time.sleep(TELEMETRY_SLEEP)
+
     def run(self):
         """
         Main loop.
@@ -57,8 +212,18 @@ class DriverPanTilt:
             self.error_count = 0
             self.connected = False
             self.connect()
+            self.pan_telemetry.write(current_angle=self.servo_pan.get_servo_angle() - self.pan.angle_bias)
+            time.sleep(TELEMETRY_SLEEP)
+            self.tilt_telemetry.write(current_angle=self.servo_tilt.get_servo_angle() - self.tilt.angle_bias)
+            time.sleep(TELEMETRY_SLEEP)
+            self.setpoint = [self.pan.current_angle, self.tilt.current_angle]
+            self.pan.moving = False
+            self.tilt.moving = False
+            self.pan.in_position = True
+            self.tilt.in_position = True
             self.pan.ready = True
             self.tilt.ready = True
+            next_tick = time.time()
             while not self.node.is_shutdown():
                 try:
                     # calibrate pid
@@ -95,53 +260,34 @@ class DriverPanTilt:
                         self.servo_tilt.torque_off()
                         time.sleep(0.2)
                         self.tilt.enabled = False
-                    # set pan angle
-                    if self.pan.enabled and self.pan.angle_ref != self.pan.angle:
-                        self.pan.angle_ref = self.pan.angle
-                        angle = max(self.pan.min_angle, min(self.pan.max_angle, self.pan.angle))
-                        # calculate playtime based on motion range.
-                        motion_range = abs(self.pan.current_angle - angle)
-                        max_motion_range = abs(self.pan.max_angle - self.pan.min_angle)
-                        motion_range_percent = motion_range / max_motion_range
-                        playtime = int(self.pan.min_playtime + (self.pan.max_playtime - self.pan.min_playtime) * motion_range_percent)
-                        # self.node.loginfo("setting pan angle to %s with playtime %s" % (angle, playtime))
-                        angle += self.pan.angle_bias
-                        self.servo_pan.set_servo_angle(angle, playtime, 0)
-                        time.sleep(0.2)
-                        # self.node.loginfo("pan angle set")
-                    # set tilt angle
-                    if self.tilt.enabled and self.tilt.angle_ref != self.tilt.angle:
-                        self.tilt.angle_ref = self.tilt.angle
-                        angle = max(self.tilt.min_angle, min(self.tilt.max_angle, self.tilt.angle))
-                        # calculate playtime based on motion range.
-                        motion_range = abs(self.tilt.current_angle - angle)
-                        max_motion_range = abs(self.tilt.max_angle - self.tilt.min_angle)
-                        motion_range_percent = motion_range / max_motion_range
-                        playtime = int(self.tilt.min_playtime + (self.tilt.max_playtime - self.tilt.min_playtime) * motion_range_percent)
-                        # self.node.loginfo("setting tilt angle to %s with playtime %s" % (angle, playtime))
-                        angle += self.tilt.angle_bias
-                        self.servo_tilt.set_servo_angle(angle, playtime, 0)
-                        time.sleep(0.2)
-                        # self.node.loginfo("tilt angle set")
-                    # update current angles
-                    self.pan.current_angle = self.servo_pan.get_servo_angle() - self.pan.angle_bias
-                    time.sleep(0.2)
-                    self.tilt.current_angle = self.servo_tilt.get_servo_angle() - self.tilt.angle_bias
-                    time.sleep(0.2)
-                    # update current temperature
-                    self.pan.temperature = self.servo_pan.get_servo_temperature()
-                    time.sleep(0.2)
-                    self.tilt.temperature = self.servo_tilt.get_servo_temperature()
-                    time.sleep(0.2)
+                    # plan a new trajectory when the target angles change
+                    pan_target = self.pan.enabled and self.pan.angle_ref != self.pan.angle
+                    tilt_target = self.tilt.enabled and self.tilt.angle_ref != self.tilt.angle
+                    if pan_target or tilt_target:
+                        self.plan_trajectory()
+                    # stream setpoints at a fixed rate, otherwise update telemetry
+                    if self.trajectory is not None:
+                        self.follow_trajectory()
+                        next_tick += 1.0 / CONTROL_RATE
+                        delay = next_tick - time.time()
+                        if delay > 0:
+                            time.sleep(delay)
+                        else:
+                            next_tick = time.time()
+                    else:
+                        self.update_telemetry()
+                        next_tick = time.time()
                 except IndexError:
-                    hx.clear_errors()
+                    self.hx.clear_errors()
                     time.sleep(0.1)
         except hx.HerkulexError as e:
             print(f'herkulex error: {e}')
         finally:
             time.sleep(1.0)
+            self.pan_telemetry.close()
+            self.tilt_telemetry.close()
             self.node.shutdown()
-            hx.close()
+            self.hx.close()
 
 
 if __name__ == '__main__':
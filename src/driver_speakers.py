@@ -8,6 +8,7 @@ Driver node.
 This node manages the speakers.
 
 Uses the aplay command to play sounds.
+When a sound ends, or is stopped, it is reported as finished.
 
 """
 
@@ -34,11 +35,28 @@ class DriverSpeakers:
         """
         Play a sound.
         """
-        self.speakers.playing = url
         print(f'playing {url}')
         os.system(f'/usr/bin/curl {url} | /usr/bin/aplay')
-        self.speakers.url = None
-        self.speakers.playing = None
+        self.finish_sound(url)
+
+    def start_sound(self, url):
+        """
+        Start playing a sound in its own process, so it can be killed.
+        """
+        self.process = multiprocessing.Process(target=self.play_sound, args=(url,))
+        self.process.start()
+
+    def finish_sound(self, url):
+        """
+        Report a sound as finished.
+        """
+        # a newer sound may have been requested in the meantime, keep it
+        if self.speakers.url == url:
+            self.speakers.url = None
+        if self.speakers.playing == url:
+            self.speakers.playing = None
+        self.speakers.finished_at = time.time()
+        self.speakers.finished = url
     
     def stop_sound(self):
         """
@@ -47,6 +65,12 @@ class DriverSpeakers:
         print(f'stopping')
         os.system("/usr/bin/killall aplay")
 
+    def set_volume(self, volume):
+        """
+        Set the volume, returns True if it was changed.
+        """
+        return 0 == os.system(f'/usr/bin/amixer sset "Master" {volume}%')
+
     def run(self):
         """
         Main loop.
@@ -59,17 +83,17 @@ class DriverSpeakers:
                 playing = self.speakers.playing
                 volume = self.speakers.volume
                 # play sound
-                if url != playing:
+                if url is not None and url != playing:
                     self.stop_sound()
-                    self.process = multiprocessing.Process(target=self.play_sound, args=(url,))
-                    self.process.start()
+                    self.speakers.playing = url
+                    self.start_sound(url)
                 # stop sound
                 if playing and url is None:
                     self.stop_sound()
                     self.speakers.playing = None
                 # change volume
                 if self.volume != volume:
-                    if 0 == os.system(f'/usr/bin/amixer sset "Master" {volume}%'):
+                    if self.set_volume(volume):
                         self.volume = volume
         finally:
             self.stop_sound()
@@ -8,6 +8,7 @@ Driver node.
 This node manages the touch sensors.
 
 Uses the adafruit_mpr121 library to read the touch sensors.
+The raw values are written to shared memory, see telemetry.py.
 
 """
 
@@ -17,6 +18,7 @@ import busio
 import adafruit_mpr121
 
 import middleware as mw
+from telemetry import TelemetryWriter
 
 
 class DriverTouchSensors:
@@ -30,6 +32,7 @@ class DriverTouchSensors:
         self.mpr121 = adafruit_mpr121.MPR121(i2c)
         self.touch_sensors = mw.TouchSensors()
         self.node = mw.Node("driver_touch_sensors")
+        self.telemetry = TelemetryWriter(self.touch_sensors)
 
     def run(self):
         """
@@ -38,13 +41,16 @@ class DriverTouchSensors:
         try:
             self.touch_sensors.ready = True
             while not self.node.is_shutdown():
-                self.touch_sensors.chest_raw = self.mpr121.filtered_data(0)
-                self.touch_sensors.head_0_raw = self.mpr121.filtered_data(1)
-                self.touch_sensors.head_1_raw = self.mpr121.filtered_data(2)
-                self.touch_sensors.head_2_raw = self.mpr121.filtered_data(3)
-                self.touch_sensors.head_3_raw = self.mpr121.filtered_data(4)    
+                self.telemetry.write(
+                    chest_raw=self.mpr121.filtered_data(0),
+                    head_0_raw=self.mpr121.filtered_data(1),
+                    head_1_raw=self.mpr121.filtered_data(2),
+                    head_2_raw=self.mpr121.filtered_data(3),
+                    head_3_raw=self.mpr121.filtered_data(4),
+                )
                 time.sleep(0.1)
         finally:
+            self.telemetry.close()
             self.node.shutdown()
 
 
@@ -6,6 +6,7 @@ import FreeSimpleGUI as sg
 
 from elmo_server import ElmoServer
 from emoshow_logger import EmoShowLogger
+from face_detection import create_detector
 
 elmo = None
 elmo_ip = None
@@ -13,11 +14,13 @@ logger = None
 window = None
 debug_mode = False
 connect_mode = False
+preview_timestamp = 0.0  # Time of the frame shown in the preview
 
-# Load the Haar Cascade model
-face_classifier = cv2.CascadeClassifier(
-    cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
-)
+# Size of the camera preview
+PREVIEW_SIZE = (640, 480)
+
+# Face detector used to center the players
+face_detector = create_detector("pyramid")
 
 def create_layout():
     """
@@ -109,14 +112,13 @@ def call_gemini():
     # Call Gemini API to get a response (TODO: implement)
     return
 
-def center_player(self, side):
+def center_player(side):
     """
     Centers the player's face in the frame by adjusting the robot's pan and
     tilt angles. If no faces detected, returns and continues the game.
     """
-    frame = self.elmo.grab_image()
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    faces = face_classifier.detectMultiScale(gray, 1.1, 5, minSize=(100, 100))
+    frame = elmo.grab_image()
+    faces = face_detector.detect(frame, min_size=100)
 
     if len(faces) == 0:
         print("Cannot center player. No faces detected.")
@@ -167,6 +169,27 @@ def center_player(self, side):
 
 
 
+def update_preview():
+    """
+    Shows the latest camera frame in the window, if it changed.
+
+    The frame is decoded at reduced resolution and passed to the window as
+    an uncompressed PPM, which is much cheaper than encoding a PNG.
+    """
+    global preview_timestamp
+
+    # Called on every window tick, so never wait for the stream
+    frame = elmo.grab_frame(timeout=0)
+    if frame is None or frame.timestamp == preview_timestamp:
+        return
+    preview_timestamp = frame.timestamp
+
+    img = frame.decode(PREVIEW_SIZE)
+    if img is not None:
+        img_bytes = cv2.imencode(".ppm", img)[1].tobytes()
+        window["image"].update(data=img_bytes)
+
+
 def handle_events():
     """
     Handle events from the GUI window.
@@ -181,9 +204,7 @@ def handle_events():
     event, values = window.read(timeout=1)
 
     if not debug_mode and not connect_mode:
-        img = elmo.grab_image()
-        img_bytes = cv2.imencode(".png", img)[1].tobytes()
-        window["image"].update(data=img_bytes)
+        update_preview()
 
     if event == "Ok":
         logger.set_filename(values["-FILENAME-"])
@@ -314,9 +335,7 @@ def main():
 
     if not debug_mode and not connect_mode:
         # Initial image update
-        img = elmo.grab_image()
-        img_bytes = cv2.imencode(".png", img)[1].tobytes()
-        window["image"].update(data=img_bytes)
+        update_preview()
 
     # Event loop
     while True:
@@ -1,8 +1,21 @@
-import socket
+import contextlib
+import threading
+import time
 import cv2
 import numpy as np
 import requests
 
+from emoshow_protocol import OPS, CommandClient, coalesce
+from stream_reader import Frame, StreamReader
+from timeline import sound_duration
+
+
+# Messages sent within this time are coalesced into one datagram
+COALESCE_WINDOW = 0.005
+
+# Time a head move takes, when the robot cannot report it (debug and connect modes)
+MOVE_TIME = 2.0
+
 
 class ElmoServer:
     """
@@ -17,6 +30,13 @@ class ElmoServer:
                                 Defaults to False.
         connect_mode (bool, optional): Specifies whether the server is in
                                     connect mode. Defaults to False.
+        reliable (bool, optional): Specifies whether commands are
+                                   acknowledged and retransmitted.
+                                   Defaults to True.
+        coalesce_window (float, optional): Messages sent within this time
+                                           share one datagram, 0 sends each
+                                           one right away.
+                                           Defaults to COALESCE_WINDOW.
 
     Methods:
         set_pan(int): Sets the pan angle
@@ -36,35 +56,59 @@ class ElmoServer:
         get_control_blush(): Get the status of the behaviour blush
         connect_elmo(): Connect to the Elmo robot
         send_message(message): Send a message to the Elmo robot
+        batch(): Context manager that sends the messages of its block in one
+                 datagram
+        flush_messages(): Send the messages waiting for the coalescing window
         send_request_command(command, **kwargs): Send a request command to the
                                                 Elmo robot
+        get_link_stats(): Get the latency and loss counters of the commands
         toggle_motors(): Toggle the motor control
         toggle_behaviour(): Toggle the behaviour control
         toggle_blush(): Toggle the blush control
+        set_face_tracking(control): Enable or disable the face tracking
+                                    behaviour
         check_pan_angle(self, angle): Check if the pan angle is valid
         check_tilt_angle(self, angle): Check if the tilt angle is valid
         move_pan(angle): Pan move with a specific angle
         move_tilt(angle): Tilt move with a specific angle
         move_left(): Move to the left
         move_right(): Move to the right
+        wait_until_settled(timeout): Wait until the motors reach the last
+                                     requested angles
         set_volume(volume): Set the volume
         increase_volume(): Send message to increase the volume
         decrease_volume(): Send message to decrease the volume
-        grab_image(): Capture an image
+        grab_frame(after): Get a camera frame, without decoding it
+        grab_snapshot(still): Request a single full resolution frame
+        grab_burst(count, after, timeout): Get consecutive camera frames
+        grab_image(after, size, grayscale): Capture an image, optionally the
+                                            first one received after a
+                                            given time
         set_image(image_name): Set the image
         set_icon(icon_name): Set the icon
-        play_sound(sound): Play a sound
+        get_sound_duration(sound): Get the duration of a sound
+        play_sound(sound, wait): Play a sound, optionally until it ends
+        wait_sound(sound, timeout): Wait until a sound ends
         close_all(): Close all connections
 
     """
 
     def __init__(
-        self, elmo_ip, elmo_port, client_ip, logger, debug=False, connect_mode=False
+        self, elmo_ip, elmo_port, client_ip, logger, debug=False, connect_mode=False, reliable=True,
+        coalesce_window=COALESCE_WINDOW
     ):
         self.elmo_ip = elmo_ip
         self.elmo_port = elmo_port
         self.client_ip = client_ip
-        self.elmo_socket = None
+        self.reliable = reliable
+        self.command_client = None
+        self.stream_reader = None
+        self.batches = threading.local()  # Messages batched by each thread
+        self.coalesce_window = coalesce_window
+        self.coalesced = []  # Messages waiting for the coalescing window
+        self.coalesce_lock = threading.Lock()
+        self.coalesce_timer = None
+        self.sound_durations = {}  # Sound durations reported by the robot
 
         self.connect_mode = connect_mode
         self.logger = logger
@@ -79,6 +123,7 @@ class ElmoServer:
 
         self.send_request_command("enable_behaviour", name="look_around", control=False)
         self.send_request_command("enable_behaviour", name="blush", control=False)
+        self.send_request_command("enable_behaviour", name="track_face", control=False)
         self.send_request_command("set_tilt_torque", control=True)
         self.send_request_command("set_pan_torque", control=True)
 
@@ -89,6 +134,9 @@ class ElmoServer:
         if not debug:
             self.connect_elmo()
             self.debug = False
+            if not connect_mode:
+                self.stream_reader = StreamReader(f"http://{elmo_ip}:8080/preview.mjpg")
+                self.stream_reader.start()
         else:
             # print("Debug mode has been activated")
             self.debug = True
@@ -219,8 +267,9 @@ class ElmoServer:
         """
         Connects to the Elmo robot.
         """
-        self.elmo_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        # print("Socket created!")
+        self.command_client = CommandClient(
+            (self.elmo_ip, self.elmo_port), reliable=self.reliable, logger=self.logger
+        )
 
     def send_message(self, message):
         """
@@ -229,12 +278,79 @@ class ElmoServer:
         Args:
             message (str): The message to be sent.
         """
-        self.logger.log_message(message)
+        command, _, value = message.partition("::")
+        self.logger.log_event("command", command=command, value=value)
 
         if self.debug == True:
             return "debug"
 
-        self.elmo_socket.sendto(message.encode("utf-8"), (self.elmo_ip, self.elmo_port))
+        if command not in OPS:
+            return  # Not handled by emoshow_handler (e.g. motors, behaviour)
+
+        pending = getattr(self.batches, "pending", None)
+        if pending is not None:
+            pending.append(message)
+            return
+
+        if self.coalesce_window <= 0:
+            self.command_client.send([message])
+            return
+
+        with self.coalesce_lock:
+            self.coalesced.append(message)
+            if self.coalesce_timer is None:
+                self.coalesce_timer = threading.Timer(self.coalesce_window, self.flush_messages)
+                self.coalesce_timer.daemon = True
+                self.coalesce_timer.start()
+
+    def flush_messages(self):
+        """
+        Sends the messages waiting for the coalescing window, in one
+        datagram.
+        """
+        with self.coalesce_lock:
+            messages = self.coalesced
+            self.coalesced = []
+            if self.coalesce_timer is not None:
+                self.coalesce_timer.cancel()
+                self.coalesce_timer = None
+            # Sent under the lock, so datagrams keep the order of the messages
+            if len(messages) > 0:
+                self.command_client.send(coalesce(messages))
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Sends the messages of the block in one datagram when the block ends.
+        The robot applies them in order. Nested blocks join the outer batch.
+        """
+        if getattr(self.batches, "pending", None) is not None:
+            yield
+            return
+
+        self.batches.pending = []
+        try:
+            yield
+        finally:
+            messages = self.batches.pending
+            self.batches.pending = None
+            if len(messages) > 0 and not self.debug:
+                # Earlier messages go first, so the robot applies them in order
+                with self.coalesce_lock:
+                    self.coalesced.extend(messages)
+                self.flush_messages()
+
+    def get_link_stats(self):
+        """
+        Returns the latency and loss counters of the commands sent to the
+        robot.
+
+        Returns:
+            dict: The counters, or None in debug mode.
+        """
+        if self.command_client is None:
+            return None
+        return self.command_client.get_stats()
 
     def send_request_command(self, command, **kwargs):
         """
@@ -284,6 +400,16 @@ class ElmoServer:
             "enable_behaviour", name="blush", control=self.control_blush
         )
 
+    def set_face_tracking(self, control):
+        """
+        Enables or disables the face tracking behaviour running on the robot.
+
+        Args:
+            control (bool): True to keep the head pointed at the closest face.
+        """
+        self.send_message(f"track_face::{control}")
+        self.send_request_command("enable_behaviour", name="track_face", control=control)
+
     def check_pan_angle(self, angle):
         """
         Checks if the pan angle is valid. If it is not valid then returns a
@@ -341,9 +467,11 @@ class ElmoServer:
         """
         self.current_pan = self.default_pan_left
         self.current_tilt = self.default_tilt_left
-        
-        self.send_message(f"pan::{self.default_pan_left}")
-        self.send_message(f"tilt::{self.default_tilt_left}")
+
+        # One datagram, so the robot never applies the pan without the tilt
+        with self.batch():
+            self.send_message(f"pan::{self.default_pan_left}")
+            self.send_message(f"tilt::{self.default_tilt_left}")
 
     def move_right(self):
         """
@@ -354,9 +482,45 @@ class ElmoServer:
         """
         self.current_pan = self.default_pan_right
         self.current_tilt = self.default_tilt_right
-        
-        self.send_message(f"pan::{self.default_pan_right}")
-        self.send_message(f"tilt::{self.default_tilt_right}")
+
+        # One datagram, so the robot never applies the pan without the tilt
+        with self.batch():
+            self.send_message(f"pan::{self.default_pan_right}")
+            self.send_message(f"tilt::{self.default_tilt_right}")
+
+    def wait_until_settled(self, timeout=3.0):
+        """
+        Waits until the pan and tilt motors reach the last requested angles.
+
+        The robot reports when its trajectory ended and the servos are in
+        position. In debug and connect modes, sleeps for the usual time of a
+        move instead, and if the robot cannot be queried, for the whole timeout.
+
+        Args:
+            timeout (float, optional): The maximum time to wait, in seconds.
+                                       Defaults to 3.0.
+
+        Returns:
+            bool: True if the motors settled before the timeout.
+        """
+        if self.debug or self.connect_mode:
+            time.sleep(min(MOVE_TIME, timeout))
+            return False
+
+        try:
+            url = "http://" + self.elmo_ip + ":8001/command"
+            kwargs = {
+                "op": "wait_until_settled",
+                "pan": self.current_pan,
+                "tilt": self.current_tilt,
+                "timeout": timeout,
+            }
+            res = requests.post(url, json=kwargs, timeout=timeout + 1).json()
+            return res["success"]
+        except Exception as e:
+            self.logger.log_error(f"Cannot wait until settled: {e}")
+            time.sleep(timeout)
+            return False
 
     def increase_volume(self):
         """
@@ -376,16 +540,105 @@ class ElmoServer:
         """
         self.send_message(f"speakers::{volume}")
 
-    def grab_image(self):
+    def grab_frame(self, after=None, timeout=2.0):
+        """
+        Returns a frame from the robot camera stream, without decoding it.
+
+        Frames come from the stream kept open by the stream reader, so this
+        does not wait for the network unless a newer frame is requested.
+
+        Args:
+            after (float, optional): Return the first frame received after
+                                     this time, as returned by time.time().
+                                     Defaults to the latest frame.
+            timeout (float, optional): The maximum time to wait for a frame,
+                                       in seconds. 0 never blocks. Defaults to 2.0.
+
+        Returns:
+            Frame: The JPEG frame, or None if no frame is available.
+        """
+        if self.stream_reader is None:
+            return None
+
+        if after is None:
+            return self.stream_reader.get_latest_frame(timeout)
+        return self.stream_reader.get_next_frame(after, timeout)
+
+    def grab_burst(self, count, after=None, timeout=1.0):
+        """
+        Returns consecutive frames from the robot camera stream, without
+        decoding them.
+
+        Args:
+            count (int): The number of frames.
+            after (float, optional): Only return frames received after this
+                                     time, as returned by time.time(). May
+                                     be slightly in the past. Defaults to now.
+            timeout (float, optional): The maximum time to wait for the
+                                       frames, in seconds. Defaults to 1.0.
+
+        Returns:
+            list: Up to count frames, oldest first.
+        """
+        if self.stream_reader is None:
+            return []
+
+        if after is None:
+            after = time.time()
+        return self.stream_reader.get_frames(count, after, timeout)
+
+    def grab_snapshot(self, still=False):
+        """
+        Requests a single full resolution frame from the camera server,
+        without opening the stream.
+
+        Args:
+            still (bool, optional): Capture a new frame encoded at high
+                                    quality, instead of returning the
+                                    latest streamed one. Defaults to False.
+
+        Returns:
+            Frame: The JPEG frame, or None if no frame is available.
+        """
+        if self.debug or self.connect_mode:
+            return None
+
+        url = f"http://{self.elmo_ip}:8080/snapshot.jpg"
+        if still:
+            url += "?mode=still"
+        try:
+            response = requests.get(url, timeout=2)
+            if response.status_code == 200:
+                return Frame(response.content, time.time())
+            self.logger.log_error(f"Snapshot failed with status {response.status_code}")
+        except Exception as e:
+            self.logger.log_error(f"Snapshot failed: {e}")
+        return None
+
+    def grab_image(self, after=None, size=(640, 480), grayscale=False):
         """
         Captures an image.
 
+        Stream frames are decoded at a reduced resolution when the requested
+        size allows it, which is much cheaper than a full decode and resize.
+
+        Args:
+            after (float, optional): Return the first frame received after
+                                     this time, as returned by time.time().
+                                     Defaults to the latest frame.
+            size (tuple, optional): The (width, height) of the image.
+                                    Defaults to (640, 480).
+            grayscale (bool, optional): Return a single channel image.
+                                        Defaults to False.
+
         Returns:
             np.ndarray: The captured image.
         """
         if self.debug:
             return
 
+        channels = () if grayscale else (3,)
+
         if self.connect_mode:
             cap = cv2.VideoCapture(0)
 
@@ -397,31 +650,21 @@ class ElmoServer:
             if not ret:
                 self.logger.log_error("Failed to capture frame")
                 cap.release()
-                return np.full((480, 640, 3), 26, dtype=np.uint8)
+                return np.full((size[1], size[0]) + channels, 26, dtype=np.uint8)
 
             cap.release()
 
-        else:
-            url = f"http://{self.elmo_ip}:8080/stream.mjpg"
-            response = requests.get(url, stream=True)
-
-            if response.status_code == 200:  # Is a valid response
-                stream = response.iter_content(chunk_size=1024)
-                bytes_ = b""
-                for chunk in stream:
-                    bytes_ += chunk
-                    a = bytes_.find(b"\xff\xd8")
-                    b = bytes_.find(b"\xff\xd9")
-                    if a != -1 and b != -1:
-                        jpg = bytes_[a : b + 2]
-                        bytes_ = bytes_[b + 2 :]
-                        frame = cv2.imdecode(
-                            np.fromstring(jpg, dtype=np.uint8), cv2.IMREAD_COLOR
-                        )
-                        break
-
-        # Resize the image to 480x640
-        frame = cv2.resize(frame, (640, 480))
+            if grayscale:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            return cv2.resize(frame, size)
+
+        stream_frame = self.grab_frame(after)
+        frame = stream_frame.decode(size, grayscale) if stream_frame else None
+
+        if frame is None:
+            self.logger.log_error("Failed to grab frame from stream")
+            return np.full((size[1], size[0]) + channels, 26, dtype=np.uint8)
+
         return frame
 
     def set_image(self, image_name):
@@ -442,25 +685,103 @@ class ElmoServer:
         """
         self.send_message(f"icon::{icon_name}")
 
-    def play_sound(self, sound):
+    def get_sound_duration(self, sound):
+        """
+        Returns the duration of a game sound, as reported by the robot.
+
+        Durations are cached. When the robot cannot be queried, the local
+        copy of the sound is read instead.
+
+        Args:
+            sound (str): The source name of the sound.
+
+        Returns:
+            float: The duration in seconds, or None if unknown.
+        """
+        if sound in self.sound_durations:
+            return self.sound_durations[sound]
+
+        duration = None
+        if not self.debug and not self.connect_mode:
+            try:
+                url = "http://" + self.elmo_ip + ":8001/command"
+                kwargs = {"op": "get_sound_duration", "name": f"emoshow/{sound}"}
+                res = requests.post(url, json=kwargs, timeout=1).json()
+                if res["success"]:
+                    duration = res["duration"]
+            except Exception as e:
+                self.logger.log_error(f"Cannot get sound duration: {e}")
+        if duration is None:
+            duration = sound_duration(sound)
+        if duration is not None:
+            self.sound_durations[sound] = duration
+        return duration
+
+    def play_sound(self, sound, wait=False):
         """
         Plays the specified sound.
 
         Args:
             sound (str): The source name of the sound to be played.
+            wait (bool, optional): Wait until the sound ends.
+                                   Defaults to False.
         """
         self.send_message(f"sound::{sound}")
+        if wait:
+            self.wait_sound(sound)
+
+    def wait_sound(self, sound, timeout=None):
+        """
+        Waits until a sound that was just played ends.
+
+        The robot reports when the sound finished playing. If the robot
+        cannot be queried, sleeps for the duration of the sound instead.
+
+        Args:
+            sound (str): The source name of the sound.
+            timeout (float, optional): The maximum time to wait, in seconds.
+                                       Defaults to the sound duration plus
+                                       2 seconds.
+
+        Returns:
+            bool: True if the sound finished before the timeout.
+        """
+        duration = self.get_sound_duration(sound) or 0.0
+        if timeout is None:
+            timeout = duration + 2.0
+
+        if self.debug or self.connect_mode:
+            time.sleep(min(duration, timeout))
+            return False
+
+        try:
+            url = "http://" + self.elmo_ip + ":8001/command"
+            kwargs = {"op": "wait_sound", "name": f"emoshow/{sound}", "timeout": timeout}
+            res = requests.post(url, json=kwargs, timeout=timeout + 1).json()
+            if not res["success"]:
+                self.logger.log_error(f"Cannot wait for {sound}: {res['message']}")
+            return res["success"]
+        except Exception as e:
+            self.logger.log_error(f"Cannot wait for {sound}: {e}")
+            time.sleep(min(duration, timeout))
+            return False
 
     def close_all(self):
         """
         Closes all connections and shuts down the server.
 
         Sends a "game::off" message to the robot.
-        If the debug flag is set to False, it also shuts down the Elmo socket.
+        If the debug flag is set to False, it also waits for the pending
+        commands and closes the command client.
+        Stops the stream reader, if running.
 
         """
+        if self.stream_reader is not None:
+            self.stream_reader.stop()
         if self.debug == False:
-            self.elmo_socket.shutdown(socket.SHUT_RDWR)
-            self.elmo_socket.close()
+            self.flush_messages()
+            self.command_client.flush()
+            self.logger.log_event("link_stats", **self.command_client.get_stats())
+            self.command_client.close()
             return
         return
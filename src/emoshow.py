@@ -1,8 +1,11 @@
+import os
 import random
 import time
-import cv2
 
-from rmn import RMN
+from emotion_service import EmotionService
+from face_detection import FaceTracker, create_detector, pixel_boxes
+from frame_writer import FrameWriter
+from timeline import Timeline, TimelinePlayer, after
 
 # List of emotions to analyse
 EMOTIONS = ["angry", "disgust", "fear", "happy", "sad", "surprise", "neutral"]
@@ -32,13 +35,92 @@ TRANSITIONS = [
     "lets_go",
 ]
 
-# Load the Haar Cascade model
-face_classifier = cv2.CascadeClassifier(
-    cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
-)
-
-# Create the facial expression recognition
-m = RMN()
+# Maximum time to wait for the head to reach a player
+SETTLE_TIMEOUT = 3.0
+
+# Size of the pictures used for emotion analysis: the preview stream size, so burst
+# frames and the fallback still are scored at the same resolution
+PICTURE_SIZE = (640, 360)
+
+# Maximum time to wait for the emotion analysis results
+INFERENCE_TIMEOUT = 10.0
+
+# Burst capture: frames start this many seconds before the camera icon
+BURST_LEAD = 0.1
+
+# Face detector used for centring and pictures ("haar", "pyramid" or "yunet")
+FACE_DETECTOR = "pyramid"
+
+# Pause between consecutive speech clips
+SPEECH_GAP = 0.5
+
+# Time given to the player to make the expression, after hearing the emotion
+EXPRESSION_TIME = 1.5
+
+# Choreography timelines, as (offset, command, value) cues, see timeline.py.
+# A timeline ends when the robot has to wait for the head to settle.
+INTRO_WELCOME = Timeline([
+    (0.0, "move", "left"),
+    (0.0, "sound", "introduction_1.wav"),
+    (after("introduction_1.wav", SPEECH_GAP), "move", "right"),
+    (after("introduction_1.wav", SPEECH_GAP), "sound", "introduction_2.wav"),
+    (after("introduction_2.wav", SPEECH_GAP), "move", "left"),
+])
+INTRO_RULES = Timeline([
+    (0.0, "sound", "introduction_3.wav"),
+    (2.8, "icon", "3.png"),
+    (3.8, "icon", "2.png"),
+    (4.5, "move", "right"),
+    (4.5, "icon", "1.png"),
+    (5.2, "icon", "camera.png"),
+    (6.2, "icon", "loading_4.gif"),
+    (12.2, "icon", "black.png"),
+    (12.2, "move", "left"),
+])
+INTRO_PLAYER_1 = Timeline([
+    (0.0, "sound", "introduction_4.wav"),
+    (after("introduction_4.wav", minimum=5.0), "move", "right"),
+])
+INTRO_PLAYER_2 = Timeline([
+    (0.0, "sound", "introduction_5.wav"),
+    (after("introduction_5.wav", SPEECH_GAP), "wait", None),
+])
+CONCLUSION = Timeline([
+    (0.0, "move", "center"),
+    (4.0, "icon", "heart.png"),
+    (4.0, "sound", "conclusion.wav"),
+    (4.0, "move", "left"),
+    (9.5, "move", "right"),
+    (14.5, "move", "left"),
+    (20.5, "move", "right"),
+    (after("conclusion.wav", SPEECH_GAP, minimum=26.5), "move", "left"),
+])
+JOKE_1 = Timeline([
+    (0.0, "sound", "joke_1.wav"),
+    (after("joke_1.wav", minimum=4.0), "move", "right"),
+])
+JOKE_2 = Timeline([
+    (0.0, "sound", "joke_2.wav"),
+    (0.0, "image", "cookie-robot.png"),
+    (after("joke_2.wav", minimum=4.0), "move", "left"),
+    (after("joke_2.wav", minimum=4.0), "image", "normal.png"),
+])
+JOKE_3 = Timeline([
+    (0.0, "sound", "joke_3.wav"),
+    (4.0, "move", "right"),
+    (9.0, "move", "left"),
+    (9.0, "image", "coffee.png"),
+    (after("joke_3.wav", minimum=14.0), "move", "center"),
+    (after("joke_3.wav", 2.0, minimum=16.0), "icon", "black.png"),  # Default icon
+    (after("joke_3.wav", 2.0, minimum=16.0), "image", "normal.png"),  # Default image
+])
+COUNTDOWN = Timeline([
+    (0.0, "sound", "picture.wav"),
+    (0.1, "icon", "3.png"),
+    (1.1, "icon", "2.png"),
+    (1.6, "icon", "1.png"),
+    (2.3, "icon", "camera.png"),
+])
 
 
 class EmoShow:
@@ -58,10 +140,18 @@ class EmoShow:
         remaining_transitions (list): The remaining transitions between moves.
         game_thread (object): The game thread.
         restart_flag (bool): Flag indicating if the game should be restarted.
+        emotion_service (object): The emotion recognition worker.
+        face_tracker (object): The face detections shared by centring and emotion analysis.
+        frame_writer (object): Saves the pictures in the background, one directory per game.
+        timeline_player (object): Plays the choreography timelines.
+        burst_size (int): The number of frames per picture (1: single still).
+        burst_budget (float): The maximum time to wait for a burst, in seconds.
+        burst_aggregate (string): How frame scores are combined ("max" or "mean").
 
     Methods:
         set_status(status): Sets the status of the game.
         set_feedback(feedback): Sets the feedback mode.
+        set_burst(size, budget, aggregate): Sets the burst capture mode.
         get_move(): Returns the current move.
         get_status(): Returns the status of the game.
         get_emotion(): Returns the current emotion.
@@ -74,7 +164,8 @@ class EmoShow:
         dynamic_conclusion(): Plays the dynamics for the conclusion of the game.
         center_player(): Centers the player in the frame.
         change_player(): Changes the current player.
-        play_transition(): Plays a transition sound while changing player.
+        play_transition(wait): Plays a transition sound while changing player.
+        play_timeline(timeline): Plays a choreography timeline.
         take_picture(): Takes a picture sequence.
         analyse_emotion(): Analyzes the emotion of the current move.
         give_feedback(accuracy): Gives feedback based on the accuracy of the emotion analysis.
@@ -83,6 +174,7 @@ class EmoShow:
         play_game(): Starts the game.
         stop_game(): Stops the game.
         restart_game(): Restarts the game.
+        close(): Stops the game and its workers.
     """
 
     def __init__(self, elmo, logger):
@@ -101,6 +193,14 @@ class EmoShow:
         self.remaining_transitions = TRANSITIONS.copy()  # Transitions between moves
         self.restart_flag = False  # Flag to restart the game
         self.game_thread = None  # Game thread
+        self.emotion_service = EmotionService()  # Emotion recognition worker
+        self.emotion_service.start()  # Load the model in the background
+        self.face_tracker = FaceTracker(create_detector(FACE_DETECTOR))  # Faces found while centring, reused for the pictures
+        self.frame_writer = FrameWriter()  # Saves pictures to analyze later
+        self.timeline_player = TimelinePlayer(elmo)  # Plays choreographies
+        self.burst_size = 5  # Frames per picture
+        self.burst_budget = 0.5  # Maximum time to wait for a burst
+        self.burst_aggregate = "max"  # How frame scores are combined
 
     def set_status(self, status):
         """
@@ -120,6 +220,21 @@ class EmoShow:
         """
         self.feedback = feedback
 
+    def set_burst(self, size, budget=0.5, aggregate="max"):
+        """
+        Sets the burst capture mode.
+
+        Args:
+            size (int): The number of frames per picture (1: single still).
+            budget (float, optional): The maximum time to wait for the
+                                      frames, in seconds. Defaults to 0.5.
+            aggregate (string, optional): How frame scores are combined,
+                                          "max" or "mean". Defaults to "max".
+        """
+        self.burst_size = size
+        self.burst_budget = budget
+        self.burst_aggregate = aggregate
+
     def get_move(self):
         """
         Returns the current move.
@@ -244,107 +359,62 @@ class EmoShow:
         """
         Plays the dynamics for the intro of the game.
         """
-        self.elmo.move_left()
-        self.elmo.play_sound("introduction_1.wav")
-        time.sleep(6.12)
-        self.elmo.move_right()
-        self.elmo.play_sound("introduction_2.wav")
-        time.sleep(7)
+        self.play_timeline(INTRO_WELCOME)
+        self.elmo.wait_until_settled(SETTLE_TIMEOUT)
 
         # Show icons
-        self.elmo.move_left()
-        time.sleep(2)
-        self.elmo.play_sound("introduction_3.wav")
-        time.sleep(2.8)
-        self.elmo.set_icon("3.png")
-        time.sleep(1)
-        self.elmo.set_icon("2.png")
-        time.sleep(0.7)
-        self.elmo.move_right()
-        self.elmo.set_icon("1.png")
-        time.sleep(0.7)
-        self.elmo.set_icon("camera.png")
-        time.sleep(1)
-        self.elmo.set_icon("loading_4.gif")
-        time.sleep(6)
-        self.elmo.set_icon("black.png")
-
-        self.elmo.move_left()
-        time.sleep(2)
-        self.elmo.play_sound("introduction_4.wav")
-        time.sleep(5)
+        self.play_timeline(INTRO_RULES)
+        self.elmo.wait_until_settled(SETTLE_TIMEOUT)
 
-        self.elmo.move_right()
-        time.sleep(2)
-        self.elmo.play_sound("introduction_5.wav")
-        time.sleep(6)
+        self.play_timeline(INTRO_PLAYER_1)
+        self.elmo.wait_until_settled(SETTLE_TIMEOUT)
+        self.play_timeline(INTRO_PLAYER_2)
 
     def dynamic_conclusion(self):
         """
         Plays the dynamics for the conclusion of the game.
         """
-        self.elmo.move_pan(0)
-        time.sleep(4)
-
-        self.elmo.set_icon("heart.png")
-        self.elmo.play_sound("conclusion.wav")
-        self.elmo.move_left()
-        time.sleep(5.5)
-        self.elmo.move_right()
-        time.sleep(5)
-        self.elmo.move_left()
-        time.sleep(6)
-        self.elmo.move_right()
-        time.sleep(6)
+        self.play_timeline(CONCLUSION)
 
         # Joke Time
-        self.elmo.move_left()
-        time.sleep(2)
-        self.elmo.play_sound("joke_1.wav")
-        time.sleep(4)
+        self.elmo.wait_until_settled(SETTLE_TIMEOUT)
+        self.play_timeline(JOKE_1)
+        self.elmo.wait_until_settled(SETTLE_TIMEOUT)
+        self.play_timeline(JOKE_2)
+        self.elmo.wait_until_settled(SETTLE_TIMEOUT)
+        self.play_timeline(JOKE_3)
 
-        self.elmo.move_right()
-        time.sleep(2)
-        self.elmo.play_sound("joke_2.wav")
-        self.elmo.set_image("cookie-robot.png")
-        time.sleep(4)
+    def play_timeline(self, timeline):
+        """
+        Plays a choreography timeline, stopping early if the game is restarted.
 
-        self.elmo.move_left()
-        self.elmo.set_image("normal.png")
-        time.sleep(2)
-        self.elmo.play_sound("joke_3.wav")
-        time.sleep(4)
-        self.elmo.move_right()
-        time.sleep(5)
-        self.elmo.move_left()
-        self.elmo.set_image("coffee.png")
-        time.sleep(5)
-        self.elmo.move_pan(0)
-        time.sleep(2)
-        self.elmo.set_icon("black.png")  # Default icon
-        self.elmo.set_image("normal.png")  # Default image
+        Args:
+            timeline (Timeline): The timeline to be played.
+
+        Returns:
+            bool: True if the timeline played until its end.
+        """
+        return self.timeline_player.play(timeline, stop=lambda: self.restart_flag)
 
     def center_player(self):
         """
         Centers the player's face in the frame by adjusting the robot's pan and
         tilt angles. If no faces detected, returns and continues the game.
         """
-        frame = self.elmo.grab_image()
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = face_classifier.detectMultiScale(gray, 1.1, 5, minSize=(100, 100))
+        gray = self.elmo.grab_image(grayscale=True)
+        faces = pixel_boxes(self.face_tracker.detect(gray), gray)
 
         if len(faces) == 0:
             self.logger.log_error("Cannot center player. No faces detected.")
             return
 
         # Get frame center and dimensions
-        frame_width, frame_height = frame.shape[1], frame.shape[0]
+        frame_width, frame_height = gray.shape[1], gray.shape[0]
         frame_center_x = frame_width / 2
         frame_center_y = frame_height / 2
 
         # Extract face bounding box
         x, y, w, h = faces[0]
-        cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
 
         # Compute offsets
         face_center_x = x + w / 2
@@ -377,8 +447,10 @@ class EmoShow:
             self.elmo.set_default_tilt_right(new_tilt_angle)
 
         self.elmo.move_pan(new_pan_angle)
-        time.sleep(2)
         self.elmo.move_tilt(new_tilt_angle)
+        # The face is now expected at the frame center
+        self.face_tracker.shift(-horizontal_offset / frame_width, vertical_offset / frame_height)
+        self.elmo.wait_until_settled(SETTLE_TIMEOUT)
 
         # Save changes
         self.logger.log_message(f"Face center: ({face_center_x}, {face_center_y})")
@@ -404,38 +476,48 @@ class EmoShow:
         else:
             self.elmo.move_right()
 
-        time.sleep(2.5)
+        self.elmo.wait_until_settled(SETTLE_TIMEOUT)
         self.center_player()
 
-    def play_transition(self):
+    def play_transition(self, wait=False):
         """
         Plays a transition sound while changing player
+
+        Args:
+            wait (bool, optional): Wait until the sound ends. Defaults to False.
         """
         transition = random.choice(self.remaining_transitions)
         self.remaining_transitions.remove(transition)
-        self.elmo.play_sound(f"transitions/{transition}.wav")
+        self.elmo.play_sound(f"transitions/{transition}.wav", wait=wait)
 
     def take_picture(self):
         """
         Plays a sound, displays a countdown sequence of icons (3, 2, 1), and
-        captures an image.
+        captures a burst of frames around the camera icon, or a single still.
 
         Returns:
-            np.ndarray: The captured picture.
+            list: The captured pictures. The still is None if it could not
+                  be captured (e.g. in debug mode).
         """
-        self.elmo.play_sound("picture.wav")
-        time.sleep(0.1)
-
         # show 3, 2, 1 and take a picture
-        self.elmo.set_icon("3.png")
-        time.sleep(1)
-        self.elmo.set_icon("2.png")
-        time.sleep(0.5)
-        self.elmo.set_icon("1.png")
-        time.sleep(0.7)
-        self.elmo.set_icon("camera.png")
+        self.play_timeline(COUNTDOWN)
 
-        return self.elmo.grab_image()
+        if self.burst_size > 1:
+            # Consecutive frames from the open stream, so a blink costs one frame
+            frames = self.elmo.grab_burst(
+                self.burst_size, after=time.time() - BURST_LEAD, timeout=self.burst_budget
+            )
+            pictures = [frame.decode(PICTURE_SIZE) for frame in frames]
+            pictures = [picture for picture in pictures if picture is not None]
+            if len(pictures) > 0:
+                return pictures
+
+        # High quality still, falling back to the preview stream
+        snapshot = self.elmo.grab_snapshot(still=True)
+        picture = snapshot.decode(PICTURE_SIZE) if snapshot else None
+        if picture is None:
+            picture = self.elmo.grab_image(size=PICTURE_SIZE)
+        return [picture]
 
     def analyse_emotion(self):
         """
@@ -444,13 +526,30 @@ class EmoShow:
         Returns:
             int: The accuracy of the emotion analysis.
         """
-        frame = self.take_picture()
+        pictures = [picture for picture in self.take_picture() if picture is not None]
+        if len(pictures) == 0:
+            self.logger.log_error("No picture captured")
+            self.elmo.set_icon("black.png")
+            self.results = None
+            self.logger.log_error("Accuracy: 0%")
+            return 0
+
+        # Follow the face found while centring, so RMN only classifies the crops
+        faces = [pixel_boxes(self.face_tracker.track(picture), picture) for picture in pictures]
 
-        # Save frames to analyze later
+        # Score all pictures in one batch while the loading animation plays
         try:
-            cv2.imwrite(f"frames/frame_{self.move}.png", frame)
+            inference = self.emotion_service.submit(pictures, faces)
         except Exception as e:
-            print(e)
+            # e.g. the worker failed to load the model, scored as no results below
+            self.logger.log_error(e)
+            inference = None
+
+        # Save frames to analyze later, written in the background
+        for i, (picture, boxes) in enumerate(zip(pictures, faces)):
+            self.frame_writer.save(
+                picture, move=self.move, player=self.player, emotion=self.emotion, index=i, faces=boxes
+            )
 
         time.sleep(1.5)
         self.elmo.set_icon("loading_4.gif")  # Set loading icon
@@ -459,8 +558,28 @@ class EmoShow:
 
         # Emotion Expression Analysis
         try:
-            results = m.detect_emotion_for_single_frame(frame)
-            self.logger.log_message(results)
+            # Probability of the target emotion in each picture with a face
+            scores = []
+            batch = inference.result(timeout=INFERENCE_TIMEOUT) if inference is not None else []
+            for results in batch:
+                if len(results) > 0:
+                    proba_list = results[0]["proba_list"]
+                    score = proba_list[emotions_dict[self.emotion]][self.emotion]
+                    scores.append((score, results))
+            self.logger.log_message(f"Faces detected in {len(scores)}/{len(pictures)} pictures")
+            if len(scores) == 0:
+                self.logger.log_message("Accuracy: 0%")
+                self.results = None
+                return 0
+
+            # Report the best picture, aggregate the scores of all of them
+            best_score, results = max(scores, key=lambda s: s[0])
+            if self.burst_aggregate == "mean":
+                score = sum(s[0] for s in scores) / len(scores)
+            else:
+                score = best_score
+
+            self.logger.log_event("emotions", target=self.emotion, results=results)
             proba_list = results[0]["proba_list"]
             self.results = (
                 f'Angry: {round(proba_list[0]["angry"] * 100)}  '
@@ -471,11 +590,8 @@ class EmoShow:
                 f'Surprise: {round(proba_list[5]["surprise"] * 100)}  '
                 f'Neutral: {round(proba_list[6]["neutral"] * 100)}'
             )
-            self.logger.log_message(results[0])
-            accuracy = round(
-                proba_list[emotions_dict[self.emotion]][self.emotion] * 100
-            )
-            self.logger.log_message(f"{self.emotion}: {accuracy}%")
+            accuracy = round(score * 100)
+            self.logger.log_event("accuracy", emotion=self.emotion, accuracy=accuracy, player=self.player)
 
         except Exception as e:
             self.logger.log_error(e)
@@ -499,17 +615,18 @@ class EmoShow:
         else: # Cheerful success chime
             feedback = ("star.png", "good_feedback.wav", 5)
 
-        self.elmo.set_image(f"{feedback[0]}")
-        self.elmo.play_sound(f"{feedback[1]}")
-        time.sleep(feedback[2])
-        self.elmo.set_image("normal.png")  # Set default image
+        # Keep the image for its minimum time, and never cut the speech
+        self.play_timeline(Timeline([
+            (0.0, "image", feedback[0]),
+            (0.0, "sound", feedback[1]),
+            (after(feedback[1], minimum=feedback[2]), "image", "normal.png"),  # Set default image
+        ]))
 
     def congrats_winner(self):
         # Find winner
         winner = int(max(self.points, key=self.points.get))
 
-        self.logger.log_message(self.points)
-        self.logger.log_message(f"winner::{winner}")
+        self.logger.log_event("winner", winner=winner, points=dict(self.points))
 
         if self.excluded_player == -1:
             if winner == 1:
@@ -523,9 +640,8 @@ class EmoShow:
                 self.elmo.move_left()
 
         self.elmo.set_image("normal.png")
-        time.sleep(2)
-        self.elmo.play_sound("winner.wav")  # Congrats winner
-        time.sleep(6.3)
+        self.elmo.wait_until_settled(SETTLE_TIMEOUT)
+        self.elmo.play_sound("winner.wav", wait=True)  # Congrats winner
 
     def player_move(self):
         """
@@ -539,28 +655,26 @@ class EmoShow:
             self.change_player()
 
             if self.move == 0:
-                self.elmo.play_sound("first_emotion.wav")
+                self.elmo.play_sound("first_emotion.wav", wait=True)
             else:
-                self.play_transition()
+                self.play_transition(wait=True)
 
-            time.sleep(5)
+            time.sleep(SPEECH_GAP)
 
             player_move = self.get_player_move()
             self.emotion = self.shuffled_emotions[str(self.player)][player_move]
 
             # Say emotion
-            self.logger.log_message(f"Emotion: {self.emotion}")
-            self.elmo.play_sound(f"emotions/{self.emotion}.wav")
+            self.logger.log_event("emotion", player=self.player, move=self.move, emotion=self.emotion)
             self.elmo.set_image(f"emotions/{self.emotion}.png")
+            self.elmo.play_sound(f"emotions/{self.emotion}.wav", wait=True)
 
-            time.sleep(3)
+            time.sleep(EXPRESSION_TIME)
 
             # Take a picture and analyse emotion
             accuracy = self.analyse_emotion()
             self.points[str(self.player)] += accuracy
-            self.logger.log_message(
-                f"Player: {str(self.player)}, points: {self.points[str(self.player)]}"
-            )
+            self.logger.log_event("points", player=self.player, points=self.points[str(self.player)])
 
             # Give feedback to the player
             if self.feedback or (
@@ -599,11 +713,19 @@ class EmoShow:
 
         self.shuffle_emotions()
 
+        session = self.frame_writer.start_session()
+        self.logger.start_session(os.path.basename(session))
+        self.logger.log_message(f"Saving frames to {session}")
+
         time.sleep(0.5)
 
-        while self.status == 1 and not self.restart_flag:
-            self.logger.log_message("New emotion...")
-            self.player_move()
+        try:
+            while self.status == 1 and not self.restart_flag:
+                self.logger.log_message("New emotion...")
+                self.player_move()
+        finally:
+            # Save the queued pictures of this game, the writer restarts with the next one
+            self.frame_writer.close()
 
         if self.status == 2:
             self.elmo.set_image("end_game.png")
@@ -627,6 +749,16 @@ class EmoShow:
         """
         self.restart_flag = True
 
+    def close(self):
+        """
+        Stops the game and the emotion recognition worker, and saves the
+        queued pictures. Call it when the game is no longer needed, e.g.
+        when its window closes.
+        """
+        self.stop_game()
+        self.emotion_service.shutdown()
+        self.frame_writer.close()
+
     def restart_game(self):
         """
         Restarts the game.
@@ -1,21 +1,34 @@
 #! /usr/bin/env python
-import os
-import socket
-import sys
 
-import middleware as mw
 
-s = None  # Socket
-pan = mw.Pan()
-tilt = mw.Tilt()
-onboard = mw.Onboard()
-speakers = mw.Speakers()
-leds = mw.Leds()
-server = mw.Server()
+"""
+
+Emo-Show handler.
+
+Receives the commands of the game controllers and applies them on the robot.
 
-image_path = "images/emoshow/"
-sound_path = "emoshow/"
-icon_path = "emoshow/"
+Transports:
+    udp        framed (see emoshow_protocol.py) or "command::value" text datagrams
+    tcp        "command::value" text lines
+    websocket  "command::value" text messages, on the next port (needs websockets)
+
+Several controllers can be connected at the same time, on any transport.
+Slow commands (icon downloads, sound requests) run in a worker of their own, so pan and
+tilt are never delayed behind them. Each slow command has a single worker, so commands
+of the same kind run in order. A queued icon is skipped when a newer one replaces it;
+every sound is played.
+
+"""
+
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from command_registry import pan, registry, tilt
+from emoshow_protocol import STATE_OPS, CommandReceiver
+
+TRANSPORTS = ("udp", "tcp", "websocket")
+WEBSOCKET_PORT_OFFSET = 1
 
 
 def enable_torque():
@@ -28,97 +41,227 @@ def enable_torque():
 
 def parse_message(message):
     """
-    Parses the given message and performs the corresponding actions based on the
-    command and value.
+    Splits a text message in the format "command::value".
 
     Args:
-        message (str): The message to be parsed in the format "command::value".
+        message (str): The message to be parsed.
+
+    Returns:
+        tuple: The command and value, or None if the message is invalid.
     """
     splitMessage = message.split("::")
 
     if len(splitMessage) != 2:
         print("Invalid message")
-        return
+        return None
 
-    command = splitMessage[0]
-    value = splitMessage[1]
+    return splitMessage[0], splitMessage[1]
 
-    if command == "pan":
-        pan.angle = int(value)
 
-    elif command == "tilt":
-        tilt.angle = int(value)
+class UDPTransport(asyncio.DatagramProtocol):
+    """
+    Receives framed and text datagrams, and acknowledges the framed ones.
+    """
 
-    elif command == "image":
-        if "emoshow" in value:
-            image_src = value
-        else:
-            image_src = os.path.join(image_path, f"{value}")
-        onboard.image = image_src
+    def __init__(self, handler):
+        self.handler = handler
+        self.receiver = None
+
+    def connection_made(self, transport):
+        self.receiver = CommandReceiver(transport)
+
+    def datagram_received(self, data, addr):
+        # Framed or text datagram, possibly batching several commands
+        for command, value in self.receiver.receive(data, addr):
+            self.handler.dispatch(command, value)
 
-    elif command == "speakers":
-        if value == "increaseVolume":
-            speakers.volume += 10
-        elif value == "decreaseVolume":
-            speakers.volume -= 10
 
-    elif command == "sound":
-        sound_src = os.path.join(sound_path, f"{value}")
-        sound_url = server.url_for_sound(sound_src)
-        speakers.url = sound_url
+class EmoShowHandler:
+    """
+    Applies the commands of the game controllers.
 
-    elif command == "icon":
-        icon_src = os.path.join(icon_path, f"{value}")
-        icon_url = server.url_for_icon(icon_src)
-        leds.load_from_url(icon_url)
+    Args:
+        debug (bool, optional): Receive the commands without applying them.
+                                Defaults to False.
 
-    elif command == "game":
-        if value == "off":
-            s.close()
-            exit()
+    Methods:
+        run(ip, port, transports): Serve the controllers until game::off
+        dispatch(command, value): Perform a command
+        stop(): Stop serving
+    """
+
+    def __init__(self, debug=False):
+        self.debug = debug
+        self.lanes = {name: ThreadPoolExecutor(max_workers=1) for name in registry.slow}
+        # Latest request of each slow state command (icon), older queued ones are skipped
+        self.generations = {name: 0 for name in registry.slow if name in STATE_OPS}
+        self.udp = None
+        self.loop = None
+        self.stopped = None
+        self.connections = {}  # Open TCP connections: task -> writer
+
+    def dispatch(self, command, value):
+        """
+        Performs a command, in its worker if it is slow, or right away.
+
+        Args:
+            command (str): The command.
+            value (str): The command value.
+        """
+        if command == "game":
+            if value == "off":
+                self.stop()
+            return
+        if self.debug or not registry.has(command):
+            return
+        if not registry.is_slow(command):
+            try:
+                registry.execute(command, value)
+            except Exception as e:
+                print(f"Error in {command}::{value}: {e}")
+            return
+        generation = None
+        if command in self.generations:
+            self.generations[command] += 1
+            generation = self.generations[command]
+        self.loop.run_in_executor(self.lanes[command], self.run_slow_command, command, value, generation)
+
+    def run_slow_command(self, command, value, generation=None):
+        """
+        Performs a slow command in its worker. A state command (generation
+        set) is skipped if a newer one of the same kind is already queued
+        and replaces it; the other commands always run, in order.
+        """
+        if generation is not None and self.generations[command] != generation:
+            return
+        try:
+            registry.execute(command, value)
+        except Exception as e:
+            print(f"Error in {command}::{value}: {e}")
+
+    def dispatch_text(self, text):
+        """
+        Performs the "command::value" messages of a text, one per line.
+        """
+        for message in text.splitlines():
+            parsed = parse_message(message)
+            if parsed is not None:
+                self.dispatch(*parsed)
+
+    async def handle_tcp(self, reader, writer):
+        """
+        Serves a TCP controller, until it disconnects.
+        """
+        self.connections[asyncio.current_task()] = writer
+        try:
+            while not reader.at_eof():
+                line = await reader.readline()
+                if line:
+                    self.dispatch_text(line.decode("utf-8"))
+        except ConnectionError:
+            pass
+        finally:
+            del self.connections[asyncio.current_task()]
+            writer.close()
+
+    async def handle_websocket(self, websocket, *args):
+        """
+        Serves a WebSocket controller, until it disconnects.
+        """
+        async for message in websocket:
+            if isinstance(message, bytes):
+                message = message.decode("utf-8")
+            self.dispatch_text(message)
+
+    async def run(self, ip, port, transports=("udp",)):
+        """
+        Serves the controllers until a game::off command is received.
+
+        Args:
+            ip (str): The address to listen on.
+            port (int): The port to listen on.
+            transports (tuple, optional): The transports to serve.
+                                          Defaults to UDP only.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        servers = []
+
+        if "udp" in transports:
+            transport, self.udp = await self.loop.create_datagram_endpoint(
+                lambda: UDPTransport(self), local_addr=(ip, port)
+            )
+            servers.append(transport)
+        if "tcp" in transports:
+            servers.append(await asyncio.start_server(self.handle_tcp, ip, port))
+        if "websocket" in transports:
+            import websockets
+
+            servers.append(await websockets.serve(self.handle_websocket, ip, port + WEBSOCKET_PORT_OFFSET))
+
+        print(f"Server Started ({', '.join(transports)})")
+
+        try:
+            await self.stopped.wait()
+        finally:
+            if self.udp is not None:
+                print(f"Link stats: {self.udp.receiver.get_stats()}")
+            for server in servers:
+                server.close()
+            # disconnect the TCP controllers, their readers end on EOF
+            for writer in self.connections.values():
+                writer.close()
+            await asyncio.gather(*self.connections, return_exceptions=True)
+            for lane in self.lanes.values():
+                lane.shutdown(wait=False)
+
+    def stop(self):
+        """
+        Stops serving, after the current command.
+        """
+        if self.stopped is not None:
+            self.stopped.set()
 
 
 def main():
     """
     Entry point of the Emo-Show handler program.
-    Parses command line arguments, establishes a connection, and handles
-    incoming messages.
+    Parses command line arguments and serves the controllers.
     """
-
-    global s
+    usage = "Usage: python emoshow_handler.py <elmoIp> <port> (--debug) (--transport udp,tcp,websocket)"
 
     # Parse arguments
-    if len(sys.argv) == 3 or len(sys.argv) == 4:
-        elmo_ip, elmo_port = sys.argv[1:3]
-        debug = False
-    else:
-        print("Usage: python emoshow_handler.py <elmoIp> <port> (--debug)")
+    if len(sys.argv) < 3:
+        print(usage)
         return
+    elmo_ip, elmo_port = sys.argv[1:3]
+    debug = False
+    transports = ("udp",)
 
-    # Check debug flag
-    if len(sys.argv) == 4:
-        if sys.argv[3] == "--debug":
+    args = sys.argv[3:]
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == "--debug":
             debug = True
+        elif arg == "--transport" and len(args) > 0:
+            transports = tuple(args.pop(0).split(","))
+            if not all(t in TRANSPORTS for t in transports):
+                print(usage)
+                return
         else:
-            print("Usage: python emoshow_handler.py <elmoIp> <port> (--debug)")
+            print(usage)
             return
 
     print("Starting connection...")
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.bind((elmo_ip, int(elmo_port)))
-
-    print("Server Started")
-
     if not debug:
         enable_torque()
 
-    while True:
-        data, addr = s.recvfrom(1024)
-        data = data.decode("utf-8")
-
-        if not debug:
-            parse_message(data)
+    handler = EmoShowHandler(debug)
+    try:
+        asyncio.run(handler.run(elmo_ip, int(elmo_port), transports))
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
@@ -1,10 +1,70 @@
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import time
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Formats log records as JSON Lines, one object per record:
+
+        {"t": monotonic time, "time": wall clock time, "level": ..., "event": ..., fields...}
+    """
+
+    def format(self, record):
+        entry = {
+            "t": getattr(record, "monotonic", record.created),
+            "time": record.created,
+            "level": record.levelname,
+            "event": getattr(record, "event", "message"),
+        }
+        entry.update(getattr(record, "fields", {"message": record.getMessage()}))
+        return json.dumps(entry, default=str)
+
+
+class SessionFileHandler(logging.FileHandler):
+    """
+    File handler that moves to a new file when it receives a session record,
+    so records queued before a new session are still written to the old one.
+    """
+
+    def emit(self, record):
+        path = getattr(record, "session_file", None)
+        if path is not None:
+            self.acquire()
+            try:
+                self.close()
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                self.baseFilename = os.path.abspath(path)
+                self.stream = None  # Opened by emit
+            finally:
+                self.release()
+        super().emit(record)
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves the formatting to the writer thread.
+
+    The default QueueHandler formats the message when it is queued, on the
+    calling thread.
+    """
+
+    def prepare(self, record):
+        return record
 
 
 class EmoShowLogger:
     """
     A class representing the logger class for the Emo-Show game.
 
+    Events are written as JSON Lines, with a monotonic timestamp and an event
+    type, by a background thread: logging only queues the event, so it adds
+    no latency to the game and the motion commands. Each session is written
+    to a file of its own.
+
     Attributes:
         log_file (str): The name of the log file.
         logger (object): The logger object.
@@ -12,19 +72,26 @@ class EmoShowLogger:
     Methods:
         set_window(window): Connects the interface with the logger.
         set_filename(filename): Sets the filename of the log file.
+        start_session(name): Starts a new log file for a game session.
+        log_event(event, **fields): Logs a structured event.
         log_message(message): Logs a debug message with the provided message.
         log_error(message): Logs an error message with the provided message.
-        close(): Closes the file handler and shuts down the logging system.
+        close(): Writes the queued events and shuts down the logging system.
     """
 
     def __init__(self, log_file="logs/emoshow.log"):
         self.log_file = log_file
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
-        self.formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-        self.handler = logging.FileHandler(self.log_file)
+        self.formatter = JsonLinesFormatter()
+        os.makedirs(os.path.dirname(os.path.abspath(self.log_file)), exist_ok=True)
+        self.handler = SessionFileHandler(self.log_file)
         self.handler.setFormatter(self.formatter)
-        self.logger.addHandler(self.handler)
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = RecordQueueHandler(self.queue)
+        self.logger.addHandler(self.queue_handler)
+        self.listener = logging.handlers.QueueListener(self.queue, self.handler)
+        self.listener.start()
 
     def set_window(self, window):
         """
@@ -43,10 +110,43 @@ class EmoShowLogger:
             filename (str): The name of the log file.
         """
         self.log_file = f"logs/{filename}"
-        self.handler.close()
-        self.handler = logging.FileHandler(self.log_file)
-        self.handler.setFormatter(self.formatter)
-        self.logger.addHandler(self.handler)
+        self.log_event("session", session_file=self.log_file)
+
+    def start_session(self, name=None):
+        """
+        Starts a new log file for a game session, next to the current one.
+
+        Args:
+            name (str, optional): The session name. Defaults to the current
+                                  date and time.
+
+        Returns:
+            str: The session log file.
+        """
+        if name is None:
+            name = time.strftime("%Y%m%d-%H%M%S")
+        base = os.path.splitext(os.path.basename(self.log_file))[0]
+        path = os.path.join(os.path.dirname(self.log_file), f"{base}-{name}.jsonl")
+        self.log_event("session", session_file=path, name=name)
+        return path
+
+    def log_event(self, event, level=logging.INFO, **fields):
+        """
+        Logs a structured event. The fields are encoded by the writer
+        thread, so they must not be modified after the call.
+
+        Args:
+            event (str): The event type (e.g. "command", "emotions").
+            level (int, optional): The logging level. Defaults to INFO.
+            **fields: The values of the event.
+        """
+        extra = {"event": event, "fields": fields, "monotonic": time.monotonic()}
+        if "session_file" in fields:
+            extra["session_file"] = fields["session_file"]
+        try:
+            self.logger.log(level, event, extra=extra)
+        except Exception as e:
+            print(f"Error logging {event}: {e}")
 
     def log_message(self, message):
         """
@@ -55,11 +155,7 @@ class EmoShowLogger:
         Args:
             message (str): The message to be logged.
         """
-        try:
-            self.logger.info(f"{message}")
-            # print(message)
-        except Exception as e:
-            self.logger.error(f"Error logging message: {e}")
+        self.log_event("message", message=message)
 
     def log_error(self, message):
         """
@@ -68,14 +164,13 @@ class EmoShowLogger:
         Args:
             message (str): The error message to be logged.
         """
-        try:
-            self.logger.error(f"{message}")
-        except Exception as e:
-            self.logger.error(f"Error logging error message: {e}")
+        self.log_event("error", level=logging.ERROR, message=message)
 
     def close(self):
         """
-        Closes the file handler and shuts down the logging system.
+        Writes the queued events and shuts down the logging system.
         """
+        self.listener.stop()
+        self.logger.removeHandler(self.queue_handler)
         self.handler.close()
         logging.shutdown()
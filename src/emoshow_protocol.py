@@ -0,0 +1,437 @@
+"""
+
+Command protocol between ElmoServer and emoshow_handler.
+
+Each datagram carries a header and one or more commands:
+
+    header:  magic (1 byte), flags (1 byte), session (2 bytes), sequence (4 bytes)
+    command: op code (1 byte), payload length (2 bytes), payload
+
+Pan and tilt angles are sent as signed 16 bit integers, other values as UTF-8 text.
+Datagrams flagged with ACK_REQUEST are acknowledged with an ACK datagram carrying the
+same session and sequence, and no commands. The sender retransmits them until they are
+acknowledged, so the receiver drops duplicates, and drops state commands (pan, tilt,
+image, icon) older than the last ones it applied.
+
+Datagrams that do not start with the magic byte are "command::value" text messages,
+one per line.
+
+"""
+
+import collections
+import random
+import socket
+import struct
+import threading
+import time
+
+
+MAGIC = 0xE5
+ACK_REQUEST = 0x01
+ACK = 0x02
+
+HEADER = struct.Struct("!BBHI")  # magic, flags, session, sequence
+COMMAND = struct.Struct("!BH")  # op code, payload length
+ANGLE = struct.Struct("!h")
+
+OPS = {
+    "pan": 1,
+    "tilt": 2,
+    "image": 3,
+    "icon": 4,
+    "sound": 5,
+    "speakers": 6,
+    "game": 7,
+    "feedback": 8,
+}
+OP_NAMES = {op: name for name, op in OPS.items()}
+ANGLE_OPS = ("pan", "tilt")
+STATE_OPS = ("pan", "tilt", "image", "icon")  # A newer value replaces the older one
+
+ACK_TIMEOUT = 0.2
+MAX_RETRIES = 3
+DUPLICATE_WINDOW = 256
+MAX_SESSIONS = 32  # Sender sessions tracked by a receiver, the least recently used is dropped
+
+
+def is_framed(data):
+    """
+    Returns whether a datagram uses the framed protocol, or is text.
+    """
+    return len(data) >= HEADER.size and data[0] == MAGIC
+
+
+def encode(session, sequence, messages, ack_request=True):
+    """
+    Encodes "command::value" messages into one datagram.
+
+    Args:
+        session (int): The sender session.
+        sequence (int): The datagram sequence number.
+        messages (list): The "command::value" messages, in order.
+        ack_request (bool, optional): Ask the receiver for an ACK.
+                                      Defaults to True.
+
+    Returns:
+        bytes: The datagram.
+
+    Raises:
+        ValueError: If a command has no op code.
+    """
+    flags = ACK_REQUEST if ack_request else 0
+    data = bytearray(HEADER.pack(MAGIC, flags, session, sequence))
+    for message in messages:
+        command, value = message.split("::", 1)
+        if command not in OPS:
+            raise ValueError(f"Unknown command {command}")
+        if command in ANGLE_OPS:
+            payload = ANGLE.pack(round(float(value)))
+        else:
+            payload = value.encode("utf-8")
+        data += COMMAND.pack(OPS[command], len(payload))
+        data += payload
+    return bytes(data)
+
+
+def coalesce(messages):
+    """
+    Drops the state commands that a later message of the same datagram
+    replaces, keeping the order of the others.
+
+    Args:
+        messages (list): The "command::value" messages, in order.
+
+    Returns:
+        list: The messages to send.
+    """
+    last = {}
+    for i, message in enumerate(messages):
+        command = message.split("::", 1)[0]
+        if command in STATE_OPS:
+            last[command] = i
+    return [
+        message
+        for i, message in enumerate(messages)
+        if last.get(message.split("::", 1)[0], i) == i
+    ]
+
+
+def encode_ack(session, sequence):
+    """
+    Encodes the ACK of a datagram.
+    """
+    return HEADER.pack(MAGIC, ACK, session, sequence)
+
+
+def decode(data):
+    """
+    Decodes a datagram.
+
+    Args:
+        data (bytes): The datagram.
+
+    Returns:
+        tuple: The flags, session, sequence and the list of (command, value)
+               pairs, with values as text.
+
+    Raises:
+        ValueError: If the datagram is malformed.
+    """
+    if not is_framed(data):
+        raise ValueError("Not a framed datagram")
+    _, flags, session, sequence = HEADER.unpack_from(data)
+    commands = []
+    i = HEADER.size
+    while i < len(data):
+        if i + COMMAND.size > len(data):
+            raise ValueError("Truncated command header")
+        op, length = COMMAND.unpack_from(data, i)
+        i += COMMAND.size
+        payload = data[i : i + length]
+        if len(payload) != length:
+            raise ValueError("Truncated command payload")
+        i += length
+        if op not in OP_NAMES:
+            raise ValueError(f"Unknown op code {op}")
+        command = OP_NAMES[op]
+        if command in ANGLE_OPS:
+            value = str(ANGLE.unpack(payload)[0])
+        else:
+            value = payload.decode("utf-8")
+        commands.append((command, value))
+    return flags, session, sequence, commands
+
+
+class CommandClient:
+    """
+    Sends commands to emoshow_handler and retransmits them until acknowledged.
+
+    A background thread receives the ACKs and retransmits the datagrams
+    that were not acknowledged in time, so sending never blocks.
+
+    Args:
+        address (tuple): The (ip, port) of the handler.
+        reliable (bool, optional): Ask for ACKs and retransmit.
+                                   Defaults to True.
+        ack_timeout (float, optional): The time to wait for an ACK before
+                                       retransmitting, in seconds.
+                                       Defaults to ACK_TIMEOUT.
+        max_retries (int, optional): The retransmissions before a datagram
+                                     is counted as lost. Defaults to MAX_RETRIES.
+        logger (Logger, optional): Logs lost datagrams. Defaults to None.
+        on_ack (callable, optional): Called with the sequence number and round
+                                     trip time of each acknowledged datagram,
+                                     from the background thread. Defaults to None.
+
+    Methods:
+        send(messages): Send messages in one datagram
+        flush(timeout): Wait until all datagrams are acknowledged or lost
+        get_stats(): Get the latency and loss counters
+        close(): Stop the client and close the socket
+    """
+
+    def __init__(self, address, reliable=True, ack_timeout=ACK_TIMEOUT, max_retries=MAX_RETRIES, logger=None, on_ack=None):
+        self.address = address
+        self.reliable = reliable
+        self.ack_timeout = ack_timeout
+        self.max_retries = max_retries
+        self.logger = logger
+        self.on_ack = on_ack
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(ack_timeout / 4)
+        self.session = random.randrange(1, 1 << 16)  # New receiver state on restart
+        self.sequence = 0
+        self.pending = {}  # Unacknowledged datagrams: sequence -> [data, first sent, last sent, retries]
+        self.lock = threading.Lock()
+        self.stats = {
+            "sent": 0,
+            "acked": 0,
+            "retransmitted": 0,
+            "lost": 0,
+            "rtt_last": 0.0,
+            "rtt_mean": 0.0,
+            "rtt_max": 0.0,
+        }
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, messages):
+        """
+        Sends "command::value" messages in one datagram.
+
+        Args:
+            messages (list): The messages, applied in order by the handler.
+
+        Returns:
+            int: The sequence number of the datagram.
+        """
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+            data = encode(self.session, sequence, messages, self.reliable)
+            now = time.time()
+            if self.reliable:
+                self.pending[sequence] = [data, now, now, 0]
+            self.stats["sent"] += 1
+        self.sock.sendto(data, self.address)
+        return sequence
+
+    def flush(self, timeout=1.0):
+        """
+        Waits until all datagrams are acknowledged or counted as lost.
+
+        Args:
+            timeout (float, optional): The maximum time to wait, in seconds.
+                                       Defaults to 1.0.
+
+        Returns:
+            bool: True if no datagram is pending.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if len(self.pending) == 0:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def get_stats(self):
+        """
+        Returns the latency and loss counters. Round trip times are in
+        seconds, from the first transmission to the ACK.
+
+        Returns:
+            dict: The counters.
+        """
+        with self.lock:
+            return dict(self.stats, pending=len(self.pending))
+
+    def close(self):
+        """
+        Stops the client and closes the socket.
+        """
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+    def run(self):
+        """
+        Receives ACKs and retransmits unacknowledged datagrams.
+        """
+        while self.running:
+            try:
+                data, _ = self.sock.recvfrom(64)
+                self.acknowledge(data)
+            except socket.timeout:
+                pass
+            except OSError:
+                if not self.running:
+                    return
+            self.retransmit()
+
+    def acknowledge(self, data):
+        """
+        Handles a received ACK.
+        """
+        try:
+            flags, session, sequence, _ = decode(data)
+        except ValueError:
+            return
+        if not flags & ACK or session != self.session:
+            return
+        with self.lock:
+            entry = self.pending.pop(sequence, None)
+            if entry is None:
+                return  # ACK of a retransmission, already counted
+            rtt = time.time() - entry[1]
+            self.stats["acked"] += 1
+            self.stats["rtt_last"] = rtt
+            self.stats["rtt_max"] = max(self.stats["rtt_max"], rtt)
+            self.stats["rtt_mean"] += (rtt - self.stats["rtt_mean"]) / self.stats["acked"]
+        if self.on_ack is not None:
+            self.on_ack(sequence, rtt)
+
+    def retransmit(self):
+        """
+        Resends the datagrams whose ACK timed out, and drops the lost ones.
+        """
+        now = time.time()
+        resend = []
+        lost = []
+        with self.lock:
+            for sequence, entry in list(self.pending.items()):
+                if now - entry[2] < self.ack_timeout:
+                    continue
+                if entry[3] >= self.max_retries:
+                    del self.pending[sequence]
+                    self.stats["lost"] += 1
+                    lost.append(sequence)
+                    continue
+                entry[2] = now
+                entry[3] += 1
+                self.stats["retransmitted"] += 1
+                resend.append(entry[0])
+        for data in resend:
+            try:
+                self.sock.sendto(data, self.address)
+            except OSError:
+                pass
+        if self.logger is not None:
+            for sequence in lost:
+                self.logger.log_error(f"Command datagram {sequence} lost after {self.max_retries} retries")
+
+
+class CommandReceiver:
+    """
+    Receiver side state: acknowledges datagrams and drops duplicates and
+    stale state commands.
+
+    Args:
+        sock (socket): The socket the datagrams are received on.
+
+    Methods:
+        receive(data, addr): Decode a datagram and return the commands to apply
+        get_stats(): Get the counters
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        # (address, session) -> sequences seen, highest one, last one of each state command
+        self.sessions = collections.OrderedDict()
+        self.stats = {
+            "received": 0,
+            "duplicates": 0,
+            "stale": 0,
+            "invalid": 0,
+            "text": 0,
+        }
+
+    def receive(self, data, addr):
+        """
+        Decodes a datagram, acknowledges it if asked, and returns the
+        commands that must be applied, in order.
+
+        Args:
+            data (bytes): The datagram.
+            addr (tuple): The sender address.
+
+        Returns:
+            list: The (command, value) pairs.
+        """
+        if not is_framed(data):
+            self.stats["text"] += 1
+            commands = []
+            for message in data.decode("utf-8").splitlines():
+                parts = message.split("::")
+                if len(parts) == 2:
+                    commands.append((parts[0], parts[1]))
+                else:
+                    print("Invalid message")
+            return commands
+
+        try:
+            flags, session, sequence, commands = decode(data)
+        except ValueError as e:
+            self.stats["invalid"] += 1
+            print(f"Invalid datagram: {e}")
+            return []
+
+        if flags & ACK_REQUEST:
+            self.sock.sendto(encode_ack(session, sequence), addr)
+
+        # every client restart starts a new session, forget the ones not heard from for longest
+        state = self.sessions.setdefault((addr, session), {"seen": set(), "highest": 0, "last": {}})
+        self.sessions.move_to_end((addr, session))
+        while len(self.sessions) > MAX_SESSIONS:
+            self.sessions.popitem(last=False)
+        seen, last = state["seen"], state["last"]
+        # sequences older than the window can only be late retransmissions
+        if sequence in seen or sequence <= state["highest"] - DUPLICATE_WINDOW:
+            self.stats["duplicates"] += 1
+            return []
+        seen.add(sequence)
+        state["highest"] = max(state["highest"], sequence)
+        seen.difference_update([s for s in seen if s <= state["highest"] - DUPLICATE_WINDOW])
+        self.stats["received"] += 1
+
+        applied = []
+        for command, value in commands:
+            if command in STATE_OPS:
+                if last.get(command, 0) > sequence:
+                    self.stats["stale"] += 1
+                    continue
+                last[command] = sequence
+            applied.append((command, value))
+        return applied
+
+    def get_stats(self):
+        """
+        Returns the counters.
+
+        Returns:
+            dict: The counters.
+        """
+        return dict(self.stats)
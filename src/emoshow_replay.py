@@ -0,0 +1,217 @@
+#! /usr/bin/env python
+
+
+"""
+
+Emo-Show session replay.
+
+Re-sends the commands of a recorded game session (the JSON Lines log written by
+EmoShowLogger) to emoshow_handler, or to a local stand-in that only acknowledges
+them, and reports the latency of each command and the duration of the session.
+
+Commands are sent with their recorded timing, scaled by --speed, or as fast as
+possible with --max-speed. The latency of a command is the time from its first
+transmission to the handler's ACK, retransmissions included. game commands are
+not replayed, so the handler keeps running.
+
+Usage: python emoshow_replay.py <session.jsonl> [<elmoIp> <port>] (--speed <factor>) (--max-speed)
+
+"""
+
+import json
+import socket
+import sys
+import threading
+import time
+
+from emoshow_protocol import OPS, CommandClient, CommandReceiver
+from latency import print_header, print_latencies
+
+
+FLUSH_TIMEOUT = 5.0
+
+
+def load_commands(path):
+    """
+    Reads the commands of a session log.
+
+    Args:
+        path (str): The JSON Lines log of the session.
+
+    Returns:
+        list: The (time, command, value) commands, in order, with monotonic
+              times in seconds.
+    """
+    commands = []
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # Not a JSON Lines entry (e.g. an older text log)
+            if entry.get("event") != "command":
+                continue
+            command = entry.get("command")
+            if command in OPS and command != "game":
+                commands.append((entry["t"], command, str(entry.get("value", ""))))
+    return commands
+
+
+class StandIn:
+    """
+    Stand-in for emoshow_handler: acknowledges the commands, without
+    applying them.
+
+    Args:
+        ip (str, optional): The address to listen on. Defaults to localhost.
+        port (int, optional): The port to listen on. Defaults to any free port.
+
+    Methods:
+        start(): Start receiving in a background thread
+        stop(): Stop receiving and close the socket
+    """
+
+    def __init__(self, ip="127.0.0.1", port=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((ip, port))
+        self.sock.settimeout(0.1)
+        self.address = self.sock.getsockname()
+        self.receiver = CommandReceiver(self.sock)
+        self.applied = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+    def run(self):
+        while self.running:
+            try:
+                data, addr = self.sock.recvfrom(65536)
+            except socket.timeout:
+                continue
+            self.applied += len(self.receiver.receive(data, addr))
+
+
+def replay(commands, address, speed=1.0):
+    """
+    Sends the commands of a session and measures their latency.
+
+    Args:
+        commands (list): The (time, command, value) commands.
+        address (tuple): The (ip, port) of the handler.
+        speed (float, optional): The replay speed factor, or None to send
+                                 as fast as possible. Defaults to 1.0.
+
+    Returns:
+        dict: The replay duration, the latency of each command, by command,
+              and the link counters.
+    """
+    rtts = {}  # Sequence -> round trip time
+    client = CommandClient(address, on_ack=lambda sequence, rtt: rtts.__setitem__(sequence, rtt))
+    sent = {}  # Sequence -> command
+
+    start = time.monotonic()
+    first = commands[0][0]
+    for t, command, value in commands:
+        if speed is not None:
+            delay = start + (t - first) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        sent[client.send([f"{command}::{value}"])] = command
+    client.flush(FLUSH_TIMEOUT)
+    duration = time.monotonic() - start
+    stats = client.get_stats()
+    client.close()
+
+    latencies = {}
+    for sequence, command in sent.items():
+        if sequence in rtts:
+            latencies.setdefault(command, []).append(rtts[sequence])
+    return {"duration": duration, "latencies": latencies, "stats": stats}
+
+
+def report(commands, results):
+    """
+    Prints the session duration and the latency of each command.
+    """
+    recorded = commands[-1][0] - commands[0][0]
+    stats = results["stats"]
+    print(f"{len(commands)} commands, recorded {recorded:.2f} s, replayed {results['duration']:.2f} s")
+    print(
+        f"sent {stats['sent']}, acked {stats['acked']}, retransmitted {stats['retransmitted']}, "
+        f"lost {stats['lost'] + stats['pending']}"
+    )
+    print_header()
+    everything = []
+    for command, rtts in sorted(results["latencies"].items()):
+        everything += rtts
+        print_latencies(command, rtts)
+    if len(everything) > 0:
+        print_latencies("all", everything)
+
+
+def main():
+    """
+    Entry point of the replay tool.
+    Parses command line arguments, replays the session and prints the report.
+    """
+    usage = "Usage: python emoshow_replay.py <session.jsonl> [<elmoIp> <port>] (--speed <factor>) (--max-speed)"
+
+    # Parse arguments
+    args = sys.argv[1:]
+    positional = []
+    speed = 1.0
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == "--max-speed":
+            speed = None
+        elif arg == "--speed" and len(args) > 0:
+            try:
+                speed = float(args.pop(0))
+            except ValueError:
+                print(usage)
+                return
+            if speed <= 0:
+                print(usage)
+                return
+        elif not arg.startswith("--"):
+            positional.append(arg)
+        else:
+            print(usage)
+            return
+    if len(positional) not in (1, 3) or (len(positional) == 3 and not positional[2].isdigit()):
+        print(usage)
+        return
+
+    commands = load_commands(positional[0])
+    if len(commands) == 0:
+        print(f"No commands found in {positional[0]}")
+        return
+
+    stand_in = None
+    if len(positional) == 3:
+        address = (positional[1], int(positional[2]))
+    else:
+        stand_in = StandIn()
+        stand_in.start()
+        address = stand_in.address
+        print(f"Replaying to a local stand-in on port {address[1]}")
+
+    try:
+        results = replay(commands, address, speed)
+    finally:
+        if stand_in is not None:
+            stand_in.stop()
+    report(commands, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+# RMN model, loaded once in each worker process
+model = None
+
+
+def load_model():
+    """
+    Loads the facial expression recognition model in the worker process.
+    """
+    global model
+    from rmn import RMN
+
+    model = RMN()
+
+
+def is_model_loaded():
+    """
+    Returns whether the worker process loaded the model.
+    """
+    return model is not None
+
+
+def classify_faces(frame, boxes):
+    """
+    Scores the faces of a frame, without running the RMN face detector.
+
+    Args:
+        frame (np.ndarray): The frame.
+        boxes (list): The (x, y, w, h) face boxes, in pixels.
+
+    Returns:
+        list: The RMN results of each face.
+    """
+    from rmn import convert_to_square
+
+    gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    results = []
+    for x, y, w, h in boxes:
+        # same square crop as the RMN detector
+        xmin, ymin, xmax, ymax = convert_to_square(x, y, x + w, y + h)
+        xmin, ymin = max(xmin, 0), max(ymin, 0)
+        face_image = gray[ymin:ymax, xmin:xmax]
+        if face_image.shape[0] < 10 or face_image.shape[1] < 10:
+            continue
+        emo_label, emo_proba, proba_list = model.detect_emotion_for_single_face_image(face_image)
+        results.append(
+            {
+                "xmin": xmin,
+                "ymin": ymin,
+                "xmax": xmax,
+                "ymax": ymax,
+                "emo_label": emo_label,
+                "emo_proba": emo_proba,
+                "proba_list": proba_list,
+            }
+        )
+    return results
+
+
+def detect_emotions(frames, faces=None):
+    """
+    Scores a batch of frames in the worker process.
+
+    Frames with known face boxes are cropped directly, the others go
+    through the RMN face detector.
+
+    Args:
+        frames (list): The frames to be scored.
+        faces (list, optional): The (x, y, w, h) face boxes of each frame,
+                                in pixels. Defaults to detecting them.
+
+    Returns:
+        list: The RMN results of each frame.
+    """
+    if faces is None:
+        faces = [[]] * len(frames)
+    results = []
+    for frame, boxes in zip(frames, faces):
+        if len(boxes) > 0:
+            results.append(classify_faces(frame, boxes))
+        else:
+            results.append(model.detect_emotion_for_single_frame(frame))
+    return results
+
+
+class EmotionService:
+    """
+    Runs emotion recognition in a separate worker process.
+
+    Requests are queued by the process pool and each one scores a batch
+    of frames. The model is loaded once, when the worker starts, so the
+    game thread never blocks on inference or model loading.
+
+    Args:
+        workers (int, optional): The number of worker processes.
+                                 Defaults to 1.
+
+    Methods:
+        start(): Start the workers and load the model
+        is_ready(): Check if the model is loaded
+        submit(frames, faces): Queue a batch of frames for inference
+        detect(frames, faces, timeout): Score a batch of frames and wait for
+                                        the results
+        shutdown(): Stop the workers
+    """
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.executor = None
+        self.warm_up = None
+
+    def start(self):
+        """
+        Starts the workers and loads the model, without waiting for it.
+        """
+        if self.executor is not None:
+            return
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=load_model,
+        )
+        # Workers start on the first request, so send one right away
+        self.warm_up = self.executor.submit(is_model_loaded)
+
+    def is_ready(self):
+        """
+        Returns whether the model is loaded and ready for inference.
+
+        Returns:
+            bool: True if the model is loaded.
+        """
+        return self.warm_up is not None and self.warm_up.done()
+
+    def submit(self, frames, faces=None):
+        """
+        Queues a batch of frames for inference.
+
+        Args:
+            frames (list): The frames to be scored.
+            faces (list, optional): The (x, y, w, h) face boxes of each
+                                    frame, in pixels. Defaults to detecting
+                                    them in the worker.
+
+        Returns:
+            Future: Resolves to the list of RMN results of each frame.
+        """
+        self.start()
+        return self.executor.submit(detect_emotions, list(frames), faces)
+
+    def detect(self, frames, faces=None, timeout=None):
+        """
+        Scores a batch of frames and waits for the results.
+
+        Args:
+            frames (list): The frames to be scored.
+            faces (list, optional): The (x, y, w, h) face boxes of each
+                                    frame, in pixels. Defaults to detecting
+                                    them in the worker.
+            timeout (float, optional): The maximum time to wait, in seconds.
+                                       Defaults to no limit.
+
+        Returns:
+            list: The RMN results of each frame.
+        """
+        return self.submit(frames, faces).result(timeout)
+
+    def shutdown(self):
+        """
+        Stops the workers.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+            self.warm_up = None
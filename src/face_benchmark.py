@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+
+
+"""
+
+Face detector benchmark.
+
+Runs each face detector over recorded frames (e.g. the frames saved by the game)
+and compares detection latency and hit rate. Frames are resized to the centring
+image size, and the Haar detector is the reference for box agreement.
+
+Usage: python face_benchmark.py <frames_dir> [detector ...]
+
+"""
+
+import glob
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from face_detection import DETECTORS, create_detector, to_gray
+
+
+FRAME_SIZE = (640, 480)
+MIN_SIZE = 100
+MIN_IOU = 0.5
+REFERENCE = "haar"
+
+
+def load_frames(path):
+    """
+    Load the recorded frames, resized to the centring image size.
+    """
+    frames = []
+    for name in sorted(glob.glob(os.path.join(path, "*"))):
+        if not name.lower().endswith((".png", ".jpg", ".jpeg")):
+            continue
+        image = cv2.imread(name)
+        if image is not None:
+            frames.append(to_gray(cv2.resize(image, FRAME_SIZE, interpolation=cv2.INTER_AREA)))
+    return frames
+
+
+def iou(a, b):
+    """
+    Intersection over union of two (x, y, w, h) boxes.
+    """
+    left, top = max(a[0], b[0]), max(a[1], b[1])
+    right, bottom = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    union = a[2] * a[3] + b[2] * b[3] - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def run_detector(detector, frames):
+    """
+    Run a detector over the frames.
+    Returns the largest face of each frame (or None) and the latency of each frame, in ms.
+    """
+    detector.detect(frames[0], MIN_SIZE)  # warm up
+    faces = []
+    latencies = []
+    for frame in frames:
+        start = time.perf_counter()
+        boxes = detector.detect(frame, MIN_SIZE)
+        latencies.append((time.perf_counter() - start) * 1000)
+        faces.append(boxes[0] if len(boxes) > 0 else None)
+    return faces, latencies
+
+
+def benchmark(frames, names):
+    """
+    Print latency, hit rate and agreement with the reference detector.
+    """
+    results = {}
+    for name in [REFERENCE] + [n for n in names if n != REFERENCE]:
+        try:
+            results[name] = run_detector(create_detector(name), frames)
+        except Exception as e:
+            print(f"{name}: skipped ({e})")
+
+    reference = results.get(REFERENCE, (None, None))[0]
+    print(f"{len(frames)} frames, {FRAME_SIZE[0]}x{FRAME_SIZE[1]}, min face size {MIN_SIZE}px")
+    print(f"{'detector':<10} {'mean ms':>8} {'p95 ms':>8} {'max ms':>8} {'hit rate':>9} {'agree':>7}")
+    for name, (faces, latencies) in results.items():
+        hits = sum(face is not None for face in faces)
+        agree = ""
+        if reference is not None:
+            both = [(f, r) for f, r in zip(faces, reference) if r is not None]
+            if len(both) > 0:
+                matched = sum(f is not None and iou(f, r) >= MIN_IOU for f, r in both)
+                agree = f"{100 * matched / len(both):.0f}%"
+        print(
+            f"{name:<10} {np.mean(latencies):>8.1f} {np.percentile(latencies, 95):>8.1f} "
+            f"{np.max(latencies):>8.1f} {100 * hits / len(frames):>8.0f}% {agree:>7}"
+        )
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f"Usage: python face_benchmark.py <frames_dir> [detector ...] (detectors: {', '.join(DETECTORS)})")
+        sys.exit(1)
+    frames = load_frames(sys.argv[1])
+    if len(frames) == 0:
+        print(f"No frames found in {sys.argv[1]}")
+        sys.exit(1)
+    benchmark(frames, sys.argv[2:] or list(DETECTORS))
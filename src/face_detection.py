@@ -0,0 +1,414 @@
+import os
+import time
+
+import cv2
+import numpy as np
+
+HAAR_CASCADE = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+
+# YuNet model, the same file RMN uses for its own face detector
+YUNET_MODEL = "face_detection_yunet_2023mar.onnx"
+YUNET_REPO = "phamquiluan/ResidualMaskingNetwork"
+
+
+def to_gray(image):
+    """
+    Converts an image to grayscale, if it is not already.
+
+    Args:
+        image (np.ndarray): The image.
+
+    Returns:
+        np.ndarray: The single channel image.
+    """
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def to_color(image):
+    """
+    Converts an image to 3 channels, if it is not already.
+
+    Args:
+        image (np.ndarray): The image.
+
+    Returns:
+        np.ndarray: The 3 channel image.
+    """
+    if image.ndim == 3:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+
+def largest_first(faces):
+    """
+    Sorts face boxes by area, largest first.
+
+    Args:
+        faces (list): The (x, y, w, h) boxes.
+
+    Returns:
+        list: The (x, y, w, h) boxes, as tuples of int.
+    """
+    faces = [tuple(int(v) for v in face) for face in faces]
+    faces.sort(key=lambda f: f[2] * f[3], reverse=True)
+    return faces
+
+
+class HaarDetector:
+    """
+    Haar cascade face detector, on the full resolution image.
+
+    Args:
+        scale_factor (float, optional): The scale step between detection
+                                        windows. Defaults to 1.1.
+        min_neighbors (int, optional): The detections needed to keep a
+                                       face. Defaults to 5.
+
+    Methods:
+        detect(image, min_size): Detect faces in an image
+    """
+
+    def __init__(self, scale_factor=1.1, min_neighbors=5):
+        self.classifier = cv2.CascadeClassifier(HAAR_CASCADE)
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+
+    def detect(self, image, min_size=30):
+        """
+        Detects faces in an image.
+
+        Args:
+            image (np.ndarray): The image.
+            min_size (int, optional): The minimum face size, in pixels.
+                                      Defaults to 30.
+
+        Returns:
+            list: The (x, y, w, h) boxes in pixels, largest first.
+        """
+        faces = self.classifier.detectMultiScale(
+            to_gray(image), self.scale_factor, self.min_neighbors, minSize=(min_size, min_size)
+        )
+        return largest_first(faces)
+
+
+class PyramidDetector:
+    """
+    Haar cascade face detector that searches a downscaled image first.
+
+    The coarse pass runs on an image of a fixed width, with a larger scale
+    step. Each face found is then refined on the full resolution image,
+    only around the coarse box and only at scales close to it.
+
+    Args:
+        width (int, optional): The width of the coarse image. Defaults to 320.
+        scale_factor (float, optional): The scale step of the coarse pass.
+                                        Defaults to 1.2.
+        min_neighbors (int, optional): The detections needed to keep a
+                                       face. Defaults to 5.
+        refine (bool, optional): Refine the boxes at full resolution.
+                                 Defaults to True.
+
+    Methods:
+        detect(image, min_size): Detect faces in an image
+    """
+
+    def __init__(self, width=320, scale_factor=1.2, min_neighbors=5, refine=True):
+        self.classifier = cv2.CascadeClassifier(HAAR_CASCADE)
+        self.width = width
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.refine = refine
+
+    def detect(self, image, min_size=30):
+        """
+        Detects faces in an image.
+
+        Args:
+            image (np.ndarray): The image.
+            min_size (int, optional): The minimum face size, in pixels.
+                                      Defaults to 30.
+
+        Returns:
+            list: The (x, y, w, h) boxes in pixels, largest first.
+        """
+        gray = to_gray(image)
+        height, width = gray.shape
+        scale = min(1.0, self.width / width)
+        small = cv2.resize(gray, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+        coarse_min_size = max(20, round(min_size * scale))
+        faces = self.classifier.detectMultiScale(
+            small, self.scale_factor, self.min_neighbors, minSize=(coarse_min_size, coarse_min_size)
+        )
+
+        boxes = []
+        for x, y, w, h in faces:
+            box = (x / scale, y / scale, w / scale, h / scale)
+            if self.refine and scale < 1.0:
+                box = self.refine_box(gray, box, min_size) or box
+            boxes.append(box)
+        return largest_first(boxes)
+
+    def refine_box(self, gray, box, min_size):
+        """
+        Searches the full resolution image around a coarse box.
+
+        Args:
+            gray (np.ndarray): The grayscale image.
+            box (tuple): The coarse (x, y, w, h) box, in pixels.
+            min_size (int): The minimum face size, in pixels.
+
+        Returns:
+            tuple: The refined (x, y, w, h) box, or None if the face is not
+                   found again.
+        """
+        x, y, w, h = box
+        height, width = gray.shape
+        left, top = max(0, int(x - w / 4)), max(0, int(y - h / 4))
+        right, bottom = min(width, int(x + w * 5 / 4)), min(height, int(y + h * 5 / 4))
+        min_box = max(min_size, int(w / self.scale_factor))
+        max_box = max(min_box, int(w * self.scale_factor))
+        faces = self.classifier.detectMultiScale(
+            gray[top:bottom, left:right],
+            1.05,
+            self.min_neighbors,
+            minSize=(min_box, min_box),
+            maxSize=(max_box, max_box),
+        )
+        if len(faces) == 0:
+            return None
+        fx, fy, fw, fh = largest_first(faces)[0]
+        return left + fx, top + fy, fw, fh
+
+
+class YuNetDetector:
+    """
+    YuNet face detector, a small CNN run by the OpenCV DNN module.
+
+    Needs the YuNet model file, which is looked up in the working directory
+    and otherwise downloaded from the Hugging Face Hub, like RMN does.
+
+    Args:
+        model (str, optional): The path of the model file.
+                               Defaults to the RMN YuNet model.
+        width (int, optional): The width the image is resized to before
+                               detection. Defaults to 320.
+        score_threshold (float, optional): The minimum face score.
+                                           Defaults to 0.6.
+
+    Methods:
+        detect(image, min_size): Detect faces in an image
+    """
+
+    def __init__(self, model=None, width=320, score_threshold=0.6):
+        if model is None:
+            model = YUNET_MODEL
+            if not os.path.exists(model):
+                from huggingface_hub import hf_hub_download
+
+                model = hf_hub_download(YUNET_REPO, YUNET_MODEL)
+        self.detector = cv2.FaceDetectorYN.create(
+            model=model, config="", input_size=(width, width), score_threshold=score_threshold
+        )
+        self.width = width
+
+    def detect(self, image, min_size=30):
+        """
+        Detects faces in an image.
+
+        Args:
+            image (np.ndarray): The image.
+            min_size (int, optional): The minimum face size, in pixels.
+                                      Defaults to 30.
+
+        Returns:
+            list: The (x, y, w, h) boxes in pixels, largest first.
+        """
+        color = to_color(image)
+        height, width = color.shape[:2]
+        scale = min(1.0, self.width / width)
+        if scale < 1.0:
+            color = cv2.resize(color, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+        self.detector.setInputSize((color.shape[1], color.shape[0]))
+        _, faces = self.detector.detect(color)
+        if faces is None:
+            return []
+        boxes = np.maximum(faces[:, :4] / scale, 0)
+        return largest_first(box for box in boxes if box[2] >= min_size)
+
+
+# Available face detectors, by name
+DETECTORS = {
+    "haar": HaarDetector,
+    "pyramid": PyramidDetector,
+    "yunet": YuNetDetector,
+}
+
+
+def create_detector(name="pyramid", **kwargs):
+    """
+    Creates a face detector by name.
+
+    Args:
+        name (str, optional): The detector name, one of DETECTORS.
+                              Defaults to "pyramid".
+        **kwargs: The detector options.
+
+    Returns:
+        object: The face detector.
+    """
+    if name not in DETECTORS:
+        raise ValueError(f"Unknown face detector: {name}")
+    return DETECTORS[name](**kwargs)
+
+
+def pixel_boxes(faces, image):
+    """
+    Converts relative face boxes to pixel coordinates in an image.
+
+    Args:
+        faces (list): The (x, y, w, h) boxes, relative to the frame size.
+        image (np.ndarray): The image.
+
+    Returns:
+        list: The (x, y, w, h) boxes, in pixels.
+    """
+    height, width = image.shape[:2]
+    return [
+        (round(x * width), round(y * height), round(w * width), round(h * height))
+        for x, y, w, h in faces
+    ]
+
+
+class FaceTracker:
+    """
+    Detects faces and keeps their bounding boxes between frames.
+
+    Boxes are kept relative to the frame size, so they carry over between
+    the centring image and the pictures, which have different resolutions.
+    Once a face is found, the next frames are only searched around it, and
+    the full frame is searched again when the face is lost.
+
+    Args:
+        detector (object, optional): The face detector. Defaults to the
+                                     pyramid detector.
+        min_size (float, optional): The minimum face width, relative to the
+                                    frame width. Defaults to 0.15.
+        max_age (float, optional): The time after which the boxes are
+                                   discarded, in seconds. Defaults to 10.0.
+        margin (float, optional): The search area around a box, relative to
+                                  its size. Defaults to 0.5.
+
+    Methods:
+        detect(image): Search the full image for faces
+        track(image): Search the image around the known faces
+        shift(dx, dy): Move the known faces after a head movement
+        reset(): Forget the known faces
+    """
+
+    def __init__(self, detector=None, min_size=0.15, max_age=10.0, margin=0.5):
+        self.detector = detector if detector is not None else create_detector()
+        self.min_size = min_size
+        self.max_age = max_age
+        self.margin = margin
+        self.faces = []  # Known faces, largest first
+        self.timestamp = 0.0  # Time the faces were last seen
+
+    def detect(self, image):
+        """
+        Searches the full image for faces.
+
+        Args:
+            image (np.ndarray): The image.
+
+        Returns:
+            list: The (x, y, w, h) boxes relative to the frame size,
+                  largest first.
+        """
+        gray = to_gray(image)
+        height, width = gray.shape
+        faces = self.search(gray, (0, 0, width, height))
+        self.update(faces)
+        return faces
+
+    def track(self, image):
+        """
+        Searches the image around the known faces, falling back to the
+        full image when there are none or they are not found.
+
+        Args:
+            image (np.ndarray): The image.
+
+        Returns:
+            list: The (x, y, w, h) boxes relative to the frame size,
+                  largest first.
+        """
+        if len(self.faces) == 0 or time.time() - self.timestamp > self.max_age:
+            return self.detect(image)
+
+        gray = to_gray(image)
+        height, width = gray.shape
+        faces = []
+        for x, y, w, h in self.faces:
+            left = max(0, int((x - w * self.margin) * width))
+            top = max(0, int((y - h * self.margin) * height))
+            right = min(width, int((x + w * (1 + self.margin)) * width))
+            bottom = min(height, int((y + h * (1 + self.margin)) * height))
+            faces += self.search(gray, (left, top, right - left, bottom - top))
+
+        if len(faces) == 0:
+            return self.detect(image)
+        faces.sort(key=lambda f: f[2] * f[3], reverse=True)
+        self.update(faces)
+        return faces
+
+    def shift(self, dx, dy):
+        """
+        Moves the known faces, to follow a head movement.
+
+        Args:
+            dx (float): The horizontal shift, relative to the frame width.
+            dy (float): The vertical shift, relative to the frame height.
+        """
+        self.faces = [(x + dx, y + dy, w, h) for x, y, w, h in self.faces]
+
+    def reset(self):
+        """
+        Forgets the known faces.
+        """
+        self.faces = []
+        self.timestamp = 0.0
+
+    def search(self, gray, region):
+        """
+        Runs the face detector on a region of the image.
+
+        Args:
+            gray (np.ndarray): The grayscale image.
+            region (tuple): The (x, y, w, h) region, in pixels.
+
+        Returns:
+            list: The (x, y, w, h) boxes relative to the frame size,
+                  largest first.
+        """
+        left, top, width, height = region
+        min_size = min(int(self.min_size * gray.shape[1]), width, height)
+        if min_size <= 0:
+            return []
+        faces = self.detector.detect(gray[top : top + height, left : left + width], min_size)
+        frame_height, frame_width = gray.shape
+        return [
+            ((left + x) / frame_width, (top + y) / frame_height, w / frame_width, h / frame_height)
+            for x, y, w, h in faces
+        ]
+
+    def update(self, faces):
+        """
+        Stores the faces found in the latest frame.
+
+        Args:
+            faces (list): The (x, y, w, h) boxes relative to the frame size.
+        """
+        self.faces = faces
+        self.timestamp = time.time() if len(faces) > 0 else 0.0
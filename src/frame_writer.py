@@ -0,0 +1,150 @@
+import json
+import os
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+class FrameWriter:
+    """
+    Saves frames to disk in a background thread.
+
+    Frames are queued by the game and written by the thread, so encoding and
+    disk I/O never delay the game. Each game session gets its own directory,
+    each frame a unique name and a JSON sidecar with its metadata.
+
+    Args:
+        root (str, optional): The directory of the sessions.
+                              Defaults to "frames".
+        fmt (str, optional): The file format, "jpg" or "npy" (raw array).
+                             Defaults to "jpg".
+        quality (int, optional): The JPEG quality. Defaults to 90.
+        max_queue (int, optional): The maximum number of queued frames,
+                                   frames are dropped when it is full.
+                                   Defaults to 64.
+
+    Methods:
+        start_session(name): Start a new session directory
+        save(image, **metadata): Queue a frame to be saved
+        flush(timeout): Wait until the queued frames are saved
+        close(): Save the queued frames and stop the thread
+    """
+
+    def __init__(self, root="frames", fmt="jpg", quality=90, max_queue=64):
+        if fmt not in ("jpg", "npy"):
+            raise ValueError(f"Unknown frame format: {fmt}")
+        self.root = root
+        self.fmt = fmt
+        self.quality = quality
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.session = None  # Directory of the current session
+        self.count = 0  # Frames queued in the current session
+        self.dropped = 0  # Frames dropped because the queue was full
+        self.thread = None
+
+    def start_session(self, name=None):
+        """
+        Starts a new session directory.
+
+        Args:
+            name (str, optional): The session name. Defaults to the current
+                                  date and time.
+
+        Returns:
+            str: The session directory.
+        """
+        if name is None:
+            name = time.strftime("%Y%m%d-%H%M%S")
+        self.session = os.path.join(self.root, name)
+        self.count = 0
+        return self.session
+
+    def save(self, image, **metadata):
+        """
+        Queues a frame to be saved, without waiting for it.
+
+        Args:
+            image (np.ndarray): The frame.
+            **metadata: Values stored in the sidecar (e.g. move, player).
+
+        Returns:
+            bool: True if the frame was queued, False if it was dropped.
+        """
+        if self.session is None:
+            self.start_session()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+        timestamp = time.time()
+        name = f"frame_{self.count:04d}_{int(timestamp * 1000)}"
+        self.count += 1
+        metadata = dict(metadata, timestamp=timestamp, shape=list(image.shape))
+        try:
+            self.queue.put_nowait((os.path.join(self.session, name), image, metadata))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self, timeout=None):
+        """
+        Waits until the queued frames are saved.
+
+        Args:
+            timeout (float, optional): The maximum time to wait, in seconds.
+                                       Defaults to no limit.
+
+        Returns:
+            bool: True if all frames were saved in time.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self.queue.unfinished_tasks > 0:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self):
+        """
+        Saves the queued frames and stops the thread.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        """
+        Writes queued frames until closed.
+        """
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.write(*item)
+            except Exception as e:
+                print(f"Error saving frame: {e}")
+            finally:
+                self.queue.task_done()
+
+    def write(self, path, image, metadata):
+        """
+        Writes a frame and its sidecar.
+
+        Args:
+            path (str): The path of the frame, without extension.
+            image (np.ndarray): The frame.
+            metadata (dict): The values stored in the sidecar.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.fmt == "npy":
+            np.save(f"{path}.npy", image)
+        else:
+            cv2.imwrite(f"{path}.jpg", image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        with open(f"{path}.json", "w") as f:
+            json.dump(dict(metadata, file=os.path.basename(f"{path}.{self.fmt}")), f, default=str)
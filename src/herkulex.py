@@ -503,6 +503,36 @@ class servo:
         except HerkulexError:
             raise HerkulexError("could not communicate with motors")
 
+    def get_servo_inposition(self):
+        """ Get the inposition flag of servo
+
+        This function reads the detailed status of the servo, without
+        printing it, and checks the inposition flag
+
+        Args:
+            none
+
+        Returns:
+            bool: True if the servo reached its goal position
+
+        Raises:
+            HerkulexError: The servo did not answer, or the answer was short
+
+        """
+        data = []
+        data.append(0x09)
+        data.append(self.servoid)
+        data.append(RAM_READ_REQ)
+        data.append(STATUS_DETAIL_RAM)
+        data.append(BYTE1)
+        send_data(data)
+        rxdata = []
+        try:
+            rxdata = SERPORT.read(12)
+            return bool(ord(rxdata[9]) & 0x02)
+        except (HerkulexError, IndexError):
+            raise HerkulexError("Could not communicate with motors")
+
     def  set_led(self, colorcode):
         """ Set the LED Color of Herkulex
 
@@ -0,0 +1,42 @@
+"""
+
+Latency reports.
+
+Formatting shared by the benchmarking tools (emoshow_replay, load_generator):
+one row per command, with the count, mean, p50, p95 and max latency in ms.
+
+"""
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of a list of values (nearest rank).
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))]
+
+
+def print_header(width=10):
+    """
+    Prints the column titles of the latency rows.
+
+    Args:
+        width (int, optional): The width of the name column. Defaults to 10.
+    """
+    print(f"{'command':<{width}} {'count':>6} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+
+
+def print_latencies(name, latencies, width=10):
+    """
+    Prints the latency row of a command.
+
+    Args:
+        name (str): The command.
+        latencies (list): The latencies, in seconds.
+        width (int, optional): The width of the name column. Defaults to 10.
+    """
+    ms = [latency * 1000 for latency in latencies]
+    print(
+        f"{name:<{width}} {len(ms):>6} {sum(ms) / len(ms):>8.2f} {percentile(ms, 50):>8.2f} "
+        f"{percentile(ms, 95):>8.2f} {max(ms):>8.2f}"
+    )
@@ -3,30 +3,40 @@
 
 """
 
-Load initial middleware keys and values into redis.
+Load initial middleware keys and values into the middleware.
 
 """
 
 
 import json
 import os
-import redis
 
+import middleware as mw
 
-client = redis.Redis()
 
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cfg", "initial.json")
+ROBOT_CONFIG_PATH = "/home/idmind/elmo.json"
 
-# Load initial config.
-with open("../cfg/initial.json") as f:
-    config = json.load(f)
 
-for key, value in config.items():
-    client.set(key, json.dumps(value))
-
-# Load custom robot config.
-if "elmo.json" in os.listdir("/home/idmind"):
-    with open("/home/idmind/elmo.json") as f:
+def load_file(path):
+    """
+    Set the keys of a JSON config file.
+    """
+    with open(path) as f:
         config = json.load(f)
 
     for key, value in config.items():
-        client.set(key, json.dumps(value))
+        mw.set_key(key, value)
+
+
+def load_config():
+    """
+    Load the initial config, then the custom robot config, if any.
+    """
+    load_file(CONFIG_PATH)
+    if os.path.exists(ROBOT_CONFIG_PATH):
+        load_file(ROBOT_CONFIG_PATH)
+
+
+if __name__ == "__main__":
+    load_config()
@@ -0,0 +1,266 @@
+#! /usr/bin/env python
+
+
+"""
+
+Load generator.
+
+Drives robot_api (HTTP) and emoshow_handler (UDP) with a scripted mix of commands
+at a fixed rate, and reports the latency of each command and the throughput.
+Meant to run against the simulated robot (see simulation.py), or the real one.
+
+    api  Clients poll the status, move the head (and wait until it settles) and set
+         the leds, through robot_api. Latencies are the request round trips.
+    udp  Game commands (pan, tilt, image, icon) are sent to emoshow_handler. Latencies
+         are the times until the handler acknowledges them.
+
+Usage: python load_generator.py <elmoIp> <api|udp|all> (--rate <commands/s>) (--duration <s>) (--clients <n>) (--port <handlerPort>)
+
+"""
+
+
+import random
+import sys
+import threading
+import time
+
+import requests
+
+from emoshow_protocol import CommandClient
+from latency import print_header, print_latencies
+
+
+API_PORT = 8001
+HANDLER_PORT = 4000
+REQUEST_TIMEOUT = 10.0
+FLUSH_TIMEOUT = 5.0
+LED_COUNT = 169
+
+# Commands of each scenario, and how often each one is sent
+API_SCENARIO = (
+    ("status", 4),
+    ("set_pan", 2),
+    ("set_tilt", 2),
+    ("settle", 1),
+    ("update_leds", 1),
+)
+UDP_SCENARIO = (
+    ("pan", 4),
+    ("tilt", 4),
+    ("image", 1),
+    ("icon", 1),
+)
+
+
+def pick(scenario):
+    """
+    Picks a command of a scenario, by weight.
+    """
+    names, weights = zip(*scenario)
+    return random.choices(names, weights)[0]
+
+
+class Results:
+    """
+    Latencies and errors of the commands, shared by the clients.
+
+    Methods:
+        add(name, latency): Record the latency of a command
+        error(name): Record a failed command
+        report(title, duration): Print the throughput and latencies
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, name, latency):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(latency)
+
+    def error(self, name):
+        with self.lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, title, duration):
+        completed = sum(len(latencies) for latencies in self.latencies.values())
+        errors = sum(self.errors.values())
+        print(f"{title}: {completed} commands in {duration:.1f} s, {completed / duration:.1f}/s, {errors} errors")
+        print_header(width=12)
+        everything = []
+        for name, latencies in sorted(self.latencies.items()):
+            everything += latencies
+            print_latencies(name, latencies, width=12)
+        if len(everything) > 0:
+            print_latencies("all", everything, width=12)
+        for name, count in sorted(self.errors.items()):
+            print(f"{name}: {count} errors")
+
+
+def api_command(session, url, name):
+    """
+    Sends one robot_api command.
+
+    Returns:
+        bool: True if the robot reported success.
+    """
+    if name == "status":
+        return session.get(f"{url}/status", timeout=REQUEST_TIMEOUT).status_code == 200
+    if name == "set_pan":
+        body = {"op": "set_pan", "angle": random.randint(-30, 30)}
+    elif name == "set_tilt":
+        body = {"op": "set_tilt", "angle": random.randint(-10, 10)}
+    elif name == "settle":
+        angle = random.randint(-30, 30)
+        res = session.post(f"{url}/command", json={"op": "set_pan", "angle": angle}, timeout=REQUEST_TIMEOUT)
+        if not res.json()["success"]:
+            return False
+        body = {"op": "wait_until_settled", "pan": angle}
+    else:
+        colors = [[random.randint(0, 255) for _ in range(3)] for _ in range(LED_COUNT)]
+        body = {"op": "update_leds", "colors": colors}
+    res = session.post(f"{url}/command", json=body, timeout=REQUEST_TIMEOUT)
+    return res.json()["success"]
+
+
+def api_client(url, rate, duration, results):
+    """
+    Sends robot_api commands at a fixed rate until the duration ends.
+    A command that takes longer than its period delays the next ones,
+    without bursts to catch up.
+    """
+    session = requests.Session()
+    start = time.monotonic()
+    next_command = start
+    while next_command < start + duration:
+        delay = next_command - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        name = pick(API_SCENARIO)
+        sent = time.monotonic()
+        try:
+            if api_command(session, url, name):
+                results.add(name, time.monotonic() - sent)
+            else:
+                results.error(name)
+        except (requests.RequestException, ValueError, KeyError):
+            results.error(name)
+        next_command = max(next_command + 1.0 / rate, time.monotonic())
+
+
+def run_api(ip, rate, duration, clients):
+    """
+    Loads robot_api with several clients, sharing the rate.
+    """
+    url = f"http://{ip}:{API_PORT}"
+    results = Results()
+    threads = [
+        threading.Thread(target=api_client, args=(url, rate / clients, duration, results))
+        for _ in range(clients)
+    ]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.report("robot_api", time.monotonic() - start)
+
+
+def udp_message(name):
+    """
+    Returns a "command::value" game command.
+    """
+    if name == "pan":
+        return f"pan::{random.randint(-30, 30)}"
+    if name == "tilt":
+        return f"tilt::{random.randint(-10, 10)}"
+    if name == "image":
+        return "image::normal.png"
+    return "icon::black.png"
+
+
+def run_udp(ip, port, rate, duration):
+    """
+    Loads emoshow_handler with game commands at a fixed rate.
+    """
+    rtts = {}  # Sequence -> round trip time
+    client = CommandClient((ip, port), on_ack=lambda sequence, rtt: rtts.__setitem__(sequence, rtt))
+    sent = {}  # Sequence -> command
+    start = time.monotonic()
+    next_command = start
+    while next_command < start + duration:
+        delay = next_command - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        name = pick(UDP_SCENARIO)
+        sent[client.send([udp_message(name)])] = name
+        next_command += 1.0 / rate
+    client.flush(FLUSH_TIMEOUT)
+    elapsed = time.monotonic() - start
+    stats = client.get_stats()
+    client.close()
+
+    results = Results()
+    for sequence, name in sent.items():
+        if sequence in rtts:
+            results.add(name, rtts[sequence])
+        else:
+            results.error(name)
+    results.report("emoshow_handler", elapsed)
+    print(f"retransmitted {stats['retransmitted']}")
+
+
+def main():
+    """
+    Entry point of the load generator.
+    Parses command line arguments and runs the scenarios.
+    """
+    usage = (
+        "Usage: python load_generator.py <elmoIp> <api|udp|all> (--rate <commands/s>) "
+        "(--duration <s>) (--clients <n>) (--port <handlerPort>)"
+    )
+
+    # Parse arguments
+    if len(sys.argv) < 3 or sys.argv[2] not in ("api", "udp", "all"):
+        print(usage)
+        return
+    ip, target = sys.argv[1:3]
+    rate = 20.0
+    duration = 10.0
+    clients = 1
+    port = HANDLER_PORT
+
+    args = sys.argv[3:]
+    while len(args) > 0:
+        arg = args.pop(0)
+        if len(args) == 0:
+            print(usage)
+            return
+        try:
+            if arg == "--rate":
+                rate = float(args.pop(0))
+            elif arg == "--duration":
+                duration = float(args.pop(0))
+            elif arg == "--clients":
+                clients = int(args.pop(0))
+            elif arg == "--port":
+                port = int(args.pop(0))
+            else:
+                print(usage)
+                return
+        except ValueError:
+            print(usage)
+            return
+    if rate <= 0 or duration <= 0 or clients <= 0 or port <= 0:
+        print(usage)
+        return
+
+    if target in ("api", "all"):
+        run_api(ip, rate, duration, clients)
+    if target in ("udp", "all"):
+        run_udp(ip, port, rate, duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,9 @@ Middleware.
 
 This module provides a set of classes to interact with the middleware.
 
-Defines several classes to interact with the underlying redis database.
+Defines several classes to interact with the underlying database, a redis server
+or, for tests and single process deployments, the memory of the process
+(set ELMO_MIDDLEWARE=memory).
 
 Classes that extend DBEntry define data that will be stored in the database.
 
@@ -24,25 +26,138 @@ When used as a script, the module provides a command line interface to manage no
 """
 
 
-import redis
 import json
 import os
 import signal
 import psutil
 import time
 import sys
+import fnmatch
+import numbers
 import requests
 from io import BytesIO
 from PIL import Image
 import threading
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from telemetry import TelemetryReader
+
+
+class RedisBackend:
+    """
+    Middleware backend on a redis server, shared by all processes.
+    Change notifications use redis keyspace events, and are delivered by a
+    background thread.
+    """
+
+    def __init__(self):
+        import redis
+        self.client = redis.Redis()
+        self.pubsub = None
+        self.pubsub_thread = None
+
+    def set(self, key, value):
+        self.client.set(key, value)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def exists(self, key):
+        return self.client.exists(key) != 0
+
+    def keys(self, pattern="*"):
+        return [k.decode() for k in self.client.keys(pattern)]
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def flushall(self):
+        self.client.flushall()
+
+    def watch(self, prefix, callback):
+        # keyspace events are disabled by default, enable the ones of writes and deletes
+        self.client.config_set("notify-keyspace-events", "K$g")
+        if self.pubsub is None:
+            self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+
+        def handle(message):
+            callback(message["channel"].decode().split(":", 1)[1])
+
+        self.pubsub.psubscribe(**{f"__keyspace@0__:{prefix}*": handle})
+        if self.pubsub_thread is None:
+            self.pubsub_thread = self.pubsub.run_in_thread(sleep_time=0.01, daemon=True)
+
+
+class MemoryBackend:
+    """
+    Middleware backend in the memory of the process, for tests and for
+    running several nodes in a single process, without a redis server.
+    Change notifications are delivered by the thread that made the change.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+        self.watchers = []
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+        self.notify(key)
+
+    def get(self, key):
+        with self.lock:
+            return self.data.get(key)
+
+    def exists(self, key):
+        with self.lock:
+            return key in self.data
+
+    def keys(self, pattern="*"):
+        with self.lock:
+            return [k for k in self.data if fnmatch.fnmatchcase(k, pattern)]
+
+    def delete(self, key):
+        with self.lock:
+            deleted = self.data.pop(key, None) is not None
+        if deleted:
+            self.notify(key)
+
+    def flushall(self):
+        with self.lock:
+            self.data.clear()
+
+    def watch(self, prefix, callback):
+        with self.lock:
+            self.watchers.append((prefix, callback))
+
+    def notify(self, key):
+        with self.lock:
+            callbacks = [callback for prefix, callback in self.watchers if key.startswith(prefix)]
+        for callback in callbacks:
+            callback(key)
+
+
+BACKENDS = {
+    "redis": RedisBackend,
+    "memory": MemoryBackend,
+}
 
 
 def get_connection():
     """
-    Get a connection to the redis database.
+    Get a connection to the database.
+    The backend is selected by the ELMO_MIDDLEWARE environment variable,
+    "redis" (default) or "memory".
     """
-    return redis.Redis()
+    name = os.environ.get("ELMO_MIDDLEWARE", "redis")
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown middleware backend: {name}")
+    return BACKENDS[name]()
 
 # global connection
 connection = get_connection()
@@ -50,50 +165,157 @@ connection = get_connection()
 
 def set_key(key, value):
     """
-    Set a key in the redis database.
+    Set a key in the database.
     """
     connection.set(key, json.dumps(value))
 
 def get_key(key):
     """
-    Get a key from the redis database.
+    Get a key from the database.
     """
     return json.loads(connection.get(key))
 
 def has_key(key):
     """
-    Check if a key exists in the redis database.
+    Check if a key exists in the database.
     """
-    return connection.exists(key) != 0
+    return connection.exists(key)
 
 def has_any_key(prefix):
     """
-    Check if any key with the given prefix exists in the redis database.
+    Check if any key with the given prefix exists in the database.
     """
     return len(connection.keys(prefix + "*")) > 0
 
 def delete_all():
     """
-    Delete all keys from the redis database.
+    Delete all keys from the database.
     """
     connection.flushall()
 
 def get_all(*prefixes):
     """
-    Get all keys from the redis database.
+    Get all keys from the database.
     Optionally, filter by prefix.
     """
     for k in sorted(connection.keys()):
-        if len(prefixes) == 0 or any([k.decode().startswith(p) for p in prefixes]):
-            print(f'{k.decode()}:\t{get_key(k.decode())}')
+        if len(prefixes) == 0 or any([k.startswith(p) for p in prefixes]):
+            print(f'{k}:\t{CODECS["json"].decode(connection.get(k))}')
+
+def watch(prefix, callback):
+    """
+    Call callback(key) when a key with the given prefix is set or deleted.
+    """
+    connection.watch(prefix, callback)
 
 def has_any(key):
     """
-    Check if any key with the given prefix exists in the redis database.
+    Check if any key matching the given pattern exists in the database.
     """
     return len(connection.keys(key)) > 0
 
 
+class JsonCodec:
+    """
+    Field codec for any value, as JSON.
+    Also decodes structures stored with msgpack, see StructCodec.
+    """
+
+    def encode(self, value):
+        return json.dumps(value)
+
+    def decode(self, value):
+        try:
+            return json.loads(value)
+        except ValueError:
+            if msgpack is None:
+                raise
+            return msgpack.unpackb(value)
+
+
+class StructCodec:
+    """
+    Field codec for lists and dictionaries, as msgpack when it is installed,
+    otherwise as JSON. Both are decoded, so values written by load_config,
+    or by nodes without msgpack, can still be read.
+    """
+
+    def encode(self, value):
+        if not isinstance(value, (list, tuple, dict)):
+            raise ValueError(f"{value!r} is not a list or dictionary")
+        if msgpack is not None:
+            return msgpack.packb(value)
+        return json.dumps(value)
+
+    def decode(self, value):
+        if msgpack is None or value[:1] in (b'[', b'{', '[', '{'):
+            return json.loads(value)
+        return msgpack.unpackb(value)
+
+
+class BoolCodec:
+    """
+    Field codec for booleans, as "1" or "0".
+    Also decodes the JSON booleans written by load_config.
+    """
+
+    def encode(self, value):
+        if isinstance(value, (str, bytes)) or value not in (True, False):
+            raise ValueError(f"{value!r} is not a boolean")
+        return "1" if value else "0"
+
+    def decode(self, value):
+        return value in (b'1', '1', b'true', 'true')
+
+
+class NumberCodec:
+    """
+    Field codec for ints and floats, as their text.
+    Ints are decoded as ints, and floats as floats.
+    """
+
+    def encode(self, value):
+        if isinstance(value, bool) or not isinstance(value, numbers.Real):
+            raise ValueError(f"{value!r} is not a number")
+        if isinstance(value, numbers.Integral):
+            return str(int(value))
+        return repr(float(value))
+
+    def decode(self, value):
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+
+
+class OptionalCodec:
+    """
+    Field codec for a value that can also be None, stored as "null".
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+
+    def encode(self, value):
+        if value is None:
+            return "null"
+        return self.codec.encode(value)
+
+    def decode(self, value):
+        if value in (b'null', 'null'):
+            return None
+        return self.codec.decode(value)
+
+
+CODECS = {
+    "json": JsonCodec(),
+    "struct": StructCodec(),
+    "bool": BoolCodec(),
+    "number": NumberCodec(),
+    "number?": OptionalCodec(NumberCodec()),
+}
+
+
 class Node:
     """
     Node class.
@@ -147,7 +369,7 @@ class NodeManager:
     """
 
     def list_nodes(self):
-        return [k.decode()[5:] for k in connection.keys("node_*")]
+        return [k[5:] for k in connection.keys("node_*")]
     
     def get_pid(self, name):
         return get_key("node_" + name)
@@ -181,26 +403,65 @@ class DBEntry:
     Extend this class to define data that will be stored in the database.
     The fields attribute defines the data that will be stored.
     The prefix attribute defines the prefix that will be used to store the data.
+    The types attribute defines the type of fields, as a key of CODECS, so they
+    are stored without JSON and validated on write. Other fields are stored as JSON.
+    The telemetry attribute defines numeric fields that the driver writes at a
+    high rate to shared memory (see telemetry.py), with their struct codes. They
+    are read from shared memory when the driver runs on the same machine.
     """
 
     prefix = ''
     fields = {}
+    types = {}
+    telemetry = {}
     def __init__(self):
         for k in self.fields:
             setattr(self.__class__, k, property(self.getter(k), self.setter(k)))
     
     def getter(self, key):
+        codec = CODECS[self.types.get(key, "json")]
         def do_get(self):
-            if not has_key(f'{self.prefix}_{key}'):
-                set_key(f'{self.prefix}_{key}', self.fields[key])
-            return get_key(f'{self.prefix}_{key}')
+            if key in self.telemetry:
+                values = self.read_telemetry()
+                if values is not None:
+                    return values[key]
+            value = connection.get(f'{self.prefix}_{key}')
+            if value is None:
+                value = codec.encode(self.fields[key])
+                connection.set(f'{self.prefix}_{key}', value)
+            return codec.decode(value)
         return do_get
     
     def setter(self, key):
+        codec = CODECS[self.types.get(key, "json")]
         def do_set(self, value):
-            set_key(f'{self.prefix}_{key}', value)
+            try:
+                encoded = codec.encode(value)
+            except ValueError as e:
+                raise ValueError(f'{self.prefix}.{key}: {e}') from None
+            connection.set(f'{self.prefix}_{key}', encoded)
         return do_set
 
+    def read_telemetry(self):
+        """
+        Get the telemetry fields from shared memory, or None if unavailable.
+        """
+        if getattr(self, "telemetry_reader", None) is None:
+            self.telemetry_reader = TelemetryReader(self.prefix, self.telemetry)
+        return self.telemetry_reader.read()
+
+    def watch(self, callback):
+        """
+        Call callback(field) when a field of the entry is set or deleted.
+        """
+        start = len(self.prefix) + 1
+
+        def on_change(key):
+            if key[start:] in self.fields:
+                callback(key[start:])
+
+        watch(f'{self.prefix}_', on_change)
+
 
 class Robot(DBEntry):
     """
@@ -217,10 +478,15 @@ class Camera(DBEntry):
     """
     Database entry.
     Camera information.
+    Use url for the full resolution stream.
+    Use preview_url for the low resolution stream.
+    Use analysis_url for the low resolution grayscale stream.
     """
     prefix = "camera"
     fields = {
         "url": "http://elmo2:8080/stream.mjpg",
+        "preview_url": "http://elmo2:8080/preview.mjpg",
+        "analysis_url": "http://elmo2:8080/analysis.mjpg",
     }
 
 
@@ -237,6 +503,10 @@ class Microphone(DBEntry):
         "is_recording": False,
         "record": False
     }
+    types = {
+        "is_recording": "bool",
+        "record": "bool",
+    }
 
 
 class Battery(DBEntry):
@@ -258,6 +528,20 @@ class Battery(DBEntry):
         'ad_at_16v': 765.021,
         'percentage': 100.0
     }
+    types = {
+        'ready': 'bool',
+        'raw': 'number',
+        'voltage': 'number',
+        'i2c_address': 'number',
+        'ad_at_13v': 'number',
+        'ad_at_16v': 'number',
+        'percentage': 'number',
+    }
+    telemetry = {
+        'raw': 'd',
+        'voltage': 'd',
+        'percentage': 'd',
+    }
 
 
 class Leds(DBEntry):
@@ -275,8 +559,18 @@ class Leds(DBEntry):
         'colors': [[0, 0, 0]] * 169,
         'brightness': 0.3
     }
+    types = {
+        'ready': 'bool',
+        'number': 'number',
+        'colors': 'struct',
+        'brightness': 'number',
+    }
 
     def load_from_url(self, url):
+        # stop the frames of a previous gif, so they do not replace this icon
+        for t in getattr(self, "animation", []):
+            t.cancel()
+        self.animation = []
         # gif
         if ".gif" in url:
             response = requests.get(url)
@@ -306,6 +600,7 @@ class Leds(DBEntry):
                     return update_colors
                 t = threading.Timer(time_between_frames * i, set_colors(frames[i]))
                 t.start()
+                self.animation.append(t)
         else:
             colors = []
             response = requests.get(url)
@@ -351,6 +646,20 @@ class GPIO(DBEntry):
         'button_pressed': False,
         'robot_shutdown': False,
     }
+    types = {
+        'ready': 'bool',
+        'button_pin': 'number',
+        'shutdown_pin': 'number',
+        'stay_enable_pin': 'number',
+        'audio_pin': 'number',
+        'monitor_pin': 'number',
+        'audio_enabled': 'bool',
+        'monitor_enabled': 'bool',
+        'audio_enable': 'bool',
+        'monitor_enable': 'bool',
+        'button_pressed': 'bool',
+        'robot_shutdown': 'bool',
+    }
 
 
 class Speakers(DBEntry):
@@ -360,6 +669,7 @@ class Speakers(DBEntry):
     Set url to a url to play a sound.
     Set volume to a value between 0 and 100 to set the volume.
     Check playing to see if a sound is playing.
+    Check finished and finished_at to see the last sound that ended, and when.
     """
     prefix = "speakers"
     fields = {
@@ -367,6 +677,13 @@ class Speakers(DBEntry):
         "volume": 70,
         "url": None,
         "playing": None,
+        "finished": None,
+        "finished_at": 0.0,
+    }
+    types = {
+        "ready": "bool",
+        "volume": "number",
+        "finished_at": "number",
     }
 
 
@@ -401,6 +718,27 @@ class TouchSensors(DBEntry):
         "head_3_raw": 0,
         "sensitivity": 5,
     }
+    types = {
+        "ready": "bool",
+        "touch_chest": "bool",
+        "touch_head_0": "bool",
+        "touch_head_1": "bool",
+        "touch_head_2": "bool",
+        "touch_head_3": "bool",
+        "chest_raw": "number",
+        "head_0_raw": "number",
+        "head_1_raw": "number",
+        "head_2_raw": "number",
+        "head_3_raw": "number",
+        "sensitivity": "number",
+    }
+    telemetry = {
+        "chest_raw": "i",
+        "head_0_raw": "i",
+        "head_1_raw": "i",
+        "head_2_raw": "i",
+        "head_3_raw": "i",
+    }
 
     def head_touch(self):
         """
@@ -414,7 +752,22 @@ class TouchSensors(DBEntry):
         ))
 
 
-class Pan(DBEntry):
+class Servo(DBEntry):
+    """
+    Base of the servo entries (Pan and Tilt).
+    """
+
+    def is_settled(self, angle=None):
+        """
+        Check if the servo finished moving to the requested angle.
+        Optionally, check that angle is the latest requested angle.
+        """
+        if angle is not None and float(self.angle) != float(angle):
+            return False
+        return self.angle_ref == self.angle and not self.moving and self.in_position
+
+
+class Pan(Servo):
     """
     Database entry.
     Pan servo information.
@@ -426,6 +779,9 @@ class Pan(DBEntry):
     Check enabled to see if torque is enabled.
     Set pid_p to a value between 0 and 255 to set the proportional gain.
     Set pid_d to a value between 0 and 255 to set the derivative gain.
+    Set max_velocity (degrees/s) and max_acceleration (degrees/s^2) to limit motion.
+    Check moving to see if a trajectory is being followed.
+    Check in_position to see if the servo reports it reached the goal.
     Check temperature to see the temperature.
     """
     prefix = "pan"
@@ -443,14 +799,40 @@ class Pan(DBEntry):
         "pid_current_d": 0,
         "max_angle": 40,
         "min_angle": -40,
-        "min_playtime": 100,
-        "max_playtime": 200,
+        "max_velocity": 90.0,
+        "max_acceleration": 360.0,
+        "moving": False,
+        "in_position": True,
         "temperature": 0,
         "angle_bias": 12.0
     }
+    types = {
+        "ready": "bool",
+        "id": "number",
+        "angle": "number",
+        "current_angle": "number",
+        "angle_ref": "number?",
+        "enable": "bool",
+        "enabled": "bool",
+        "pid_p": "number",
+        "pid_current_p": "number",
+        "pid_d": "number",
+        "pid_current_d": "number",
+        "max_angle": "number",
+        "min_angle": "number",
+        "max_velocity": "number",
+        "max_acceleration": "number",
+        "moving": "bool",
+        "in_position": "bool",
+        "temperature": "number",
+        "angle_bias": "number",
+    }
+    telemetry = {
+        "current_angle": "d",
+    }
 
 
-class Tilt(DBEntry):
+class Tilt(Servo):
     """
     Database entry.
     Tilt servo information.
@@ -462,6 +844,9 @@ class Tilt(DBEntry):
     Check enabled to see if torque is enabled.
     Set pid_p to a value between 0 and 255 to set the proportional gain.
     Set pid_d to a value between 0 and 255 to set the derivative gain.
+    Set max_velocity (degrees/s) and max_acceleration (degrees/s^2) to limit motion.
+    Check moving to see if a trajectory is being followed.
+    Check in_position to see if the servo reports it reached the goal.
     Check temperature to see the temperature.
     """
     prefix = "tilt"
@@ -479,11 +864,37 @@ class Tilt(DBEntry):
         "pid_current_d": 0,
         "max_angle": 15,
         "min_angle": -15,
-        "min_playtime": 100,
-        "max_playtime": 200,
+        "max_velocity": 45.0,
+        "max_acceleration": 180.0,
+        "moving": False,
+        "in_position": True,
         "temperature": 0,
         "angle_bias": 2.3
     }
+    types = {
+        "ready": "bool",
+        "id": "number",
+        "angle": "number",
+        "current_angle": "number",
+        "angle_ref": "number?",
+        "enable": "bool",
+        "enabled": "bool",
+        "pid_p": "number",
+        "pid_current_p": "number",
+        "pid_d": "number",
+        "pid_current_d": "number",
+        "max_angle": "number",
+        "min_angle": "number",
+        "max_velocity": "number",
+        "max_acceleration": "number",
+        "moving": "bool",
+        "in_position": "bool",
+        "temperature": "number",
+        "angle_bias": "number",
+    }
+    telemetry = {
+        "current_angle": "d",
+    }
 
 
 class Onboard(DBEntry):
@@ -506,6 +917,9 @@ class Onboard(DBEntry):
         "video": None,
         "speech": None,
     }
+    types = {
+        "ready": "bool",
+    }
 
 
 class Speech(DBEntry):
@@ -524,23 +938,34 @@ class Speech(DBEntry):
         "say": None,
         "saying": None,
     }
+    types = {
+        "ready": "bool",
+    }
 
 
 class Server(DBEntry):
     """
     Database entry.
     Server information.
+    Configure the host name the robot is reached at, used in resource urls.
     Configure the http server port, udp server port and api server port.
     Configure the path to static resources, served by the http server.
     """
     prefix = "server"
     fields = {
         "ready": False,
+        "host": "elmo",
         "http_port": 8000,
         "udp_port": 5000,
         "api_port": 8001,
         "static_path": "static",
     }
+    types = {
+        "ready": "bool",
+        "http_port": "number",
+        "udp_port": "number",
+        "api_port": "number",
+    }
 
     # def wait_for_ready(self):
     #     while not self.ready:
@@ -548,23 +973,23 @@ class Server(DBEntry):
     def wait_for_ready(self):
         while True:
             try:
-                requests.get("http://elmo:8000/")
+                requests.get(f"http://{self.host}:{self.http_port}/")
                 break
             except Exception:
                 time.sleep(0.5)
 
 
     def url_for_image(self, name):
-        return "http://elmo:8000/images/" + name
+        return f"http://{self.host}:{self.http_port}/images/" + name
 
     def url_for_sound(self, name):
-        return "http://elmo:8000/sounds/" + name
+        return f"http://{self.host}:{self.http_port}/sounds/" + name
     
     def url_for_icon(self, name):
-        return "http://elmo:8000/icons/" + name
+        return f"http://{self.host}:{self.http_port}/icons/" + name
     
     def url_for_video(self, name):
-        return "http://elmo:8000/videos/" + name
+        return f"http://{self.host}:{self.http_port}/videos/" + name
     
     def url_for_camera(self):
         return ""
@@ -617,6 +1042,12 @@ class Power(DBEntry):
         "gpio_shutdown": True,
         "battery_shutdown": True,
     }
+    types = {
+        "reboot": "bool",
+        "shutdown": "bool",
+        "gpio_shutdown": "bool",
+        "battery_shutdown": "bool",
+    }
 
 
 class Behaviours(DBEntry):
@@ -626,12 +1057,20 @@ class Behaviours(DBEntry):
     Set look_around to True to enable look around behaviour.
     Set blush to True to enable blush behaviour.
     Set change_mode to True to enable change mode behaviour.
+    Set track_face to True to enable face tracking behaviour.
     """
     prefix = "behaviour"
     fields = {
         "look_around": False,
         "blush": True,
         "change_mode": True,
+        "track_face": False,
+    }
+    types = {
+        "look_around": "bool",
+        "blush": "bool",
+        "change_mode": "bool",
+        "track_face": "bool",
     }
 
     def list_behaviours(self):
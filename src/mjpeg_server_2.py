@@ -1,17 +1,46 @@
 #!/usr/bin/python3
 
 # This is the same as mjpeg_server.py, but uses the h/w MJPEG encoder.
+#
+# Several streams are served at the same time, so each client can pick
+# the resolution it needs:
+#   /stream.mjpg    full resolution, from the main output
+#   /preview.mjpg   low resolution, from the lores output
+#   /analysis.mjpg  low resolution grayscale, encoded only while watched
+#
+# Stream clients always get the latest frame, frames they were too slow
+# for are skipped and counted as dropped. Add ?fps=N to a stream URL to
+# limit its frame rate. Each stream takes up to MAX_STREAM_CLIENTS clients.
+# Client counters are served on /stats.json.
+#
+# Single pictures are served without stream setup:
+#   /snapshot.jpg             latest full resolution frame, returned immediately
+#   /snapshot.jpg?mode=still  new full resolution capture, encoded at high quality
 
 import io
+import json
 import logging
 import socketserver
+import time
 from http import server
-from threading import Condition
+from threading import Condition, Lock, Thread
+from urllib.parse import parse_qs, urlsplit
 
+import numpy as np
+import simplejpeg
 from picamera2 import Picamera2
 from picamera2.encoders import MJPEGEncoder
 from picamera2.outputs import FileOutput
 
+MAIN_SIZE = (2304, 1296)
+LORES_SIZE = (640, 360)
+ANALYSIS_FPS = 10
+ANALYSIS_QUALITY = 80
+STILL_QUALITY = 95
+MAX_STREAM_CLIENTS = 4  # Per stream
+FRAME_TIMEOUT = 5.0  # A stream without frames for this long is closed
+STREAM_WRITE_TIMEOUT = 10.0
+
 PAGE = """\
 <html>
 <head>
@@ -19,7 +48,13 @@ PAGE = """\
 </head>
 <body>
 <h1>Picamera2 MJPEG Streaming Demo</h1>
-<img src="stream.mjpg" width="2304" height="1296" />
+<p>
+<a href="stream.mjpg">Full resolution</a> |
+<a href="preview.mjpg">Preview</a> |
+<a href="analysis.mjpg">Analysis</a> |
+<a href="snapshot.jpg?mode=still">Still</a>
+</p>
+<img src="preview.mjpg" width="640" height="360" />
 </body>
 </html>
 """
@@ -29,52 +64,160 @@ class StreamingOutput(io.BufferedIOBase):
     def __init__(self):
         self.frame = None
         self.condition = Condition()
+        self.clients = 0
+        self.count = 0
 
     def write(self, buf):
         with self.condition:
             self.frame = buf
+            self.count += 1
             self.condition.notify_all()
 
 
+class AnalysisStream(Thread):
+    """
+    Encodes the luminance plane of the lores output as grayscale JPEG.
+    Frames are only captured and encoded while the stream has clients.
+    """
+
+    def __init__(self, output):
+        super().__init__(daemon=True)
+        self.output = output
+
+    def run(self):
+        width, height = LORES_SIZE
+        while True:
+            if self.output.clients == 0:
+                time.sleep(0.1)
+                continue
+            start = time.time()
+            yuv = picam2.capture_array("lores")
+            gray = np.ascontiguousarray(yuv[:height, :width])
+            frame = simplejpeg.encode_jpeg(
+                gray[:, :, np.newaxis], quality=ANALYSIS_QUALITY, colorspace='GRAY')
+            self.output.write(frame)
+            time.sleep(max(0.0, 1.0 / ANALYSIS_FPS - (time.time() - start)))
+
+
+def capture_still():
+    """
+    Captures a new full resolution frame and encodes it at high quality.
+    """
+    array = picam2.capture_array("main")
+    return simplejpeg.encode_jpeg(array, quality=STILL_QUALITY, colorspace='RGBX')
+
+
 class StreamingHandler(server.BaseHTTPRequestHandler):
     def do_GET(self):
-        if self.path == '/':
+        url = urlsplit(self.path)
+        if url.path == '/':
             self.send_response(301)
             self.send_header('Location', '/index.html')
             self.end_headers()
-        elif self.path == '/index.html':
+        elif url.path == '/index.html':
             content = PAGE.encode('utf-8')
             self.send_response(200)
             self.send_header('Content-Type', 'text/html')
             self.send_header('Content-Length', len(content))
             self.end_headers()
             self.wfile.write(content)
-        elif self.path == '/stream.mjpg':
+        elif url.path in streams:
+            try:
+                max_fps = float(parse_qs(url.query).get('fps', ['0'])[0])
+            except ValueError:
+                max_fps = 0.0
+            self.stream(url.path, max_fps)
+        elif url.path == '/stats.json':
+            with clients_lock:
+                content = json.dumps(list(clients.values())).encode('utf-8')
             self.send_response(200)
-            self.send_header('Age', 0)
-            self.send_header('Cache-Control', 'no-cache, private')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(content))
             self.end_headers()
-            try:
-                while True:
-                    with output.condition:
-                        output.condition.wait()
-                        frame = output.frame
-                    self.wfile.write(b'--FRAME\r\n')
-                    self.send_header('Content-Type', 'image/jpeg')
-                    self.send_header('Content-Length', len(frame))
-                    self.end_headers()
-                    self.wfile.write(frame)
-                    self.wfile.write(b'\r\n')
-            except Exception as e:
-                logging.warning(
-                    'Removed streaming client %s: %s',
-                    self.client_address, str(e))
+            self.wfile.write(content)
+        elif url.path == '/snapshot.jpg':
+            self.snapshot(parse_qs(url.query).get('mode', [''])[0] == 'still')
         else:
             self.send_error(404)
             self.end_headers()
 
+    def snapshot(self, still):
+        if still:
+            frame = capture_still()
+        else:
+            with output.condition:
+                if output.frame is None:
+                    output.condition.wait(timeout=1.0)
+                frame = output.frame
+        if frame is None:
+            self.send_error(503)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', len(frame))
+        self.end_headers()
+        self.wfile.write(frame)
+
+    def stream(self, path, max_fps):
+        output = streams[path]
+        with clients_lock:
+            if sum(1 for c in clients.values() if c['path'] == path) >= MAX_STREAM_CLIENTS:
+                self.send_error(503, 'Too many streaming clients')
+                self.end_headers()
+                return
+            stats = {
+                'client': '%s:%d' % self.client_address,
+                'path': path,
+                'max_fps': max_fps,
+                'sent': 0,
+                'dropped': 0,
+            }
+            clients[self.client_address] = stats
+        self.send_response(200)
+        self.send_header('Age', 0)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Pragma', 'no-cache')
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+        self.end_headers()
+        # a stalled client is removed instead of holding its thread forever
+        self.connection.settimeout(STREAM_WRITE_TIMEOUT)
+        period = 1.0 / max_fps if max_fps > 0 else 0.0
+        next_time = 0.0
+        with output.condition:
+            output.clients += 1
+            last_count = output.count
+        try:
+            while True:
+                delay = next_time - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                # skip to the latest frame, counting the ones this client missed
+                with output.condition:
+                    if not output.condition.wait_for(lambda: output.count > last_count, FRAME_TIMEOUT):
+                        raise TimeoutError('no frame for %.0f s' % FRAME_TIMEOUT)
+                    frame = output.frame
+                    stats['dropped'] += output.count - last_count - 1
+                    last_count = output.count
+                next_time = time.time() + period
+                self.wfile.write(b'--FRAME\r\n')
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', len(frame))
+                self.end_headers()
+                self.wfile.write(frame)
+                self.wfile.write(b'\r\n')
+                stats['sent'] += 1
+        except Exception as e:
+            logging.warning(
+                'Removed streaming client %s: %s (sent %d, dropped %d)',
+                self.client_address, str(e), stats['sent'], stats['dropped'])
+        finally:
+            with output.condition:
+                output.clients -= 1
+            with clients_lock:
+                clients.pop(self.client_address, None)
+
 
 class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
     allow_reuse_address = True
@@ -82,11 +225,23 @@ class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
 
 
 picam2 = Picamera2()
-# picam2.configure(picam2.create_video_configuration(main={"size": (640, 480)}))
-# picam2.configure(picam2.create_video_configuration(main={"size": (1536, 864)}))
-picam2.configure(picam2.create_video_configuration(main={"size": (2304, 1296)}))
+picam2.configure(picam2.create_video_configuration(
+    main={"size": MAIN_SIZE, "format": "XBGR8888"},
+    lores={"size": LORES_SIZE, "format": "YUV420"},
+))
 output = StreamingOutput()
+preview_output = StreamingOutput()
+analysis_output = StreamingOutput()
+streams = {
+    '/stream.mjpg': output,
+    '/preview.mjpg': preview_output,
+    '/analysis.mjpg': analysis_output,
+}
+clients = {}  # Counters of each streaming client
+clients_lock = Lock()
 picam2.start_recording(MJPEGEncoder(), FileOutput(output))
+picam2.start_encoder(MJPEGEncoder(), FileOutput(preview_output), name="lores")
+AnalysisStream(analysis_output).start()
 
 try:
     address = ('', 8080)
@@ -5,6 +5,8 @@ import time
 import threading
 import socket
 import json
+import os
+import wave
 from flask import Flask, jsonify, request
 from werkzeug.utils import secure_filename
 import logging
@@ -12,6 +14,7 @@ import logging
 logging.getLogger('werkzeug').setLevel(logging.ERROR)
 
 import middleware as mw
+from command_registry import registry
 
 
 SERVER_PORT = 8001
@@ -37,6 +40,8 @@ class Robot:
     mw_power = mw.Power()
     mw_behaviours = mw.Behaviours()
 
+    sound_durations = {}  # Cached sound durations, by name
+
     def __init__(self):
         self.battery = self.mw_battery.voltage
         self.battery_percentage = self.mw_battery.percentage
@@ -57,6 +62,7 @@ class Robot:
         self.touch_head_w = self.mw_touch_sensors.touch_head_3
         self.behaviour_look_around = self.mw_behaviours.look_around
         self.behaviour_blush = self.mw_behaviours.blush
+        self.behaviour_track_face = self.mw_behaviours.track_face
         self.video_list = self.mw_server.get_video_list()
         self.sound_list = self.mw_server.get_sound_list()
         self.image_list = self.mw_server.get_image_list()
@@ -86,6 +92,7 @@ class Robot:
         self.touch_head_w = self.mw_touch_sensors.touch_head_3
         self.behaviour_look_around = self.mw_behaviours.look_around
         self.behaviour_blush = self.mw_behaviours.blush
+        self.behaviour_track_face = self.mw_behaviours.track_face
         self.video_list = self.mw_server.get_video_list()
         self.sound_list = self.mw_server.get_sound_list()
         self.image_list = self.mw_server.get_image_list()
@@ -111,6 +118,10 @@ class Robot:
         self.mw_behaviours.change_mode = bool(control)
         return True, "OK"
 
+    def enable_track_face(self, control):
+        self.mw_behaviours.track_face = bool(control)
+        return True, "OK"
+
     def set_pan_torque(self, control):
         self.mw_pan.enable = bool(control)
         return True, "OK"
@@ -127,6 +138,14 @@ class Robot:
         self.mw_tilt.angle = angle
         return True, "OK"
 
+    def wait_until_settled(self, pan=None, tilt=None, timeout=5.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.mw_pan.is_settled(pan) and self.mw_tilt.is_settled(tilt):
+                return True, "OK"
+            time.sleep(0.05)
+        return False, "Not settled after %.1f seconds" % timeout
+
     def update_motor_limits(self, pan_min, pan_max, tilt_min, tilt_max):
         self.mw_pan.min_angle = pan_min
         self.mw_pan.max_angle = pan_max
@@ -139,6 +158,34 @@ class Robot:
         self.mw_speakers.url = url
         return True, "OK"
 
+    def get_sound_duration(self, name):
+        if name not in self.sound_durations:
+            path = os.path.join(self.mw_server.static_path, "sounds", name)
+            try:
+                with wave.open(path) as f:
+                    self.sound_durations[name] = f.getnframes() / f.getframerate()
+            except (OSError, EOFError, wave.Error) as e:
+                return False, "Cannot read %s: %s" % (name, e), None
+        return True, "OK", self.sound_durations[name]
+
+    def wait_sound(self, name, timeout=10.0):
+        # the sound may be requested by another client, and not be playing yet:
+        # the driver may take a while to start it, so wait for it until the timeout
+        url = self.mw_server.url_for_sound(name)
+        start = time.time()
+        started = False
+        while time.time() < start + timeout:
+            if self.mw_speakers.url == url or self.mw_speakers.playing == url:
+                started = True
+            elif started:
+                return True, "OK"
+            elif self.mw_speakers.finished == url and self.mw_speakers.finished_at >= start:
+                return True, "OK"
+            time.sleep(0.05)
+        if not started:
+            return False, "%s did not play in %.1f seconds" % (name, timeout)
+        return False, "%s still playing after %.1f seconds" % (name, timeout)
+
     def pause_audio(self):
         self.mw_speakers.url = None
         return True, "OK"
@@ -228,6 +275,8 @@ def command():
                 success, message = robot.enable_blush(control)
             if name == "change_mode":
                 success, message = robot.enable_change_mode(control)
+            if name == "track_face":
+                success, message = robot.enable_track_face(control)
             return jsonify({ "success": True, "message": "OK" })
         elif op == "set_pan_torque":
             control = req["control"]
@@ -241,9 +290,22 @@ def command():
         elif op == "set_tilt":
             angle = req["angle"]
             success, message = robot.set_tilt(angle)
+        elif op == "wait_until_settled":
+            pan = req.get("pan")
+            tilt = req.get("tilt")
+            timeout = req.get("timeout", 5.0)
+            success, message = robot.wait_until_settled(pan, tilt, timeout)
         elif op == "play_sound":
             name = req["name"]
             success, message = robot.play_sound(name)
+        elif op == "get_sound_duration":
+            name = req["name"]
+            success, message, duration = robot.get_sound_duration(name)
+            return jsonify({ "success": success, "message": message, "duration": duration })
+        elif op == "wait_sound":
+            name = req["name"]
+            timeout = req.get("timeout", 10.0)
+            success, message = robot.wait_sound(name, timeout)
         elif op == "pause_audio":
             success, message = robot.pause_audio()
         elif op == "set_volume":
@@ -269,6 +331,9 @@ def command():
             success, message = robot.reboot()
         elif op == "shutdown":
             success, message = robot.shutdown()
+        elif registry.has(op):
+            # game commands, the same ones emoshow_handler receives
+            registry.execute(op, str(req["value"]))
         else:
             return jsonify({ "success": False, "message": "%s is not a recognized operation" % op })
         return jsonify({ "success": success, "message": message })
@@ -0,0 +1,391 @@
+#! /usr/bin/env python
+
+
+"""
+
+Simulated robot.
+
+Runs stand-ins of the hardware drivers against the middleware (a local redis),
+so the rest of the software (robot_api, http_server, emoshow_handler, the
+behaviours) can run and be benchmarked without the robot.
+
+    pan_tilt       the real DriverPanTilt on a simulated herkulex servo bus, with the
+                   serial transfer times of the real bus and servos that follow their
+                   goals in the requested play time
+    battery        the real DriverBattery on a simulated AD converter, slowly discharging
+    touch_sensors  raw values with noise, and occasional touches
+    leds           the time the neopixel matrix takes to update
+    speakers       the real DriverSpeakers, sounds last as long as their file
+
+Resource urls are set to the local http server. With ELMO_MIDDLEWARE=memory, the
+simulated drivers run on their own, without redis (e.g. to test the drivers). They all
+run in this process, simulated sounds play in a thread instead of a process.
+
+Usage: python simulation.py [driver ...] (--reset)
+
+"""
+
+
+import os
+import random
+import sys
+import threading
+import time
+import wave
+
+import herkulex as hx
+import middleware as mw
+from driver_battery import DriverBattery
+from driver_pan_tilt import PLAYTIME_UNIT, DriverPanTilt
+from driver_speakers import DriverSpeakers
+from load_config import load_config
+from telemetry import TelemetryWriter
+
+
+SIMULATION_HOST = "localhost"
+
+# Herkulex bus
+BAUDRATE = 115200
+BYTE_TIME = 10 / BAUDRATE  # 8N1
+RESPONSE_DELAY = 0.0006  # Servo return delay
+WRITE_PACKET = 12  # Bytes of a write request (e.g. a position goal)
+READ_PACKET = 9  # Bytes of a read request
+READ_RESPONSE = 13  # Bytes of a read response
+ANGLE_RESOLUTION = 0.326  # Degrees per position step
+INPOSITION_DELAY = 0.02  # Time to settle within the inposition margin
+SERVO_TEMPERATURE = 35
+
+# Battery
+FULL_VOLTAGE = 16.2
+DISCHARGE_RATE = 0.0002  # V/s
+VOLTAGE_NOISE = 0.02
+
+# Touch sensors
+TOUCH_BASELINE = 200
+TOUCH_DROP = 40  # Filtered value drop of a touched sensor
+TOUCH_NOISE = 2
+TOUCH_RATE = 0.05  # Touches per second
+TOUCH_DURATION = 1.0
+
+# Neopixel matrix
+NEOPIXEL_BIT_TIME = 1.25e-6
+NEOPIXEL_RESET_TIME = 50e-6
+
+# Speakers
+SOUNDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "sounds")
+DEFAULT_SOUND_DURATION = 1.0
+
+
+class SimulatedServo:
+    """
+    Simulated herkulex servo, with the interface of herkulex.servo.
+
+    Moves linearly to its goal in the requested play time, and reports
+    being in position shortly after. Every call takes the time of its
+    packets on the shared bus.
+    """
+
+    def __init__(self, bus, servoid):
+        self.bus = bus
+        self.servoid = servoid
+        self.torque = False
+        self.position_p = 0
+        self.position_d = 0
+        self.start_angle = 0.0
+        self.goal_angle = 0.0
+        self.start_time = 0.0
+        self.end_time = 0.0
+
+    def angle(self):
+        """
+        The angle at the current time.
+        """
+        now = time.time()
+        if now >= self.end_time:
+            return self.goal_angle
+        s = (now - self.start_time) / (self.end_time - self.start_time)
+        return self.start_angle + (self.goal_angle - self.start_angle) * s
+
+    def set_servo_angle(self, goalangle, goaltime, led):
+        self.bus.transfer(WRITE_PACKET)
+        if not self.torque:
+            return
+        self.start_angle = self.angle()
+        self.goal_angle = goalangle
+        self.start_time = time.time()
+        self.end_time = self.start_time + goaltime * PLAYTIME_UNIT
+
+    def get_servo_angle(self):
+        self.bus.transfer(READ_PACKET, READ_RESPONSE)
+        return round(self.angle() / ANGLE_RESOLUTION) * ANGLE_RESOLUTION
+
+    def get_servo_inposition(self):
+        self.bus.transfer(READ_PACKET, READ_RESPONSE)
+        return time.time() >= self.end_time + INPOSITION_DELAY
+
+    def get_servo_temperature(self):
+        self.bus.transfer(READ_PACKET, READ_RESPONSE)
+        return SERVO_TEMPERATURE
+
+    def torque_on(self):
+        self.bus.transfer(WRITE_PACKET)
+        self.torque = True
+
+    def torque_off(self):
+        self.bus.transfer(WRITE_PACKET)
+        self.torque = False
+
+    def set_position_p(self, pvalue):
+        self.bus.transfer(WRITE_PACKET)
+        self.position_p = pvalue
+
+    def set_position_d(self, dvalue):
+        self.bus.transfer(WRITE_PACKET)
+        self.position_d = dvalue
+
+
+class SimulatedHerkulex:
+    """
+    Simulated herkulex bus, with the interface of the herkulex module.
+
+    The bus is half duplex, so transfers of different servos wait for
+    each other.
+    """
+
+    HerkulexError = hx.HerkulexError
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.servos = {}
+
+    def transfer(self, sent, received=0):
+        """
+        Wait for the time a request, and its response, take on the bus.
+        """
+        with self.lock:
+            duration = sent * BYTE_TIME
+            if received > 0:
+                duration += RESPONSE_DELAY + received * BYTE_TIME
+            time.sleep(duration)
+
+    def connect(self, portname, baudrate):
+        pass
+
+    def close(self):
+        pass
+
+    def clear_errors(self):
+        self.transfer(WRITE_PACKET)
+
+    def servo(self, servoid):
+        if servoid not in self.servos:
+            self.servos[servoid] = SimulatedServo(self, servoid)
+        return self.servos[servoid]
+
+
+class SimulatedBattery(DriverBattery):
+    """
+    DriverBattery on a simulated AD converter, discharging from a full battery.
+    """
+
+    def __init__(self):
+        """
+        Connect to middleware.
+        Initialize node.
+        """
+        self.battery = mw.Battery()
+        self.node = mw.Node("driver_battery")
+        self.telemetry = TelemetryWriter(self.battery)
+        value_at_13v = self.battery.ad_at_13v
+        value_at_16v = self.battery.ad_at_16v
+        self.slope = 30 / (value_at_16v - value_at_13v)
+        self.bias = 130 - self.slope * value_at_13v
+        self.voltage_buffer = []
+        self.start_time = time.time()
+
+    def read_ad(self):
+        """
+        Read the AD value of the current voltage.
+        """
+        voltage = FULL_VOLTAGE - DISCHARGE_RATE * (time.time() - self.start_time)
+        voltage += random.gauss(0.0, VOLTAGE_NOISE)
+        return round((voltage * 10.0 - self.bias) / self.slope * 4) / 4
+
+
+class SimulatedTouchSensors:
+    """
+    Simulated touch sensors: noisy raw values, and touches at random times.
+    """
+
+    SENSORS = ("chest_raw", "head_0_raw", "head_1_raw", "head_2_raw", "head_3_raw")
+
+    def __init__(self):
+        """
+        Connect to middleware.
+        Initialize node.
+        """
+        self.touch_sensors = mw.TouchSensors()
+        self.node = mw.Node("driver_touch_sensors")
+        self.telemetry = TelemetryWriter(self.touch_sensors)
+        self.touched = {}  # Sensor -> end of the touch
+
+    def run(self):
+        """
+        Main loop.
+        """
+        try:
+            self.touch_sensors.ready = True
+            while not self.node.is_shutdown():
+                now = time.time()
+                if random.random() < TOUCH_RATE * 0.1:
+                    self.touched[random.choice(self.SENSORS)] = now + TOUCH_DURATION
+                values = {}
+                for sensor in self.SENSORS:
+                    value = TOUCH_BASELINE + random.gauss(0.0, TOUCH_NOISE)
+                    if self.touched.get(sensor, 0.0) > now:
+                        value -= TOUCH_DROP
+                    values[sensor] = int(value)
+                self.telemetry.write(**values)
+                time.sleep(0.1)
+        finally:
+            self.telemetry.close()
+            self.node.shutdown()
+
+
+class SimulatedLeds:
+    """
+    Simulated neopixel matrix, taking the time of the real update.
+    """
+
+    def __init__(self):
+        """
+        Connect to middleware.
+        Initialize node.
+        """
+        self.node = mw.Node("driver_leds")
+        self.leds = mw.Leds()
+        self.colors = [[0, 0, 0]] * self.leds.number
+        self.updates = 0
+
+    def run(self):
+        """
+        Main loop.
+        """
+        try:
+            self.leds.ready = True
+            while not self.node.is_shutdown():
+                time.sleep(0.1)
+                colors = self.leds.colors[:]
+                if colors != self.colors:
+                    time.sleep(len(colors) * 24 * NEOPIXEL_BIT_TIME + NEOPIXEL_RESET_TIME)
+                    self.colors = colors
+                    self.updates += 1
+        finally:
+            self.node.shutdown()
+
+
+class SimulatedSpeakers(DriverSpeakers):
+    """
+    DriverSpeakers that plays sounds for the duration of their file,
+    without audio. Sounds play in a thread, so they report finishing
+    to the same middleware as the driver, also the memory backend.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.stopped = threading.Event()
+
+    def start_sound(self, url):
+        """
+        Start playing a sound in a thread.
+        """
+        self.process = threading.Thread(target=self.play_sound, args=(url,), daemon=True)
+        self.process.start()
+
+    def play_sound(self, url):
+        """
+        Play a sound, until it ends or is stopped.
+        """
+        print(f'playing {url}')
+        self.stopped.wait(sound_duration(url))
+        self.finish_sound(url)
+
+    def stop_sound(self):
+        """
+        Stop playing a sound.
+        """
+        if self.process is not None and self.process.is_alive():
+            self.stopped.set()
+            self.process.join()
+        self.stopped.clear()
+
+    def set_volume(self, volume):
+        return True
+
+
+def sound_duration(url):
+    """
+    Returns the duration of a sound url, read from the local file.
+    """
+    name = url.split("/sounds/", 1)[-1]
+    try:
+        with wave.open(os.path.join(SOUNDS_PATH, name)) as f:
+            return f.getnframes() / f.getframerate()
+    except (OSError, EOFError, wave.Error):
+        return DEFAULT_SOUND_DURATION
+
+
+DRIVERS = {
+    "pan_tilt": lambda: DriverPanTilt(SimulatedHerkulex()),
+    "battery": SimulatedBattery,
+    "touch_sensors": SimulatedTouchSensors,
+    "leds": SimulatedLeds,
+    "speakers": SimulatedSpeakers,
+}
+
+
+def main():
+    """
+    Entry point of the simulation.
+    Parses command line arguments and runs the simulated drivers until they are shut down.
+    """
+    usage = f"Usage: python simulation.py [driver ...] (--reset) (drivers: {', '.join(DRIVERS)})"
+
+    # Parse arguments
+    names = []
+    reset = False
+    for arg in sys.argv[1:]:
+        if arg == "--reset":
+            reset = True
+        elif arg in DRIVERS:
+            names.append(arg)
+        else:
+            print(usage)
+            return
+    if len(names) == 0:
+        names = list(DRIVERS)
+
+    if reset:
+        mw.delete_all()
+        load_config()
+    mw.Server().host = SIMULATION_HOST
+
+    drivers = [DRIVERS[name]() for name in names]
+    threads = [threading.Thread(target=driver.run, daemon=True) for driver in drivers]
+    for thread in threads:
+        thread.start()
+    print(f"Simulating {', '.join(names)}")
+
+    manager = mw.NodeManager()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        for driver in drivers:
+            manager.shutdown(driver.node.name)
+        for thread in threads:
+            thread.join(timeout=5.0)
+
+
+if __name__ == "__main__":
+    main()
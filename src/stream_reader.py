@@ -0,0 +1,300 @@
+import collections
+import threading
+import time
+
+import cv2
+import numpy as np
+import requests
+
+
+# Reduced decode flags, by scale factor
+REDUCED_COLOR = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+REDUCED_GRAYSCALE = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def jpeg_size(jpeg):
+    """
+    Reads the image size from the JPEG header, without decoding.
+
+    Args:
+        jpeg (bytes): The JPEG frame.
+
+    Returns:
+        tuple: The width and height, or None if no frame header is found.
+    """
+    i = 2
+    while i + 9 < len(jpeg):
+        if jpeg[i] != 0xFF:
+            i += 1
+            continue
+        marker = jpeg[i + 1]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(jpeg[i + 5 : i + 7], "big")
+            width = int.from_bytes(jpeg[i + 7 : i + 9], "big")
+            return width, height
+        if marker == 0xFF:
+            i += 1
+        elif marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            i += 2
+        else:
+            i += 2 + int.from_bytes(jpeg[i + 2 : i + 4], "big")
+    return None
+
+
+class Frame:
+    """
+    A JPEG frame received from the stream, decoded on demand.
+
+    Args:
+        jpeg (bytes): The JPEG frame.
+        timestamp (float): The time the frame was received.
+
+    Methods:
+        decode(size, grayscale): Decode the frame, at reduced resolution
+                                 when a smaller size is requested
+    """
+
+    def __init__(self, jpeg, timestamp):
+        self.jpeg = jpeg
+        self.timestamp = timestamp
+
+    def decode(self, size=None, grayscale=False):
+        """
+        Decodes the frame.
+
+        When a size is given, the JPEG is decoded at the largest reduction
+        (1/2, 1/4 or 1/8) that is still at least that size, and then resized.
+
+        Args:
+            size (tuple, optional): The (width, height) of the image.
+                                    Defaults to the full resolution.
+            grayscale (bool, optional): Decode a single channel image.
+                                        Defaults to False.
+
+        Returns:
+            np.ndarray: The decoded image, or None if decoding failed.
+        """
+        flags = REDUCED_GRAYSCALE if grayscale else REDUCED_COLOR
+        scale = 1
+        full_size = jpeg_size(self.jpeg) if size is not None else None
+        if full_size is not None:
+            for factor in (8, 4, 2):
+                if full_size[0] // factor >= size[0] and full_size[1] // factor >= size[1]:
+                    scale = factor
+                    break
+
+        image = cv2.imdecode(np.frombuffer(self.jpeg, dtype=np.uint8), flags[scale])
+        if image is None or size is None:
+            return image
+        if (image.shape[1], image.shape[0]) != tuple(size):
+            image = cv2.resize(image, tuple(size), interpolation=cv2.INTER_AREA)
+        return image
+
+
+class StreamReader:
+    """
+    Keeps an MJPEG stream open and buffers the latest frame.
+
+    A background thread reads the stream and parses JPEG frames
+    incrementally, so grabbing a frame is a memory read. Frames are kept
+    as JPEG and only decoded when requested. The last few frames are kept
+    too, so bursts can start slightly in the past.
+
+    Args:
+        url (str): The URL of the MJPEG stream.
+        chunk_size (int, optional): The size of each read from the stream.
+                                    Defaults to 16384.
+        max_buffer_size (int, optional): The maximum number of bytes kept
+                                         while looking for a frame.
+                                         Defaults to 4 MB.
+        history_size (int, optional): The number of recent frames kept.
+                                      Defaults to 30.
+
+    Methods:
+        start(): Start reading the stream in the background
+        stop(): Stop reading the stream
+        get_latest_frame(timeout): Get the latest frame
+        get_next_frame(after, timeout): Get the first frame received after
+                                        a given time
+        get_frames(count, after, timeout): Get consecutive frames received
+                                           after a given time
+    """
+
+    def __init__(
+        self, url, chunk_size=16384, max_buffer_size=4 * 1024 * 1024, history_size=30
+    ):
+        self.url = url
+        self.chunk_size = chunk_size
+        self.max_buffer_size = max_buffer_size
+
+        self.frame = None  # Latest frame
+        self.history = collections.deque(maxlen=history_size)  # Recent frames
+        self.condition = threading.Condition()
+
+        self.running = False
+        self.thread = None
+        self.response = None
+
+    def start(self):
+        """
+        Starts reading the stream in the background.
+        """
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.read_stream, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops reading the stream and closes the connection.
+        """
+        self.running = False
+        if self.response is not None:
+            self.response.close()
+
+    def read_stream(self):
+        """
+        Reads the stream until stopped, reconnecting on errors.
+        """
+        while self.running:
+            try:
+                self.response = requests.get(self.url, stream=True, timeout=5)
+                if self.response.status_code != 200:
+                    raise requests.RequestException(
+                        f"Stream returned status {self.response.status_code}"
+                    )
+                self.parse_stream(self.response.iter_content(chunk_size=self.chunk_size))
+            except Exception:
+                if self.running:
+                    time.sleep(1)
+            finally:
+                if self.response is not None:
+                    self.response.close()
+
+    def parse_stream(self, stream):
+        """
+        Extracts JPEG frames from the stream chunks.
+
+        Only the bytes not scanned yet are searched for the JPEG markers,
+        and consumed bytes are dropped from the buffer.
+
+        Args:
+            stream (iterator): The chunks of the stream.
+        """
+        buffer = bytearray()
+        start = -1  # Position of the start of the current frame
+        scanned = 0  # Position up to which the buffer was scanned
+
+        for chunk in stream:
+            if not self.running:
+                return
+            buffer += chunk
+
+            while True:
+                if start == -1:
+                    start = buffer.find(b"\xff\xd8", max(0, scanned - 1))
+                    if start == -1:
+                        scanned = len(buffer)
+                        break
+                    scanned = start + 2
+                end = buffer.find(b"\xff\xd9", max(start + 2, scanned - 1))
+                if end == -1:
+                    scanned = len(buffer)
+                    break
+                self.set_frame(bytes(buffer[start : end + 2]))
+                del buffer[: end + 2]
+                start = -1
+                scanned = 0
+
+            # Keep the buffer bounded if the stream is corrupted
+            if len(buffer) > self.max_buffer_size:
+                buffer.clear()
+                start = -1
+                scanned = 0
+
+    def set_frame(self, jpeg):
+        """
+        Stores a new frame and wakes up waiting readers.
+
+        Args:
+            jpeg (bytes): The JPEG frame.
+        """
+        with self.condition:
+            self.frame = Frame(jpeg, time.time())
+            self.history.append(self.frame)
+            self.condition.notify_all()
+
+    def get_latest_frame(self, timeout=2.0):
+        """
+        Returns the latest frame, waiting for the first one if needed.
+
+        Args:
+            timeout (float, optional): The maximum time to wait, in seconds.
+                                       Defaults to 2.0.
+
+        Returns:
+            Frame: The latest frame, or None if no frame arrived in time.
+        """
+        with self.condition:
+            if self.frame is None:
+                self.condition.wait_for(lambda: self.frame is not None, timeout)
+            return self.frame
+
+    def get_next_frame(self, after, timeout=2.0):
+        """
+        Returns the first frame received after a given time.
+
+        Args:
+            after (float): The time, as returned by time.time().
+            timeout (float, optional): The maximum time to wait, in seconds.
+                                       Defaults to 2.0.
+
+        Returns:
+            Frame: The first frame received after that time, or None if no
+                   frame arrived in time.
+        """
+        with self.condition:
+            received = lambda: self.frame is not None and self.frame.timestamp > after
+            if not self.condition.wait_for(received, timeout):
+                return None
+            # The oldest frame of the history after that time, if still kept
+            for frame in self.history:
+                if frame.timestamp > after:
+                    return frame
+            return self.frame
+
+    def get_frames(self, count, after, timeout=1.0):
+        """
+        Returns consecutive frames received after a given time.
+
+        Frames already in the history are returned right away, and new
+        frames are waited for until there are enough or the timeout expires.
+
+        Args:
+            count (int): The number of frames.
+            after (float): The time, as returned by time.time().
+            timeout (float, optional): The maximum time to wait, in seconds.
+                                       Defaults to 1.0.
+
+        Returns:
+            list: Up to count frames, oldest first.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                frames = [frame for frame in self.history if frame.timestamp > after]
+                remaining = deadline - time.time()
+                if len(frames) >= count or remaining <= 0:
+                    return frames[:count]
+                self.condition.wait(remaining)
@@ -0,0 +1,204 @@
+"""
+
+Telemetry.
+
+Shared memory fast path for the numeric telemetry of the drivers (touch raw values,
+battery voltage, servo angles), updated several times a second and read by several
+processes.
+
+Each DBEntry that declares telemetry fields gets a shared memory region, named after
+its prefix, with a fixed layout:
+
+    sequence (4 bytes), timestamp (8 bytes), then the fields, in order, as struct codes
+
+The region has a single writer, the driver. The sequence is a seqlock: it is odd while
+the writer updates the region, so readers retry instead of reading a torn update.
+The values are also published to the middleware, at a lower rate, for remote tools and
+for readers that cannot map the region.
+
+"""
+
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+
+REGION_PREFIX = "elmo_telemetry_"
+PUBLISH_INTERVAL = 1.0  # Seconds between middleware updates
+STALE_TIME = 10.0  # Values older than this are read from the middleware
+ATTACH_INTERVAL = 1.0  # Seconds between attempts to map a missing region
+READ_RETRIES = 10
+
+regions = {}  # Regions written by this process, by name
+
+
+def layout(fields):
+    """
+    Returns the struct of a region with the given fields.
+
+    Args:
+        fields (dict): The struct code of each field, in order.
+
+    Returns:
+        struct.Struct: The layout of the region.
+    """
+    return struct.Struct("<Id" + "".join(fields.values()))
+
+
+def attach(name):
+    """
+    Maps an existing region without tracking it, so the region is not
+    removed when the reader exits. The regions written by this process
+    are shared with its readers.
+    """
+    if name in regions:
+        return regions[name]
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before python 3.13, every mapping is tracked
+        region = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(region._name, "shared_memory")
+        return region
+
+
+class TelemetryWriter:
+    """
+    Writes the telemetry fields of a DBEntry to its shared memory region,
+    and publishes them to the middleware at a lower rate.
+
+    Args:
+        entry (DBEntry): The entry, declaring its fields in telemetry.
+        publish_interval (float, optional): The time between middleware
+                                            updates, in seconds.
+                                            Defaults to PUBLISH_INTERVAL.
+
+    Methods:
+        write(**values): Update fields
+        publish(): Write the latest values to the middleware
+        close(): Publish the latest values and remove the region
+    """
+
+    def __init__(self, entry, publish_interval=PUBLISH_INTERVAL):
+        self.entry = entry
+        self.fields = entry.telemetry
+        self.layout = layout(self.fields)
+        self.publish_interval = publish_interval
+        self.values = {name: getattr(entry, name) for name in self.fields}
+        self.changed = set()
+        self.published_at = 0.0
+        self.sequence = 0
+
+        name = REGION_PREFIX + entry.prefix
+        try:
+            self.region = shared_memory.SharedMemory(name=name, create=True, size=self.layout.size)
+        except FileExistsError:
+            # left by a previous run of the driver
+            self.region = shared_memory.SharedMemory(name=name)
+            if self.region.size < self.layout.size:
+                self.region.close()
+                self.region.unlink()
+                self.region = shared_memory.SharedMemory(name=name, create=True, size=self.layout.size)
+        regions[name] = self.region
+
+    def write(self, **values):
+        """
+        Updates fields, in the region right away, and in the middleware
+        when the publish interval is over.
+
+        Args:
+            **values: The new values, by field name.
+        """
+        self.values.update(values)
+        self.changed.update(values)
+        self.sequence += 1  # odd: update in progress
+        struct.pack_into("<I", self.region.buf, 0, self.sequence)
+        self.layout.pack_into(self.region.buf, 0, self.sequence, time.time(), *self.values.values())
+        self.sequence += 1
+        struct.pack_into("<I", self.region.buf, 0, self.sequence)
+
+        if time.monotonic() - self.published_at >= self.publish_interval:
+            self.publish()
+
+    def publish(self):
+        """
+        Writes the values changed since the last update to the middleware.
+        """
+        for name in self.changed:
+            setattr(self.entry, name, self.values[name])
+        self.changed.clear()
+        self.published_at = time.monotonic()
+
+    def close(self):
+        """
+        Publishes the latest values and removes the region.
+        """
+        self.publish()
+        regions.pop(REGION_PREFIX + self.entry.prefix, None)
+        self.region.close()
+        self.region.unlink()
+
+
+class TelemetryReader:
+    """
+    Reads the telemetry fields of a DBEntry from its shared memory region.
+
+    Args:
+        prefix (str): The entry prefix.
+        fields (dict): The struct code of each field, in order.
+
+    Methods:
+        read(): Get the latest values
+    """
+
+    def __init__(self, prefix, fields):
+        self.name = REGION_PREFIX + prefix
+        self.fields = list(fields)
+        self.layout = layout(fields)
+        self.region = None
+        self.attached_at = 0.0
+
+    def read(self):
+        """
+        Returns the latest values, or None if the region is missing or
+        not updated recently, e.g. if the driver does not run on this
+        machine.
+
+        Returns:
+            dict: The values, by field name.
+        """
+        if self.region is not None and self.region.buf is None:
+            self.region = None  # closed by the writer of this process
+        if self.region is None:
+            if time.monotonic() - self.attached_at < ATTACH_INTERVAL:
+                return None
+            self.attached_at = time.monotonic()
+            try:
+                self.region = attach(self.name)
+            except OSError:
+                return None
+            if self.region.size < self.layout.size:
+                self.detach()
+                return None
+
+        for _ in range(READ_RETRIES):
+            values = self.layout.unpack_from(self.region.buf)
+            if values[0] % 2 == 1:
+                continue
+            (sequence,) = struct.unpack_from("<I", self.region.buf, 0)
+            if sequence != values[0]:
+                continue
+            if time.time() - values[1] > STALE_TIME:
+                # the driver stopped, it may have been restarted with a new region
+                self.detach()
+                return None
+            return dict(zip(self.fields, values[2:]))
+        return None
+
+    def detach(self):
+        """
+        Unmaps the region, unless this process writes it.
+        """
+        if regions.get(self.name) is not self.region:
+            self.region.close()
+        self.region = None
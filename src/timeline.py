@@ -0,0 +1,204 @@
+import os
+import time
+import wave
+
+# Sounds played by the game, read locally to know their durations
+SOUND_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "sounds", "emoshow")
+
+durations = {}  # Cached sound durations, by name
+
+
+def sound_duration(sound):
+    """
+    Returns the duration of a sound, read from its WAV header.
+
+    Args:
+        sound (str): The sound name, relative to the game sounds.
+
+    Returns:
+        float: The duration in seconds, or None if the file cannot be read.
+    """
+    if sound not in durations:
+        try:
+            with wave.open(os.path.join(SOUND_PATH, sound)) as f:
+                durations[sound] = f.getnframes() / f.getframerate()
+        except (OSError, EOFError, wave.Error):
+            durations[sound] = None
+    return durations[sound]
+
+
+class After:
+    """
+    A cue offset relative to the end of a sound of the same timeline.
+
+    Args:
+        sound (str): The sound name.
+        delay (float, optional): The time after the end of the sound, in
+                                 seconds. Defaults to 0.0.
+        minimum (float, optional): The earliest offset from the start of the
+                                   timeline, also used when the sound
+                                   duration is unknown. Defaults to 0.0.
+    """
+
+    def __init__(self, sound, delay=0.0, minimum=0.0):
+        self.sound = sound
+        self.delay = delay
+        self.minimum = minimum
+
+
+def after(sound, delay=0.0, minimum=0.0):
+    """
+    Returns a cue offset relative to the end of a sound, see After.
+    """
+    return After(sound, delay, minimum)
+
+
+class Timeline:
+    """
+    A declarative sequence of cues.
+
+    Each cue is an (offset, command, value) tuple. The offset is the time
+    from the start of the timeline, in seconds, or an After offset, which
+    follows the length of a sound played earlier in the same timeline.
+
+    Commands:
+        sound: Play a sound
+        image: Set the screen image
+        icon: Set the chest icon
+        pan: Move the pan to an angle
+        tilt: Move the tilt to an angle
+        move: Look at a player ("left", "right") or the middle ("center")
+        wait: Nothing, keeps the timeline running until its offset
+
+    Args:
+        cues (list): The (offset, command, value) cues.
+
+    Methods:
+        resolve(durations): Get the cues at absolute offsets, in order
+        duration(durations): Get the length of the timeline
+    """
+
+    def __init__(self, cues):
+        self.cues = list(cues)
+
+    def resolve(self, durations=sound_duration):
+        """
+        Converts the cue offsets to seconds from the start of the timeline.
+
+        Args:
+            durations (callable, optional): Returns the duration of a sound.
+                                            Defaults to reading the local
+                                            WAV header.
+
+        Returns:
+            list: The (offset, command, value) cues, sorted by offset.
+        """
+        resolved = []
+        sound_starts = {}
+        for offset, command, value in self.cues:
+            if isinstance(offset, After):
+                start = sound_starts.get(offset.sound)
+                length = durations(offset.sound)
+                if start is None or length is None:
+                    offset = offset.minimum
+                else:
+                    offset = max(offset.minimum, start + length + offset.delay)
+            if command == "sound":
+                sound_starts[value] = offset
+            resolved.append((offset, command, value))
+        # stable, so cues at the same offset keep their order
+        return sorted(resolved, key=lambda cue: cue[0])
+
+    def duration(self, durations=sound_duration):
+        """
+        Returns the length of the timeline, up to its last cue.
+
+        Args:
+            durations (callable, optional): Returns the duration of a sound.
+                                            Defaults to reading the local
+                                            WAV header.
+
+        Returns:
+            float: The length in seconds.
+        """
+        cues = self.resolve(durations)
+        return cues[-1][0] if len(cues) > 0 else 0.0
+
+
+class TimelinePlayer:
+    """
+    Plays timelines on the robot.
+
+    Cues are dispatched against a single start time, so delays do not add
+    up, and the cues that share an offset are sent in one datagram. Sound
+    durations are the ones reported by the robot.
+
+    Args:
+        elmo (object): The Elmo robot.
+
+    Methods:
+        play(timeline, stop): Play a timeline until its end
+        dispatch(command, value): Run a single cue
+    """
+
+    def __init__(self, elmo):
+        self.elmo = elmo
+
+    def play(self, timeline, stop=None):
+        """
+        Plays a timeline, returning after its last cue.
+
+        Args:
+            timeline (Timeline): The timeline.
+            stop (callable, optional): Returns True to stop early.
+                                       Defaults to never stopping.
+
+        Returns:
+            bool: True if the timeline played until its end.
+        """
+        cues = timeline.resolve(self.elmo.get_sound_duration)
+        start = time.monotonic()
+        i = 0
+        while i < len(cues):
+            offset = cues[i][0]
+            while True:
+                if stop is not None and stop():
+                    return False
+                remaining = start + offset - time.monotonic()
+                if remaining <= 0:
+                    break
+                time.sleep(min(remaining, 0.1))
+
+            with self.elmo.batch():
+                while i < len(cues) and cues[i][0] == offset:
+                    self.dispatch(cues[i][1], cues[i][2])
+                    i += 1
+        return True
+
+    def dispatch(self, command, value):
+        """
+        Runs a single cue.
+
+        Args:
+            command (str): The cue command.
+            value: The cue value.
+        """
+        if command == "sound":
+            self.elmo.play_sound(value)
+        elif command == "image":
+            self.elmo.set_image(value)
+        elif command == "icon":
+            self.elmo.set_icon(value)
+        elif command == "pan":
+            self.elmo.move_pan(value)
+        elif command == "tilt":
+            self.elmo.move_tilt(value)
+        elif command == "move":
+            if value == "left":
+                self.elmo.move_left()
+            elif value == "right":
+                self.elmo.move_right()
+            else:
+                self.elmo.move_pan(0)
+        elif command != "wait":
+            raise ValueError(f"Unknown cue command: {command}")
@@ -0,0 +1,129 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from emoshow_protocol import (  # noqa: E402
+    ACK,
+    ACK_REQUEST,
+    MAX_SESSIONS,
+    CommandReceiver,
+    coalesce,
+    decode,
+    encode,
+    encode_ack,
+    is_framed,
+)
+
+
+ADDRESS = ("127.0.0.1", 4000)
+
+
+class FakeSocket:
+    """
+    Records the datagrams sent by a CommandReceiver.
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+
+
+class TestEncodeDecode(unittest.TestCase):
+    def test_round_trip(self):
+        data = encode(7, 42, ["pan::-12.6", "image::normal.png", "tilt::5"])
+        self.assertTrue(is_framed(data))
+        flags, session, sequence, commands = decode(data)
+        self.assertEqual(flags, ACK_REQUEST)
+        self.assertEqual((session, sequence), (7, 42))
+        self.assertEqual(commands, [("pan", "-13"), ("image", "normal.png"), ("tilt", "5")])
+
+    def test_no_ack_request(self):
+        flags, _, _, _ = decode(encode(1, 1, ["icon::black.png"], ack_request=False))
+        self.assertEqual(flags, 0)
+
+    def test_values_with_separator(self):
+        _, _, _, commands = decode(encode(1, 1, ["feedback::a::b"]))
+        self.assertEqual(commands, [("feedback", "a::b")])
+
+    def test_unknown_command(self):
+        for message in ("motors::on", "behaviour::off", "blush::on", "track_face::off"):
+            with self.assertRaises(ValueError):
+                encode(1, 1, [message])
+
+    def test_malformed(self):
+        data = encode(1, 1, ["image::normal.png"])
+        with self.assertRaises(ValueError):
+            decode(data[:-1])
+        with self.assertRaises(ValueError):
+            decode(b"pan::10")
+
+    def test_ack(self):
+        flags, session, sequence, commands = decode(encode_ack(3, 9))
+        self.assertEqual((flags, session, sequence, commands), (ACK, 3, 9, []))
+
+
+class TestCoalesce(unittest.TestCase):
+    def test_keeps_last_state_command(self):
+        messages = ["pan::1", "sound::a.wav", "pan::2", "tilt::3", "image::x.png", "tilt::4"]
+        self.assertEqual(coalesce(messages), ["sound::a.wav", "pan::2", "image::x.png", "tilt::4"])
+
+    def test_keeps_every_event_command(self):
+        messages = ["sound::a.wav", "sound::b.wav", "feedback::ok"]
+        self.assertEqual(coalesce(messages), messages)
+
+
+class TestCommandReceiver(unittest.TestCase):
+    def setUp(self):
+        self.sock = FakeSocket()
+        self.receiver = CommandReceiver(self.sock)
+
+    def test_acknowledges(self):
+        commands = self.receiver.receive(encode(5, 1, ["pan::10", "sound::a.wav"]), ADDRESS)
+        self.assertEqual(commands, [("pan", "10"), ("sound", "a.wav")])
+        self.assertEqual(self.sock.sent, [(encode_ack(5, 1), ADDRESS)])
+
+    def test_no_ack_when_not_requested(self):
+        self.receiver.receive(encode(5, 1, ["pan::10"], ack_request=False), ADDRESS)
+        self.assertEqual(self.sock.sent, [])
+
+    def test_drops_duplicates(self):
+        data = encode(5, 1, ["sound::a.wav"])
+        self.receiver.receive(data, ADDRESS)
+        self.assertEqual(self.receiver.receive(data, ADDRESS), [])
+        self.assertEqual(len(self.sock.sent), 2)  # The retransmission is acknowledged again
+        self.assertEqual(self.receiver.get_stats()["duplicates"], 1)
+
+    def test_drops_stale_state_commands(self):
+        self.receiver.receive(encode(5, 2, ["pan::20"]), ADDRESS)
+        commands = self.receiver.receive(encode(5, 1, ["pan::10", "sound::a.wav"]), ADDRESS)
+        self.assertEqual(commands, [("sound", "a.wav")])
+        self.assertEqual(self.receiver.get_stats()["stale"], 1)
+
+    def test_sessions_are_independent(self):
+        self.receiver.receive(encode(5, 1, ["pan::10"]), ADDRESS)
+        self.assertEqual(self.receiver.receive(encode(6, 1, ["pan::20"]), ADDRESS), [("pan", "20")])
+
+    def test_forgets_old_sessions(self):
+        for session in range(MAX_SESSIONS + 10):
+            self.receiver.receive(encode(session, 1, ["pan::10"]), ADDRESS)
+        self.assertEqual(len(self.receiver.sessions), MAX_SESSIONS)
+        # the most recent sessions are still tracked
+        self.assertEqual(self.receiver.receive(encode(MAX_SESSIONS + 9, 1, ["pan::10"]), ADDRESS), [])
+
+    def test_text_datagram(self):
+        commands = self.receiver.receive(b"pan::10\nimage::normal.png", ADDRESS)
+        self.assertEqual(commands, [("pan", "10"), ("image", "normal.png")])
+        self.assertEqual(self.sock.sent, [])
+
+    def test_invalid_datagram(self):
+        data = encode(5, 1, ["image::normal.png"])
+        self.assertEqual(self.receiver.receive(data[:-1], ADDRESS), [])
+        self.assertEqual(self.receiver.get_stats()["invalid"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()